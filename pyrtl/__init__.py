@@ -77,7 +77,15 @@ from .conditional import currently_under_condition
 from .simulation import Simulation
 from .simulation import FastSimulation
 from .simulation import SimulationTrace
+from .simulation import TriggeredTrace
+from .simulation import SparseMemory
+from .simulation import DenseMemory
+from .simulation import MmapMemory
+from .simulation import SimulationDivergence
+from .simulation import lockstep
 from .compilesim import CompiledSimulation
+from .compilesim import SimulationCoverage
+from .fuzz import StimulusFuzzer
 
 # input and output to file format routines
 from .inputoutput import input_from_blif
@@ -1,63 +1,301 @@
 from __future__ import print_function, unicode_literals
 
+import array
+import copy
 import ctypes
+import hashlib
+import os
+import itertools
+import numbers
 import subprocess
 import tempfile
+import timeit
 import shutil
 import collections
+import zlib
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from os import path
 import platform
 import _ctypes
 
-from .core import working_block
+from .core import working_block, _net_sort_key
 from .wire import Input, Output, Const, WireVector, Register
 from .memory import RomBlock
 from .pyrtlexceptions import PyrtlError, PyrtlInternalError
-from .simulation import SimulationTrace
+from .simulation import SimulationTrace, SimulationCheckpoint, TriggeredTrace
+from .simulation import _trace_length, _trigger_state, _restore_trace, _copy_trace
+from .simulation import _input_columns, _run_until_checks, _run_until_steps
 
 
-__all__ = ['CompiledSimulation']
+__all__ = ['CompiledSimulation', 'SimulationCoverage']
+
+
+# array.array typecode of unsigned 64-bit words
+_WORD_TYPECODE = 'Q' if 'Q' in getattr(array, 'typecodes', '') else 'L'
+
+_build_executor = None
+
+
+def _background_builder():
+    """The executor shared by all CompiledSimulations compiling in the background."""
+    global _build_executor
+    if _build_executor is None:
+        try:
+            from concurrent.futures import ThreadPoolExecutor
+        except ImportError:
+            raise PyrtlError('compiling in the background requires concurrent.futures '
+                             '(install the "futures" package on Python 2)')
+        _build_executor = ThreadPoolExecutor(max_workers=cpu_count())
+    return _build_executor
+
+
+class _CompiledLibrary(object):
+    """A loaded simulation library, shared by every CompiledSimulation forked from one.
+
+    The library and the directory holding it are removed once no simulation uses it.
+    The library stays loaded while any context made by it is not yet freed, which
+    can happen when a simulation is part of a reference cycle collected along with
+    the library.
+    """
+
+    def __init__(self, directory):
+        self.dir = directory
+        self.dll = ctypes.CDLL(path.join(directory, 'pyrtlsim.so'))
+        self.contexts = 0  # the number of contexts allocated and not yet freed
+
+    def __del__(self):
+        handle = self.dll._handle
+        if self.contexts:
+            shutil.rmtree(self.dir, ignore_errors=True)
+            return
+        if platform.system() == 'Windows':
+            _ctypes.FreeLibrary(handle)  # pylint: disable=no-member
+        else:
+            _ctypes.dlclose(handle)  # pylint: disable=no-member
+        shutil.rmtree(self.dir)
+
+
+class _SparseSlot(ctypes.Structure):
+    """A slot of the hash table of pages of a sparse memory (sim_sparse_slot in C)."""
+    _fields_ = [('key', ctypes.c_uint64), ('data', ctypes.POINTER(ctypes.c_uint64))]
+
+
+class _SparseMem(ctypes.Structure):
+    """The pages of a sparse memory in the compiled code (sim_sparse_mem in C)."""
+    _fields_ = [('slots', ctypes.POINTER(_SparseSlot)),
+                ('cap', ctypes.c_uint64), ('count', ctypes.c_uint64)]
 
 
 class DllMemInspector(collections.Mapping):
-    """Dictionary-like access to a memory array in a CompiledSimulation."""
+    """Dictionary-like access to a memory array in a CompiledSimulation.
 
-    def __init__(self, sim, mem):
+    A sparse memory (see sparse_mem_threshold) holds just the pages of addresses
+    that have been written, and only the addresses of those pages are iterated over.
+    """
+
+    def __init__(self, sim, mem, lane=0):
         self._aw = mem.addrwidth
         bw = mem.bitwidth
         self._limbs = limbs = sim._limbs(mem)
-        self._vn = vn = sim.varname[mem]
-        if bw <= 8:
-            scalar = ctypes.c_uint8
-        elif bw <= 16:
-            scalar = ctypes.c_uint16
-        elif bw <= 32:
-            scalar = ctypes.c_uint32
+        self._vn = sim.varname[mem]
+        address = sim._dll.sim_mem(sim._ctx, lane, sim._mem_index[mem])
+        if mem in sim._sparse_mems:
+            self._page_bits = sim._page_bits(mem)
+            self._sparse = _SparseMem.from_address(address)
+            self._entry = sim._dll.sim_sparse_entry
         else:
-            scalar = ctypes.c_uint64
-        array_type = scalar*(len(self)*limbs)
-        self._buf = array_type.in_dll(sim._dll, vn)
-        self._sim = sim  # keep reference to avoid freeing dll
+            self._sparse = None
+            if bw <= 8:
+                scalar = ctypes.c_uint8
+            elif bw <= 16:
+                scalar = ctypes.c_uint16
+            elif bw <= 32:
+                scalar = ctypes.c_uint32
+            else:
+                scalar = ctypes.c_uint64
+            array_type = scalar*(len(self)*limbs)
+            self._buf = array_type.from_address(address)
+        self._lane = lane
+        self._sim = sim  # keep reference to avoid freeing the context
 
     def __getitem__(self, ind):
         val = 0
         limbs = self._limbs
-        for n in reversed(range(ind*limbs, (ind+1)*limbs)):
+        if self._sparse is not None:
+            buf = self._entry(ctypes.addressof(self._sparse), ind, self._page_bits, limbs)
+            start = 0
+        else:
+            buf, start = self._buf, ind*limbs
+        for n in reversed(range(start, start+limbs)):
             val <<= 64
-            val |= self._buf[n]
+            val |= buf[n]
         return val
 
+    def _pages(self):
+        """The numbers of the populated pages of a sparse memory, in order."""
+        sparse = self._sparse
+        return sorted(sparse.slots[n].key-1 for n in range(sparse.cap) if sparse.slots[n].key)
+
     def __iter__(self):
+        if self._sparse is not None:
+            size = 1 << self._page_bits
+            return itertools.chain.from_iterable(
+                range(page*size, (page+1)*size) for page in self._pages())
         return iter(range(len(self)))
 
     def __len__(self):
+        if self._sparse is not None:
+            return self._sparse.count << self._page_bits
         return 1 << self._aw
 
+    def _values(self):
+        """The values at every address of a dense memory, read in bulk."""
+        words = self._buf[:]
+        limbs = self._limbs
+        if limbs == 1:
+            return words
+        values = []
+        for start in range(0, len(words), limbs):
+            val = 0
+            for word in reversed(words[start:start+limbs]):
+                val = (val << 64) | word
+            values.append(val)
+        return values
+
     def __eq__(self, other):
         if isinstance(other, DllMemInspector):
-            if self._sim is other._sim and self._vn == other._vn:
+            if (self._sim is other._sim and self._vn == other._vn and
+                    self._lane == other._lane):
                 return True
-        return all(self[x] == other.get(x, 0) for x in self)
+            if (self._sparse is None and other._sparse is None and
+                    ctypes.sizeof(self._buf) == ctypes.sizeof(other._buf) and
+                    self._limbs == other._limbs):
+                return bytes(self._buf) == bytes(other._buf)
+        if self._sparse is not None:
+            # the populated pages must match other, and other's nonzero entries self
+            return (all(self[x] == other.get(x, 0) for x in self) and
+                    all(0 <= x < 1 << self._aw and self[x] == val
+                        for x, val in other.items() if val))
+        # every entry of other must match, and no other address may be nonzero
+        values = self._values()
+        matched = 0
+        for addr, val in other.items():
+            if 0 <= addr < len(values):
+                if values[addr] != val:
+                    return False
+                matched += val != 0
+            elif val:
+                return False
+        return len(values) - values.count(0) == matched
+
+
+def _bit_ranges(bits):
+    """Describe a sorted list of numbers as a string of ranges, like '0-3, 7'."""
+    ranges = []
+    for bit in bits:
+        if ranges and ranges[-1][1] == bit-1:
+            ranges[-1][1] = bit
+        else:
+            ranges.append([bit, bit])
+    return ', '.join(str(lo) if lo == hi else '{}-{}'.format(lo, hi) for lo, hi in ranges)
+
+
+class SimulationCoverage(object):
+    """The toggle and value coverage of the wires of a CompiledSimulation.
+
+    * *toggled*: a NumPy array of 64-bit words, holding for each wire (in order of
+      name) the limbs of a bitmap of the bits that have changed value
+    * *counts*: a NumPy array holding for each wire the number of steps its value
+      was in each of its buckets (empty unless coverage_buckets was given)
+    * *steps*: the number of steps covered
+    * *wires*: a map from the name of each wire to its bitwidth and the positions
+      of its words in toggled and its buckets in counts
+
+    Coverage of the same design, from other runs, lanes or processes (it can be
+    pickled), is combined with merge.
+    """
+
+    def __init__(self, wires, toggled, counts, steps):
+        self.wires = wires
+        self.toggled = toggled
+        self.counts = counts
+        self.steps = steps
+
+    def merge(self, other):
+        """Return the coverage of both this and other, which must be of the same design."""
+        if other.wires != self.wires:
+            raise PyrtlError('cannot merge the coverage of different designs')
+        return SimulationCoverage(self.wires, self.toggled | other.toggled,
+                                  self.counts + other.counts, self.steps + other.steps)
+
+    def toggled_bits(self, w):
+        """Get the bits of a wire that have toggled, as an integer bitmask."""
+        if isinstance(w, WireVector):
+            w = w.name
+        _, start, limbs, _, _ = self.wires[w]
+        val = 0
+        for word in reversed(self.toggled[start:start+limbs]):
+            val = (val << 64) | int(word)
+        return val
+
+    def bucket_counts(self, w):
+        """Get the number of steps a wire's value was in each of its buckets.
+
+        The values of a wire of bitwidth b are split between buckets of equal
+        ranges, so bucket k of n holds the values from k << (b - log2(n)) on.
+        """
+        if isinstance(w, WireVector):
+            w = w.name
+        _, _, _, start, count = self.wires[w]
+        return self.counts[start:start+count]
+
+    def uncovered(self):
+        """Get the wires that are not fully covered.
+
+        :return: a map from the name of each such wire to a pair of the list of its
+          bits that never toggled and the list of its buckets that were never hit
+        """
+        result = {}
+        for name in sorted(self.wires):
+            bitwidth, _, _, _, count = self.wires[name]
+            toggled = self.toggled_bits(name)
+            bits = [bit for bit in range(bitwidth) if not (toggled >> bit) & 1]
+            buckets = []
+            if count:
+                buckets = [int(k) for k in (self.bucket_counts(name) == 0).nonzero()[0]]
+            if bits or buckets:
+                result[name] = bits, buckets
+        return result
+
+    def report(self, block=None):
+        """Describe the coverage and the uncovered wires of block, as a string.
+
+        Each uncovered wire is followed by the call stack that created it, if it was
+        kept (see set_debug_mode).
+        """
+        from .helperfuncs import get_stack
+        block = working_block(block)
+        bits = sum(bitwidth for bitwidth, _, _, _, _ in self.wires.values())
+        toggled = sum(bin(self.toggled_bits(name)).count('1') for name in self.wires)
+        lines = ['toggle coverage: {} of {} bits ({:.1f}%) in {} steps'.format(
+            toggled, bits, 100.0*toggled/max(bits, 1), self.steps)]
+        if len(self.counts):
+            hit = int((self.counts != 0).sum())
+            lines.append('value coverage: {} of {} buckets ({:.1f}%)'.format(
+                hit, len(self.counts), 100.0*hit/len(self.counts)))
+        for name, (bits, buckets) in sorted(self.uncovered().items()):
+            line = '{}:'.format(name)
+            if bits:
+                line += ' bits {} never toggled'.format(_bit_ranges(bits))
+            if buckets:
+                line += '{} buckets {} of {} never hit'.format(
+                    ';' if bits else '', _bit_ranges(buckets), self.wires[name][4])
+            lines.append(line)
+            w = block.wirevector_by_name.get(name)
+            if w is not None and getattr(w, 'init_call_stack', None):
+                lines.append(get_stack(w).rstrip('\n'))
+        return '\n'.join(lines) + '\n'
 
 
 class CompiledSimulation(object):
@@ -76,18 +314,71 @@ class CompiledSimulation(object):
         - A 64-bit processor
         - GCC (tested on version 4.8.4)
         - A 64-bit build of Python
-    If using the multiplication operand, only some architectures are supported:
+    If using the multiplication operand with opt_level 0 and a compiler without
+    unsigned __int128, only some architectures are supported:
         - x86-64 / amd64
         - arm64 / aarch64 (untested)
         - mips64 (untested)
 
     default_value is currently only implemented for registers, not memories.
+
+    Each simulation keeps all of its state in a context of its own in the compiled
+    library, so simulations made with fork() share one library and can run at the
+    same time from different threads.
     """
 
     def __init__(
             self, tracer=True, register_value_map={}, memory_value_map={},
-            default_value=0, block=None):
-        self._dll = self._dir = None
+            default_value=0, block=None, fast_forward=False, opt_level=0, cache_dir=None,
+            partition_size=None, background=False, lanes=1, threads=1,
+            sparse_mem_threshold=1 << 20, coverage=False, coverage_buckets=0):
+        """Generate the C code of a block and compile it into a library.
+
+        :param tracer: the tracer (or None), as for Simulation.  Any wire of the block
+          can be traced.  A TriggeredTrace whose trigger is a dictionary of wire
+          values is checked in the compiled code, so only the captured steps are passed
+          back to Python; a trigger given as a function is checked after each run.
+        :param register_value_map: the initial values of registers, as for Simulation
+        :param memory_value_map: the initial contents of memories, as for Simulation,
+          which are loaded into each new simulation rather than compiled into the code.
+          Contents may also be a NumPy array of the values from address 0 on (laid
+          out as for mem_array).
+        :param default_value: the initial value of registers not in register_value_map
+        :param block: the block to simulate; defaults to the working block
+        :param fast_forward: if True, once the registers and memories reach a fixed
+          point under unchanged inputs, copy the previous outputs instead of simulating
+          for as long as the inputs stay the same.  The number of cycles skipped is
+          kept in cycles_skipped.
+        :param opt_level: the optimization level passed to gcc (as -O<opt_level>).  The
+          default of 0 compiles fastest; higher levels simulate faster.
+        :param cache_dir: a directory in which to keep compiled libraries, named by a
+          hash of the generated code and compiler flags, so that a later simulation of
+          the same design (even in another process) reuses the library
+        :param partition_size: split the logic into functions of about this many nets,
+          in separate source files compiled in parallel.  The split points depend on
+          wire names, so after a small edit only the partitions around it are
+          recompiled (with a cache_dir).
+        :param background: if True, leave compiling the generated code to a background
+          thread and return at once (see wait and build_future)
+        :param lanes: the number of independent copies of the state, stepped together
+          by run_lanes.  Everything else, including the trace, works on lane 0.
+        :param threads: the number of threads among which the logic of each step is
+          split, in tasks of about equal cost (see parallel_report).  This only pays
+          off for designs with thousands of nets.
+        :param sparse_mem_threshold: MemBlocks with more addresses than this are stored
+          sparsely, in pages allocated as they are first written
+        :param coverage: if True, record the toggle coverage of every wire (see
+          get_coverage)
+        :param coverage_buckets: with coverage, also count the steps in which each
+          wire's value fell in each of this many (a power of two) equal ranges
+
+        The rtl_asserts of the block are checked after every step of a run, and a
+        failure stops the run after that step.  The steps run are traced, and then the
+        assertion's exception is raised, with assertion_failure set to the name of the
+        assertion's Output and the number of the step (counting from 0 in that call) in
+        which it failed.  assertion_failure is None after a run in which all held.
+        """
+        self._dll = self._dir = self._lib = self._ctx = None
         self.block = working_block(block)
         self.block.sanity_check()
 
@@ -95,31 +386,302 @@ class CompiledSimulation(object):
             tracer = SimulationTrace()
         self.tracer = tracer
         self._remove_untraceable()
+        self._capture = (isinstance(tracer, TriggeredTrace) and
+                         not callable(tracer.trigger))
+        if self._capture:
+            tracer._trigger_test(list(tracer.trace))  # check the trigger wires are traced
 
         self.default_value = default_value
+        self.fast_forward = fast_forward
+        self.cycles_skipped = 0
+        self._mem_viewed = False  # whether mem_array may have changed memories
+        self.assertion_failure = None
+        if opt_level not in (0, 1, 2, 3, 's'):
+            raise PyrtlError('opt_level must be 0, 1, 2, 3 or "s"')
+        self.opt_level = opt_level
+        self.cache_dir = cache_dir
+        if partition_size is not None and partition_size < 1:
+            raise PyrtlError('partition_size must be at least 1')
+        self.partition_size = partition_size
+        self.background = background
+        self.build_future = None
+        if lanes < 1:
+            raise PyrtlError('lanes must be at least 1')
+        self.lanes = lanes
+        if threads < 1:
+            raise PyrtlError('threads must be at least 1')
+        if threads > 1 and platform.system() == 'Windows':
+            raise PyrtlError('threads are not supported on Windows')
+        self.threads = threads
+        self.sparse_mem_threshold = sparse_mem_threshold
+        if coverage_buckets and not coverage:
+            raise PyrtlError('coverage_buckets needs coverage')
+        if coverage_buckets < 0 or coverage_buckets & (coverage_buckets-1) or \
+                coverage_buckets > 1 << 16:
+            raise PyrtlError('coverage_buckets must be a power of two, up to 65536')
+        self.coverage = coverage
+        self.coverage_buckets = coverage_buckets
         self._regmap, self._memmap = register_value_map, memory_value_map
         self._uid_counter = 0
+        self._used_names = set()
         self.varname = {}  # mapping from wires and memories to C variables
 
         self._create_dll()
 
-    def inspect_mem(self, mem):
-        """Get a view into the contents of a MemBlock."""
-        return DllMemInspector(self, mem)
+    def inspect_mem(self, mem, lane=0):
+        """Get a view into the contents of a MemBlock (in the given lane)."""
+        self.wait()
+        return DllMemInspector(self, mem, lane)
+
+    def checkpoint(self):
+        """Capture the current state of the simulation (see Simulation.checkpoint).
+
+        Register values are read out of the compiled code, and the contents of
+        each memory are copied as raw bytes, as is the rest of the state kept in the
+        compiled code (see _state_buffers) as the checkpoint's context.
+        """
+        self.wait()
+        regbuf = (ctypes.c_uint64*self._regbufsz)()
+        self._dll.sim_save_regs(self._ctx, 0, regbuf)
+        registers = {}
+        for name, (start, count) in self._regpos.items():
+            val = 0
+            for pos in reversed(range(start, start+count)):
+                val <<= 64
+                val |= regbuf[pos]
+            registers[name] = val
+        memories = {}
+        for mem in self._mems:
+            if mem in self._sparse_mems:
+                memories[self.varname[mem]] = {
+                    addr: val for addr, val in self.inspect_mem(mem).items() if val}
+                continue
+            buf = self._mem_buffer(mem)
+            memories[self.varname[mem]] = ctypes.string_at(
+                ctypes.addressof(buf), ctypes.sizeof(buf))
+        context = {name: ctypes.string_at(address, size)
+                   for name, (address, size) in self._state_buffers().items()}
+        return SimulationCheckpoint(
+            registers=registers, memories=memories,
+            trace_length=_trace_length(self.tracer),
+            trigger_state=_trigger_state(self.tracer), context=context)
+
+    def restore(self, checkpoint):
+        """Return the simulation to the state captured by checkpoint.
+
+        See Simulation.restore for details.
+        """
+        self.wait()
+        regbuf = (ctypes.c_uint64*self._regbufsz)()
+        for name, val in checkpoint.registers.items():
+            start, count = self._regpos[name]
+            for pos in range(start, start+count):
+                regbuf[pos] = val & ((1 << 64)-1)
+                val >>= 64
+        self._dll.sim_load_regs(self._ctx, 0, regbuf)
+        for mem in self._mems:
+            contents = checkpoint.memories[self.varname[mem]]
+            if mem in self._sparse_mems:
+                self._dll.sim_mem_clear(self._ctx, 0, self._mem_index[mem])
+                self._load_mem(self._ctx, 0, mem, contents)
+                continue
+            buf = self._mem_buffer(mem)
+            ctypes.memmove(ctypes.addressof(buf), contents, len(contents))
+        for name, (address, size) in self._state_buffers().items():
+            ctypes.memmove(address, checkpoint.context[name], size)
+        self._wake()
+        _restore_trace(self.tracer, checkpoint)
+
+    def _state_buffers(self):
+        """Get the address and size of the state in lane 0 besides registers and memories.
+
+        This is the capture of a TriggeredTrace checked in the compiled code, and the
+        values of the last step, against which coverage finds the toggles of the next.
+        """
+        buffers = {}
+        if self._capture:
+            size = ctypes.c_uint64(0)
+            address = self._dll.sim_capture(self._ctx, ctypes.byref(size))
+            buffers['capture'] = address, size.value
+        if self.coverage:
+            buffers['coverage'] = self._dll.sim_coverage(self._ctx, 0, 3), 8*(1+self._cov_words)
+        return buffers
+
+    def fork(self):
+        """Return a new CompiledSimulation that starts from the current state.
+
+        The fork shares the compiled library, with a new context giving it its own
+        registers, memories, and trace, so it can be run in another thread while
+        this simulation runs.  Only lane 0 is copied; other lanes start afresh.
+        """
+        self.wait()
+        sim = copy.copy(self)
+        sim._ctx = sim._new_context()
+        sim.tracer = _copy_trace(self.tracer)
+        sim.restore(self.checkpoint())
+        return sim
+
+    def parallel_report(self, inputs=None):
+        """Describe how well the logic is split between the threads (see threads).
+
+        :param inputs: if given, steps of inputs (as for run) to time on forks of the
+          simulation, once with its threads and once without
+        :return: a dictionary holding the estimated 'thread_costs' of the tasks each
+          thread runs, their 'balance' (the mean cost over the greatest, so 1.0 when
+          perfectly balanced), the 'estimated_speedup' allowing for the time tasks
+          spend waiting for each other, and, if inputs were given, the measured
+          'speedup' over running every task in one thread
+
+        The tasks are scheduled ahead of time onto the threads, the extra ones started
+        by the compiled code for each simulation.  A task waits only for the tasks in
+        other threads whose results it reads, and all of them finish before registers
+        and memories are updated.
+        """
+        if self.threads == 1:
+            raise PyrtlError('parallel_report needs a simulation with threads')
+        costs = [0]*self.threads
+        for cost, t in zip(self._task_costs, self._task_thread):
+            costs[t] += cost
+        report = {
+            'threads': self.threads,
+            'tasks': len(self._task_costs),
+            'thread_costs': costs,
+            'balance': float(sum(costs)) / (self.threads*max(costs)),
+            'estimated_speedup': float(sum(costs)) / max(self._thread_finish),
+        }
+        if inputs is not None:
+            if not isinstance(inputs, collections.Mapping):
+                inputs = {w: [step[w] for step in inputs] for w in inputs[0]}
+            times = []
+            for serial in (1, 0):
+                sim = self.fork()
+                sim.tracer = None
+                self._dll.sim_serial(sim._ctx, serial)
+                start = timeit.default_timer()
+                sim.run_columns(inputs)
+                times.append(timeit.default_timer() - start)
+            report['speedup'] = times[0] / times[1]
+        return report
+
+    def get_coverage(self, lane=None):
+        """Read the coverage collected so far (see coverage).
+
+        :param lane: the lane whose coverage to read, or None for all of them merged
+        :return: a SimulationCoverage
+
+        In each step, the bits of every wire (other than constants) that changed
+        since the last step are recorded, and with coverage_buckets, the bucket its
+        value fell in is counted.  Steps skipped by fast_forward are not counted.
+        """
+        try:
+            import numpy
+        except ImportError:
+            raise PyrtlError('need numpy installed (try "pip install numpy")')
+        if not self.coverage:
+            raise PyrtlError('coverage was not collected; use coverage=True')
+        self.wait()
+        result = None
+        for n in range(self.lanes) if lane is None else [lane]:
+            arrays = []
+            for which, size in enumerate((self._cov_words, self._cov_buckets, 1)):
+                buf = (ctypes.c_uint64*size).from_address(
+                    self._dll.sim_coverage(self._ctx, n, which))
+                arrays.append(numpy.frombuffer(buf, dtype=numpy.uint64).copy())
+            toggled, counts, steps = arrays
+            cov = SimulationCoverage(self._cov_layout, toggled, counts[:self._cov_used],
+                                     int(steps[0]))
+            result = cov if result is None else result.merge(cov)
+        return result
+
+    def clear_coverage(self):
+        """Discard the coverage collected so far, in every lane.
+
+        The toggles of the next step are still found against the last step run (or
+        for lane 0, the step before the last checkpoint restored).
+        """
+        if not self.coverage:
+            raise PyrtlError('coverage was not collected; use coverage=True')
+        self.wait()
+        for lane in range(self.lanes):
+            self._dll.sim_coverage_clear(self._ctx, lane)
+
+    def _mem_buffer(self, mem):
+        """Get a ctypes array over the storage of a memory in the compiled code."""
+        return DllMemInspector(self, mem)._buf
+
+    def mem_array(self, mem, lane=0):
+        """Get a NumPy array that is a view of the storage of a MemBlock (in a lane).
+
+        :param mem: a MemBlock that is not stored sparsely (see sparse_mem_threshold)
+        :param lane: the lane whose copy of the memory to view
+        :return: an array of unsigned integers of the smallest of 8, 16, 32 or 64 bits
+          holding each entry, indexed by address, or for memories over 64 bits wide,
+          an array of shape (addresses, limbs) of their 64-bit limbs, least
+          significant first
+
+        The array shares its storage with the simulation, so it can be used to read,
+        write, compare or save the whole memory at once, between runs.  It is only
+        valid while the simulation exists.
+        """
+        self.wait()
+        self._mem_viewed = True
+        return self._mem_view(self._ctx, lane, mem)
+
+    def _wake(self, force=True):
+        """With fast_forward, make sure the next step is simulated rather than skipped.
+
+        This is needed whenever the state is changed other than by a step, which
+        mem_array allows at any time between runs.
+        """
+        if self.fast_forward and (force or self._mem_viewed):
+            self._dll.sim_wake(self._ctx)
 
-    def inspect(self, w):
-        """Get the latest value of the wire given, if possible."""
+    def _mem_view(self, ctx, lane, mem):
+        """Get a NumPy array that is a view of a memory of the given context."""
+        try:
+            import numpy
+        except ImportError:
+            raise PyrtlError('need numpy installed (try "pip install numpy")')
+        if mem not in self._mem_index:
+            raise PyrtlError('MemBlock "%s" is not written in the simulated block' % mem.name)
+        if mem in self._sparse_mems:
+            raise PyrtlError('MemBlock "%s" is stored sparsely, so it has no array; use '
+                             'inspect_mem instead' % mem.name)
+        width = 64 if self._limbs(mem) > 1 else self._memwidth(mem)
+        size = (1 << mem.addrwidth)*self._limbs(mem)*width // 8
+        buf = (ctypes.c_uint8*size).from_address(
+            self._dll.sim_mem(ctx, lane, self._mem_index[mem]))
+        view = numpy.frombuffer(buf, dtype='uint{}'.format(width))
+        if self._limbs(mem) > 1:
+            view = view.reshape(1 << mem.addrwidth, self._limbs(mem))
+        return view
+
+    def inspect(self, w, lane=0):
+        """Get the value of a wire in the last step (in the given lane).
+
+        Wires traced by a SimulationTrace are read from the trace, and any other wire
+        of the block is read straight from its storage in the compiled code.  (A
+        TriggeredTrace need not hold the last step.)
+        """
         if isinstance(w, WireVector):
             w = w.name
-        try:
+        if lane == 0 and self.tracer is not None and w in self.tracer._wires and \
+                not isinstance(self.tracer, TriggeredTrace):
             vals = self.tracer.trace[w]
-        except KeyError:
-            pass
-        else:
             if not vals:
                 raise PyrtlError('No context available. Please run a simulation step')
             return vals[-1]
-        raise PyrtlError('CompiledSimulation does not support inspecting internal WireVectors')
+        try:
+            index, limbs = self._wire_index[w]
+        except KeyError:
+            raise PyrtlError('Wire "%s" is not in the simulated block' % w)
+        self.wait()
+        buf = (ctypes.c_uint64*limbs).from_address(self._dll.sim_wire(self._ctx, lane, index))
+        val = 0
+        for limb in reversed(buf):
+            val <<= 64
+            val |= limb
+        return val
 
     def step(self, inputs):
         """Run one step of the simulation.
@@ -133,15 +695,21 @@ class CompiledSimulation(object):
 
         The argument is a list of input mappings for each step,
         and its length is the number of steps to be executed.
+        It may also be a dictionary of input columns, as for run_columns.
+        Returns the number of those steps skipped by fast_forward.
         """
+        self.wait()
+        if isinstance(inputs, collections.Mapping):
+            skipped_before = self.cycles_skipped
+            self.run_columns(inputs)
+            return self.cycles_skipped - skipped_before
         steps = len(inputs)
         # create i/o arrays of the appropriate length
         ibuf_type = ctypes.c_uint64*(steps*self._ibufsz)
         obuf_type = ctypes.c_uint64*(steps*self._obufsz)
         ibuf = ibuf_type()
         obuf = obuf_type()
-        # these array will be passed to _crun
-        self._crun.argtypes = [ctypes.c_uint64, ibuf_type, obuf_type]
+        skipped = ctypes.c_uint64(0)
 
         # build the input array
         for n, inmap in enumerate(inputs):
@@ -150,84 +718,677 @@ class CompiledSimulation(object):
                     name = w.name
                 else:
                     name = w
-                start, count = self._inputpos[name]
-                start += n*self._ibufsz
                 val = inmap[w]
                 if val >= 1 << self._inputbw[name]:
                     raise PyrtlError(
                         'Wire {} has value {} which cannot be represented '
                         'using its bitwidth'.format(name, val))
-                # pack input
-                for pos in range(start, start+count):
-                    ibuf[pos] = val & ((1 << 64)-1)
-                    val >>= 64
+                self._pack(ibuf, self._inputpos[name], n*self._ibufsz, val)
+
+        if self._capture:
+            self._run_capture(steps, ibuf)
+            return 0
 
         # run the simulation
-        self._crun(steps, ibuf, obuf)
+        self._wake(force=False)
+        self._crun(self._ctx, steps, ibuf, obuf, ctypes.byref(skipped))
+        self.cycles_skipped += skipped.value
+        steps = self._assertion_steps(steps)
 
         # save traced wires
+        if self.tracer is not None:
+            values = {}
+            for name in self.tracer.trace:
+                if name in self._outputpos:
+                    start, count = self._outputpos[name]
+                    buf, sz = obuf, self._obufsz
+                elif name in self._inputpos:
+                    start, count = self._inputpos[name]
+                    buf, sz = ibuf, self._ibufsz
+                else:
+                    raise PyrtlInternalError('Untraceable wire in tracer')
+                values[name] = self._unpack(buf, start, count, sz, steps)
+            self.tracer.add_steps_named(values)
+        self._raise_assertion()
+        return skipped.value
+
+    def run_columns(self, inputs, nsteps=None, validate=True):
+        """Run many steps of the simulation on arrays of input values.
+
+        :param inputs: a dictionary mapping each input (or its name) to a single value
+          to hold for every step, to a sequence of per-step values, or to a buffer of
+          64-bit unsigned integers (such as an array.array('Q') or a numpy uint64
+          array) holding the limbs of each step's value in turn, least significant
+          limb first.  Writable buffers of the right size are passed to the compiled
+          code as they are, without being copied.
+        :param nsteps: the number of steps to run; defaults to the length of the inputs
+        :param validate: if False, skip checking that the values fit their inputs
+        :return: a dictionary mapping each output name to an array.array('Q') of its
+          limbs for each step (so just its values, for outputs of up to 64 bits)
+
+        Wires of up to 64 bits are added to the trace straight from the arrays.
+        """
+        self.wait()
+        if self._capture:
+            raise PyrtlError('run_columns is not supported with a TriggeredTrace '
+                             'checked in the compiled code')
+        incols, outputs, nsteps = self._run_columns(inputs, nsteps, validate)
+        if self.tracer is not None:
+            self._trace_columns(self.tracer, incols, outputs, nsteps)
+        self._raise_assertion()
+        return {name: outputs[name] for name in self._output_names}
+
+    def _run_columns(self, inputs, nsteps, validate):
+        """Run steps on a dictionary of input columns (see run_columns).
+
+        Returns the input columns as passed to the compiled code, a dictionary of the
+        columns copied out (including traced wires that are not outputs), and the
+        number of steps run, which is fewer than asked for if an rtl_assert failed.
+        """
+        columns = {}
+        for w, column in inputs.items():
+            name = w.name if isinstance(w, WireVector) else w
+            if name not in self._inputpos:
+                raise PyrtlError('run provided a value for input for "%s" which is '
+                                 'not a known input ' % name)
+            columns[name] = column
+        for name in self._required_inputs.difference(columns):
+            raise PyrtlError('Input "%s" has no input value specified' % name)
+        if nsteps is None:
+            lengths = {len(c) // self._inputpos[name][1] for name, c in columns.items()
+                       if not isinstance(c, numbers.Integral)}
+            if len(lengths) != 1:
+                raise PyrtlError(
+                    'run cannot infer the number of steps, either provide nsteps or '
+                    'sequences for the inputs that are all of the same length')
+            nsteps = lengths.pop()
+
+        incols = [self._input_column(name, columns[name], nsteps, validate)
+                  for name in self._input_order]
+        outcols = [array.array(_WORD_TYPECODE, [0])*(nsteps*self._outputpos[name][1])
+                   for name in self._output_order]
+        words = ctypes.POINTER(ctypes.c_uint64)
+        skipped = ctypes.c_uint64(0)
+        self._wake(force=False)
+        self._dll.sim_run_columns(
+            self._ctx, nsteps,
+            (words*(len(incols)+1))(*[ctypes.cast(c, words) for c in incols]),
+            (words*(len(outcols)+1))(*[self._words(c) for c in outcols]),
+            ctypes.byref(skipped))
+        self.cycles_skipped += skipped.value
+        ran = self._assertion_steps(nsteps)
+        if ran < nsteps:
+            outcols = [col[:ran*self._outputpos[name][1]]
+                       for name, col in zip(self._output_order, outcols)]
+            incols = [col[:ran*self._inputpos[name][1]]
+                      for name, col in zip(self._input_order, incols)]
+        return incols, dict(zip(self._output_order, outcols)), ran
+
+    def _trace_columns(self, tracer, incols, outputs, nsteps):
+        """Add the columns of a run of nsteps (from _run_columns) to a tracer."""
+        values = {}
+        for name in tracer.trace:
+            if name in self._outputpos:
+                count, column = self._outputpos[name][1], outputs[name]
+            else:
+                count = self._inputpos[name][1]
+                column = incols[self._input_order.index(name)]
+            if count == 1:
+                values[name] = column
+            else:
+                values[name] = self._unpack(column, 0, count, count, nsteps)
+        tracer.add_steps_named(values)
+
+    def run_stream(self, inputs, sink=None, chunk_size=65536, validate=True):
+        """Run the simulation on a stream of inputs, calling the compiled code per chunk.
+
+        :param inputs: an iterable, such as a generator, either of input mappings for
+          each step (as for run), which are gathered into chunks of chunk_size steps,
+          or of dictionaries of input columns (as for run_columns), each run as a chunk
+        :param sink: what is given the outputs of each chunk: a function, called with
+          the number of the chunk's first step (counting from the start of the stream)
+          and a dictionary of output columns (as returned by run_columns); a
+          SimulationTrace, to which the chunk is added; or a binary file, to which
+          the limbs of the outputs are written, a row of them (in order of output
+          name) for each step
+        :param chunk_size: the number of steps in a chunk of step mappings
+        :param validate: if False, skip checking that the values fit their inputs
+        :return: the number of steps run
+
+        Only one chunk is held at a time, so the memory used is bounded by the size of
+        a chunk, however long the stream is.  The simulation's own tracer is not added
+        to, unless it is given as the sink.
+        """
+        self.wait()
+        if self._capture:
+            raise PyrtlError('run_stream is not supported with a TriggeredTrace '
+                             'checked in the compiled code')
+        if chunk_size < 1:
+            raise PyrtlError('chunk_size must be at least 1')
+        if isinstance(sink, SimulationTrace):
+            for name in sink.trace:
+                if name not in self._outputpos and name not in self._inputpos:
+                    raise PyrtlError('the sink traces "%s", which is not an input, '
+                                     'output or wire traced by the simulation' % name)
+        inputs = iter(inputs)
+        total = 0
+        for first in inputs:
+            if all(isinstance(v, numbers.Integral) for v in first.values()):
+                steps = [first]
+                steps.extend(itertools.islice(inputs, chunk_size-1))
+                try:
+                    chunk = {w: [step[w] for step in steps] for w in first}
+                except KeyError:
+                    raise PyrtlError('every step of the stream must give the same inputs')
+                nsteps = len(steps)
+            else:
+                chunk, nsteps = first, None
+            incols, outputs, nsteps = self._run_columns(chunk, nsteps, validate)
+            if isinstance(sink, SimulationTrace):
+                self._trace_columns(sink, incols, outputs, nsteps)
+            elif callable(sink):
+                sink(total, {name: outputs[name] for name in self._output_names})
+            elif sink is not None:
+                rows = self._output_rows(outputs, nsteps)
+                sink.write(rows.tobytes() if hasattr(rows, 'tobytes') else rows.tostring())
+            total += nsteps
+            self._raise_assertion()
+        return total
+
+    def _output_rows(self, outputs, nsteps):
+        """Interleave the columns of the outputs into an array of a row per step."""
+        rowsz = sum(self._outputpos[name][1] for name in self._output_names)
+        rows = array.array(_WORD_TYPECODE, [0])*(nsteps*rowsz)
+        pos = 0
+        for name in self._output_names:
+            count = self._outputpos[name][1]
+            for n in range(count):
+                rows[pos::rowsz] = outputs[name][n::count]
+                pos += 1
+        return rows
+
+    def run_lanes(self, inputs, nsteps=None, validate=True):
+        """Run many steps of every lane of the simulation at once.
+
+        :param inputs: a dictionary mapping each input (or its name) to a single value
+          to hold for every step of every lane, to a sequence with, for each step, a
+          sequence of the values for each lane, or to a flat sequence or buffer of the
+          values (or limbs of the values, for inputs over 64 bits) for each lane of
+          each step in turn (see run_columns)
+        :param nsteps: the number of steps to run; defaults to the length of the inputs
+        :param validate: if False, skip checking that the values fit their inputs
+        :return: a dictionary mapping each output name to an array.array('Q') of its
+          limbs for each lane of each step in turn, so the value of an output of up to
+          64 bits in lane l of step n is at index n*lanes+l
+
+        The lanes are independent copies of the design, and are not traced.
+        """
+        self.wait()
+        columns = {}
+        for w, column in inputs.items():
+            name = w.name if isinstance(w, WireVector) else w
+            if name not in self._inputpos:
+                raise PyrtlError('run provided a value for input for "%s" which is '
+                                 'not a known input ' % name)
+            if (not isinstance(column, numbers.Integral) and len(column) and
+                    not isinstance(column[0], numbers.Integral)):
+                for values in column:
+                    if len(values) != self.lanes:
+                        raise PyrtlError('run_lanes needs a value for each of the %d '
+                                         'lanes of each step' % self.lanes)
+                column = list(itertools.chain.from_iterable(column))
+            columns[name] = column
+        for name in self._required_inputs.difference(columns):
+            raise PyrtlError('Input "%s" has no input value specified' % name)
+        if nsteps is None:
+            lengths = {len(c) // (self._inputpos[name][1]*self.lanes)
+                       for name, c in columns.items() if not isinstance(c, numbers.Integral)}
+            if len(lengths) != 1:
+                raise PyrtlError(
+                    'run cannot infer the number of steps, either provide nsteps or '
+                    'sequences for the inputs that are all of the same length')
+            nsteps = lengths.pop()
+
+        slots = nsteps*self.lanes
+        incols = [self._input_column(name, columns[name], slots, validate)
+                  for name in self._input_order]
+        outcols = [array.array(_WORD_TYPECODE, [0])*(slots*self._outputpos[name][1])
+                   for name in self._output_order]
+        words = ctypes.POINTER(ctypes.c_uint64)
+        self._dll.sim_run_lanes(
+            self._ctx, nsteps,
+            (words*(len(incols)+1))(*[ctypes.cast(c, words) for c in incols]),
+            (words*(len(outcols)+1))(*[self._words(c) for c in outcols]))
+        ran = self._assertion_steps(nsteps)
+        outputs = dict(zip(self._output_order, outcols))
+        outputs = {name: outputs[name][:ran*self.lanes*self._outputpos[name][1]]
+                   if ran < nsteps else outputs[name] for name in self._output_names}
+        self._raise_assertion()
+        return outputs
+
+    def _input_column(self, name, column, nsteps, validate):
+        """Get a ctypes array of the limbs of each step's value of an input."""
+        count = self._inputpos[name][1]
+        size = nsteps*count
+        col_type = ctypes.c_uint64*size
+        if isinstance(column, numbers.Integral):
+            column = [column]*nsteps
+        try:
+            view = memoryview(column)
+        except TypeError:
+            view = None
+        if view is not None:
+            words = view.ndim and view.itemsize == 8 and view.format[-1] in 'QL'
+            nbytes = view.nbytes
+        else:
+            # arrays on Python 2 have only the old buffer interface, which ctypes reads
+            words = isinstance(column, array.array) and column.itemsize == 8 and \
+                column.typecode in 'QL'
+            nbytes = len(column)*8
+        if words:
+            if nbytes < size*8:
+                raise PyrtlError('run was given fewer input values than the %d steps '
+                                 'requested' % nsteps)
+            if view is not None and (view.readonly or not view.c_contiguous):
+                buf = col_type.from_buffer_copy(view.tobytes()[:size*8])
+            else:
+                buf = col_type.from_buffer(column)
+            # only the most significant limbs can hold bits beyond the bitwidth
+            too_wide = validate and size and max(buf[count-1::count]) >> (
+                self._inputbw[name] - 64*(count-1))
+        else:
+            values = column[:nsteps]
+            if len(values) < nsteps:
+                raise PyrtlError('run was given fewer input values than the %d steps '
+                                 'requested' % nsteps)
+            if values and min(values) < 0:
+                raise PyrtlError('run provided an input "%s" which is not a valid '
+                                 'positive integer' % min(values))
+            too_wide = validate and values and max(values) >> self._inputbw[name]
+            if count == 1 and not too_wide:
+                buf = col_type(*values)
+            else:
+                buf = col_type()
+                for n, val in enumerate(values):
+                    self._pack(buf, (0, count), n*count, val)
+        if too_wide:
+            raise PyrtlError('the bitwidth for "%s" is %d, but a provided input '
+                             'does not fit' % (name, self._inputbw[name]))
+        return buf
+
+    def _words(self, column):
+        """Get a pointer to the 64-bit words of an array.array('Q') without copying."""
+        return ctypes.cast((ctypes.c_uint64*len(column)).from_buffer(column),
+                           ctypes.POINTER(ctypes.c_uint64))
+
+    def run_until(self, condition, inputs, max_cycles, validate=True):
+        """Run the simulation until the condition holds or max_cycles have passed.
+
+        The loop over cycles and the check of the condition both run in the
+        compiled code.  Inputs that are all held are passed in as a single row
+        rather than one row per cycle.  See Simulation.run_until for details.
+        """
+        self.wait()
+        if self._capture:
+            raise PyrtlError('run_until is not supported with a TriggeredTrace '
+                             'checked in the compiled code')
+        checks = _run_until_checks(condition, self.block)
+        steps = _run_until_steps(inputs, max_cycles)
+        slots, rows = _input_columns(
+            inputs, steps, self._input_table, self._required_inputs, validate)
+        held = all(isinstance(v, numbers.Integral) for v in inputs.values())
+        istride = 0 if held else self._ibufsz
+        ostride = 0 if self.tracer is None else self._obufsz
+        ibuf = (ctypes.c_uint64*(max(istride*steps, self._ibufsz)))()
+        obuf = (ctypes.c_uint64*(max(ostride*steps, self._obufsz)))()
+        for n, row in enumerate(itertools.islice(rows, 1 if held else steps)):
+            for name, val in zip(slots, row):
+                self._pack(ibuf, self._inputpos[name], n*self._ibufsz, val)
+
+        # the state array holds the registers (before the step) then the outputs
+        condpos, condval = [], []
+        for name, val in checks:
+            if name in self._regpos:
+                start, count = self._regpos[name]
+            else:
+                start, count = self._outputpos[name]
+                start += self._regbufsz
+            for pos in range(start, start+count):
+                condpos.append(pos)
+                condval.append(val & ((1 << 64)-1))
+                val >>= 64
+        state = (ctypes.c_uint64*(self._regbufsz+self._obufsz+1))()
+        cycles = self._dll.sim_run_until(
+            self._ctx, steps, ibuf, istride, obuf, ostride, len(condpos),
+            (ctypes.c_uint64*(len(condpos)+1))(*condpos),
+            (ctypes.c_uint64*(len(condval)+1))(*condval), state)
+        self._assertion_steps(cycles)
+
+        if self.tracer is not None:
+            values = {}
+            for name in self.tracer.trace:
+                if name in self._outputpos:
+                    values[name] = self._unpack(
+                        obuf, self._outputpos[name][0], self._outputpos[name][1],
+                        self._obufsz, cycles)
+                else:
+                    start, count = self._inputpos[name]
+                    values[name] = self._unpack(ibuf, start, count, istride, cycles)
+            self.tracer.add_steps_named(values)
+        if not cycles:
+            # the state array is only filled in by a step, so read the last step instead
+            final = {name: self.inspect(name) for name, _ in checks}
+            final.update((name, self.inspect(name)) for name in self._output_names)
+            self._raise_assertion()
+            return cycles, final
+        final = {}
+        for name, _ in checks:
+            if name in self._regpos:
+                start, count = self._regpos[name]
+                final[name] = self._unpack(state, start, count, 0, 1)[0]
+        for name in self._output_names:
+            start, count = self._outputpos[name]
+            final[name] = self._unpack(state, self._regbufsz+start, count, 0, 1)[0]
+        self._raise_assertion()
+        return cycles, final
+
+    def _run_capture(self, steps, ibuf):
+        """Run steps with the trigger checked in the compiled code, tracing only the capture.
+
+        Each captured row holds the inputs followed by the outputs of one step.
+        """
+        rowsz = self._ibufsz + self._obufsz
+        maxrows = steps + self.tracer.pre_trigger
+        cbuf = (ctypes.c_uint64*(maxrows*rowsz))()
+        cycbuf = (ctypes.c_uint64*maxrows)()
+        rows = self._dll.sim_run_capture(self._ctx, steps, ibuf, cbuf, cycbuf)
+        steps = self._assertion_steps(steps)
+
         for name in self.tracer.trace:
-            rname = self._probe_mapping.get(name, name)
-            if rname in self._outputpos:
-                start, count = self._outputpos[rname]
-                buf, sz = obuf, self._obufsz
-            elif rname in self._inputpos:
-                start, count = self._inputpos[rname]
-                buf, sz = ibuf, self._ibufsz
+            if name in self._outputpos:
+                start, count = self._outputpos[name]
+                start += self._ibufsz
             else:
-                raise PyrtlInternalError('Untraceable wire in tracer')
-            res = []
-            for n in range(steps):
-                val = 0
-                # unpack output
-                for pos in reversed(range(start, start+count)):
-                    val <<= 64
-                    val |= buf[pos]
-                res.append(val)
-                start += sz
-            self.tracer.trace[name].extend(res)
-
-    def _traceable(self, wv):
-        """Check if wv is able to be traced
-
-        If it is traceable due to a probe, record that probe in _probe_mapping.
-        """
-        if isinstance(wv, (Input, Output)):
-            return True
-        for net in self.block.logic:
-            if net.op == 'w' and net.args[0].name == wv.name and isinstance(net.dests[0], Output):
-                self._probe_mapping[wv.name] = net.dests[0].name
-                return True
-        return False
+                start, count = self._inputpos[name]
+            self.tracer.trace[name].extend(self._unpack(cbuf, start, count, rowsz, rows))
+        self.tracer.cycles.extend(cycbuf[:rows])
+        self.tracer._cycle += steps
+        self._raise_assertion()
+
+    def _assertion_steps(self, steps):
+        """Return how many of the steps just run by the compiled code were run.
+
+        If an rtl_assert failed, the steps stopped after the one in which it failed,
+        and the failure is recorded in assertion_failure, to be raised (once the steps
+        run are traced) by _raise_assertion.
+        """
+        step = ctypes.c_uint64(0)
+        failed = self._dll.sim_assert_failed(self._ctx, ctypes.byref(step))
+        if not failed:
+            self.assertion_failure = None
+            return steps
+        self.assertion_failure = (self._assertions[failed-1][0], step.value)
+        return step.value + 1
+
+    def _raise_assertion(self):
+        """Raise the exception of the rtl_assert that failed in the last run, if any."""
+        if self.assertion_failure is not None:
+            raise dict(self._assertions)[self.assertion_failure[0]]
+
+    def _pack(self, buf, position, offset, val):
+        """Write val into buf at the (start, count) position of a wire, plus offset."""
+        start, count = position
+        for pos in range(start+offset, start+offset+count):
+            buf[pos] = val & ((1 << 64)-1)
+            val >>= 64
+
+    def _unpack(self, buf, start, count, stride, steps):
+        """Read the values of one wire out of steps rows of buf."""
+        res = []
+        for n in range(steps):
+            val = 0
+            for pos in reversed(range(start, start+count)):
+                val <<= 64
+                val |= buf[pos]
+            res.append(val)
+            start += stride
+        return res
 
     def _remove_untraceable(self):
-        """Remove from the tracer those wires that CompiledSimulation cannot track.
+        """Remove from the tracer those wires that are not in the block.
 
-        Create _probe_mapping for wires only traceable via probes.
+        The traced wires that are not inputs are copied out after the outputs.
         """
-        self._probe_mapping = {}
-        wvs = {wv for wv in self.tracer.wires_to_track if self._traceable(wv)}
+        if self.tracer is None:
+            return
+        wvs = {wv for wv in self.tracer.wires_to_track if wv in self.block.wirevector_set}
         self.tracer.wires_to_track = wvs
         self.tracer._wires = {wv.name: wv for wv in wvs}
         self.tracer.trace.__init__(wvs)
 
     def _create_dll(self):
-        """Create a dynamically-linked library implementing the simulation logic."""
-        self._dir = tempfile.mkdtemp()
-        with open(path.join(self._dir, 'pyrtlsim.c'), 'w') as f:
-            self._create_code(lambda s: f.write(s+'\n'))
+        """Create a dynamically-linked library implementing the simulation logic.
+
+        The library is always loaded from a fresh directory of its own, even when it
+        comes from the cache, which is removed along with the library.
+        """
+        lines = []
+        self._create_code(lines.append)
+        sources = [('pyrtlsim.c', '\n'.join(lines) + '\n')]
+        for n, partition in enumerate(self._partition_sources):
+            sources.append(('pyrtlsim_part{}.c'.format(n), partition))
+        if self.background:
+            self.build_future = _background_builder().submit(self._build_dll, sources)
+        else:
+            self._build_dll(sources)
+
+    def _build_dll(self, sources):
+        """Compile the sources into a library and load it, returning the simulation."""
         if platform.system() == 'Darwin':
             shared = '-dynamiclib'
         else:
             shared = '-shared'
-        subprocess.check_call([
-            'gcc', '-O0', '-march=native', '-std=c99', '-m64',
-            shared, '-fPIC',
-            path.join(self._dir, 'pyrtlsim.c'), '-o', path.join(self._dir, 'pyrtlsim.so'),
-            ], shell=(platform.system() == 'Windows'))
-        self._dll = ctypes.CDLL(path.join(self._dir, 'pyrtlsim.so'))
-        self._crun = self._dll.sim_run_all
-        self._crun.restype = None  # argtypes set on use
+        flags = ['-O{}'.format(self.opt_level), '-march=native', '-std=c99', '-m64', '-fPIC']
+        link_flags = ['-pthread'] if self.threads > 1 else []
+        flags += link_flags
+
+        self._dir = tempfile.mkdtemp()
+        library = path.join(self._dir, 'pyrtlsim.so')
+        cached = None
+        if self.cache_dir is not None:
+            key = self._cache_key([code for _, code in sources] + flags + [shared])
+            cached = path.join(self.cache_dir, key + '.so')
+            if path.exists(cached):
+                shutil.copyfile(cached, library)
+                self._load_dll()
+                return self
+
+        for name, code in sources:
+            with open(path.join(self._dir, name), 'w') as f:
+                f.write(code)
+        if len(sources) == 1:
+            subprocess.check_call(
+                ['gcc'] + flags + [shared, path.join(self._dir, 'pyrtlsim.c'), '-o', library],
+                shell=(platform.system() == 'Windows'))
+        else:
+            objects = self._compile_objects(sources, flags)
+            subprocess.check_call(
+                ['gcc', '-m64', shared] + link_flags + objects + ['-o', library],
+                shell=(platform.system() == 'Windows'))
+        if cached is not None:
+            self._store_in_cache(library, cached)
+        self._load_dll()
+        return self
+
+    def wait(self):
+        """Block until the simulation has been compiled (see background).
+
+        Raises any error that stopped the compilation.  Every other method waits
+        first.  To wait without blocking, build_future is a concurrent.futures.Future
+        resolving to the simulation, which asyncio users can await with
+        asyncio.wrap_future(sim.build_future).
+        """
+        if self.build_future is not None:
+            self.build_future.result()
+
+    def _compile_objects(self, sources, flags):
+        """Compile each source file to an object file, running gcc in parallel.
+
+        The objects of partitions are cached by the hash of their source, so that
+        partitions that are unchanged after an edit to the design are not recompiled.
+        """
+        objects, jobs = [], []
+        for n, (name, code) in enumerate(sources):
+            obj = path.join(self._dir, name[:-len('.c')] + '.o')
+            objects.append(obj)
+            cached = None
+            if n > 0 and self.cache_dir is not None:
+                cached = path.join(self.cache_dir, self._cache_key([code] + flags) + '.o')
+                if path.exists(cached):
+                    shutil.copyfile(cached, obj)
+                    continue
+            jobs.append(([path.join(self._dir, name), '-o', obj], obj, cached))
+
+        def build(job):
+            args, obj, cached = job
+            subprocess.check_call(
+                ['gcc'] + flags + ['-c'] + args, shell=(platform.system() == 'Windows'))
+            if cached is not None:
+                self._store_in_cache(obj, cached)
+
+        pool = ThreadPool(min(len(jobs), cpu_count()) or 1)
+        try:
+            pool.map(build, jobs)
+        finally:
+            pool.close()
+            pool.join()
+        return objects
+
+    def _cache_key(self, parts):
+        """Hash the given code and flags (and the machine) to name a cached file."""
+        return hashlib.sha256(
+            '\n'.join(parts + [platform.machine()]).encode('utf-8')).hexdigest()
+
+    def _store_in_cache(self, library, cached):
+        """Copy a compiled file into the cache, so that it appears there all at once."""
+        if not path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                if not path.isdir(self.cache_dir):
+                    raise
+        fd, partial = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        os.close(fd)
+        shutil.copyfile(library, partial)
+        try:
+            os.rename(partial, cached)
+        except OSError:  # another simulation cached it first (on Windows)
+            os.remove(partial)
+
+    def _load_dll(self):
+        """Load the compiled library from self._dir, and create a context to run in.
+
+        The argument types are set once here, as the library may be called from
+        several threads at once.
+        """
+        self._lib = _CompiledLibrary(self._dir)
+        self._dll = dll = self._lib.dll
+        ctx = ctypes.c_void_p
+        word = ctypes.c_uint64
+        words = ctypes.POINTER(ctypes.c_uint64)
+        signatures = {
+            'sim_new': (ctx, []),
+            'sim_free': (None, [ctx]),
+            'sim_mem': (ctypes.c_void_p, [ctx, word, word]),
+            'sim_wire': (ctypes.c_void_p, [ctx, word, word]),
+            'sim_mem_load': (None, [ctx, word, word, word, words, words]),
+            'sim_mem_clear': (None, [ctx, word, word]),
+            'sim_assert_failed': (word, [ctx, words]),
+            'sim_run_all': (None, [ctx, word, words, words, words]),
+            'sim_run_columns': (None, [ctx, word, ctypes.POINTER(words),
+                                       ctypes.POINTER(words), words]),
+            'sim_run_lanes': (None, [ctx, word, ctypes.POINTER(words),
+                                     ctypes.POINTER(words)]),
+            'sim_save_regs': (None, [ctx, word, words]),
+            'sim_load_regs': (None, [ctx, word, words]),
+            'sim_run_until': (word, [ctx, word, words, word, words, word,
+                                     word, words, words, words]),
+        }
+        if self._sparse_mems:
+            signatures['sim_sparse_entry'] = (words, [ctypes.c_void_p, word, word, word])
+        if self.coverage:
+            signatures['sim_coverage'] = (ctypes.c_void_p, [ctx, word, word])
+            signatures['sim_coverage_clear'] = (None, [ctx, word])
+        if self._capture:
+            signatures['sim_run_capture'] = (word, [ctx, word, words, words, words])
+            signatures['sim_capture'] = (ctypes.c_void_p, [ctx, words])
+        if self.fast_forward:
+            signatures['sim_wake'] = (None, [ctx])
+        if self.threads > 1:
+            signatures['sim_serial'] = (None, [ctx, ctypes.c_int])
+        for name, (restype, argtypes) in signatures.items():
+            func = getattr(dll, name)
+            func.restype = restype
+            func.argtypes = argtypes
+        self._crun = dll.sim_run_all
+        self._ctx = self._new_context()
+
+    def _new_context(self):
+        """Allocate the state of a new simulation in the compiled library.
+
+        Every lane's memories are loaded with their contents in memory_value_map.
+        """
+        ctx = self._dll.sim_new()
+        if not ctx:
+            raise MemoryError('cannot allocate the state of the compiled simulation')
+        self._lib.contexts += 1
+        for mem, contents in self._memmap.items():
+            for lane in range(self.lanes):
+                self._load_mem(ctx, lane, mem, contents)
+        return ctx
+
+    def _load_mem(self, ctx, lane, mem, contents):
+        """Write a dictionary of addresses and values into a memory of a context.
+
+        Addresses beyond the end of the memory are ignored.  The contents may also
+        be an array of the values from address 0 on, laid out as for mem_array.
+        """
+        if not isinstance(contents, collections.Mapping):
+            self._load_mem_array(ctx, lane, mem, contents)
+            return
+        limbs = self._limbs(mem)
+        addrs = [addr for addr in contents if 0 <= addr < 1 << mem.addrwidth]
+        values = (ctypes.c_uint64*(len(addrs)*limbs+1))()
+        for n, addr in enumerate(addrs):
+            self._pack(values, (0, limbs), n*limbs, contents[addr])
+        self._dll.sim_mem_load(ctx, lane, self._mem_index[mem], len(addrs),
+                               (ctypes.c_uint64*(len(addrs)+1))(*addrs), values)
+
+    def _load_mem_array(self, ctx, lane, mem, contents):
+        """Write an array of the values from address 0 on into a memory of a context."""
+        import numpy
+        limbs = self._limbs(mem)
+        contents = numpy.asarray(contents)
+        shape = (limbs,) if limbs > 1 else ()
+        if contents.ndim != 1 + len(shape) or contents.shape[1:] != shape:
+            raise PyrtlError('the array for MemBlock "%s" in memory_value_map must have '
+                             'shape %s' % (mem.name, ('addresses',) + shape))
+        if len(contents) > 1 << mem.addrwidth:
+            raise PyrtlError('the array for MemBlock "%s" in memory_value_map has more '
+                             'entries than the memory' % mem.name)
+        if mem not in self._sparse_mems:
+            self._mem_view(ctx, lane, mem)[:len(contents)] = contents
+            return
+        rows = contents.reshape(len(contents), limbs)
+        addrs = numpy.flatnonzero(rows.any(axis=1)).astype(numpy.uint64)
+        values = numpy.ascontiguousarray(rows[addrs], dtype=numpy.uint64)
+        words = ctypes.POINTER(ctypes.c_uint64)
+        self._dll.sim_mem_load(ctx, lane, self._mem_index[mem], len(addrs),
+                               addrs.ctypes.data_as(words), values.ctypes.data_as(words))
+
+    def _page_bits(self, mem):
+        """The log2 of the number of addresses in each page of a sparse memory."""
+        return min(mem.addrwidth, 10)
 
     def _limbs(self, w):
         """Number of 64-bit words needed to store value of wire."""
@@ -272,8 +1433,16 @@ class CompiledSimulation(object):
         return '{vn}[{n}]'.format(vn=self.varname[arg], n=n) if arg.bitwidth > 64*n else '0'
 
     def _clean_name(self, prefix, obj):
-        """Create a C variable name with the given prefix based on the name of obj."""
-        return '{}{}_{}'.format(prefix, self._uid(), ''.join(c for c in obj.name if c.isalnum()))
+        """Create a C variable name with the given prefix based on the name of obj.
+
+        The name depends only on the name of obj, unless it clashes with one already
+        made, so that unchanged parts of a design get unchanged code.
+        """
+        vn = base = '{}_{}'.format(prefix, ''.join(c for c in obj.name if c.isalnum()))
+        while vn in self._used_names:
+            vn = '{}_{}'.format(base, self._uid())
+        self._used_names.add(vn)
+        return vn
 
     def _uid(self):
         """Get an auto-incrementing number suitable for use as a unique identifier."""
@@ -281,51 +1450,83 @@ class CompiledSimulation(object):
         self._uid_counter += 1
         return x
 
-    def _declare_mem(self, write, mem):
+    def _declare_mem(self, write, mem, members):
+        """Declare a memory: ROMs as constants, other memories as members of sim_state.
+
+        The lines of the sim_state struct are added to members.  Memories start out
+        zeroed, and are loaded with the contents in memory_value_map by _new_context.
+        """
         self.varname[mem] = vn = self._clean_name('m', mem)
         if isinstance(mem, RomBlock):
             # extract data from mem
             romval = [mem._get_read_data(n) for n in range(1 << mem.addrwidth)]
-            write('static const uint{width}_t {name}[][{limbs}] = {{'.format(
-                name=vn, width=self._memwidth(mem), limbs=self._limbs(mem)))
+            write('{static}const uint{width}_t {name}[][{limbs}] = {{'.format(
+                static=self._static, name=vn, width=self._memwidth(mem),
+                limbs=self._limbs(mem)))
             for rv in romval:
                 write(self._makeini(mem, rv)+',')
             write('};')
+        elif mem in self._sparse_mems:
+            # an array of one, so that the name is a pointer to it, as in partitions
+            self.varname[mem] = 's->' + vn
+            members.append('sim_sparse_mem {name}[1];'.format(name=vn))
         else:
-            write('EXPORT')
-            if mem in self._memmap:
-                highest = min(1 << mem.addrwidth, max(self._memmap[mem])+1)
-                memval = [self._memmap[mem].get(n, 0) for n in range(highest)]
-                write('uint{width}_t {name}[{size}][{limbs}] = {{'.format(
-                    name=vn, width=self._memwidth(mem),
-                    size=1 << mem.addrwidth, limbs=self._limbs(mem)))
-                for mv in memval:
-                    write(self._makeini(mem, mv)+',')
-                write('};')
-            else:
-                # initialize to zero by default
-                write('uint{width}_t {name}[{size}][{limbs}] = {{{{0}}}};'.format(
-                    name=vn, width=self._memwidth(mem),
-                    size=1 << mem.addrwidth, limbs=self._limbs(mem)))
+            self.varname[mem] = 's->' + vn
+            members.append('uint{width}_t {name}[{size}][{limbs}];'.format(
+                name=vn, width=self._memwidth(mem),
+                size=1 << mem.addrwidth, limbs=self._limbs(mem)))
+
+    def _declare_wv(self, write, w, members=None, init=None):
+        """Declare a constant, or add any other wire to the members of sim_state.
 
-    def _declare_wv(self, write, w):
+        The lines that set up a register's initial value in the state s are
+        added to init.
+        """
         self.varname[w] = vn = self._clean_name('w', w)
         if isinstance(w, Const):
-            write('const uint64_t {name}[{limbs}] = {val};'.format(
-                limbs=self._limbs(w), name=vn, val=self._makeini(w, w.val)))
+            write('{static}const uint64_t {name}[{limbs}] = {val};'.format(
+                static=self._static, limbs=self._limbs(w), name=vn,
+                val=self._makeini(w, w.val)))
         elif isinstance(w, Register):
-            write('static uint64_t {name}[{limbs}] = {val};'.format(
-                limbs=self._limbs(w), name=vn,
-                val=self._makeini(w, self._regmap.get(w, self.default_value))))
+            self.varname[w] = 's->' + vn
+            members.append('uint64_t {name}[{limbs}];'.format(limbs=self._limbs(w), name=vn))
+            # the value during the last step, kept for inspect
+            members.append('uint64_t {name}_last[{limbs}];'.format(
+                limbs=self._limbs(w), name=vn))
+            val = self._regmap.get(w, self.default_value)
+            for n in range(self._limbs(w)):
+                for suffix in ('', '_last'):
+                    init.append('s->{name}{suffix}[{n}] = {val};'.format(
+                        name=vn, suffix=suffix, n=n, val=hex(val & ((1 << 64)-1))))
+                val >>= 64
         else:
-            write('uint64_t {name}[{limbs}];'.format(limbs=self._limbs(w), name=vn))
+            self.varname[w] = 's->' + vn
+            members.append('uint64_t {name}[{limbs}];'.format(limbs=self._limbs(w), name=vn))
+
+    def _extern_declaration(self, obj):
+        """C declaration of a wire or ROM defined in another source file."""
+        if isinstance(obj, WireVector):
+            return 'extern {const}uint64_t {name}[{limbs}];'.format(
+                const='const ' if isinstance(obj, Const) else '',
+                name=self.varname[obj], limbs=self._limbs(obj))
+        return 'extern {const}uint{width}_t {name}[{size}][{limbs}];'.format(
+            const='const ' if isinstance(obj, RomBlock) else '', width=self._memwidth(obj),
+            name=self.varname[obj], size=1 << obj.addrwidth, limbs=self._limbs(obj))
 
     def _build_memread(self, write, op, param, args, dest):
         mem = param[1]
+        entry = '{mem}[{addr}[0]]'.format(mem=self.varname[mem], addr=self.varname[args[0]])
+        if mem in self._sparse_mems:
+            write('{{ const uint64_t *entry = sim_sparse_read({mem}, {addr}[0], {bits}, '
+                  '{limbs});'.format(mem=self.varname[mem], addr=self.varname[args[0]],
+                                     bits=self._page_bits(mem), limbs=self._limbs(mem)))
+            entry = 'entry'
         for n in range(self._limbs(dest)):
-            write('{dest}[{n}] = {mem}[{addr}[0]][{n}]{mask};'.format(
-                dest=self.varname[dest], n=n, mem=self.varname[mem],
-                addr=self.varname[args[0]], mask=self._makemask(dest, mem.bitwidth, n)))
+            write('{dest}[{n}] = {entry}[{n}]{mask};'.format(
+                dest=self.varname[dest], n=n, entry=entry,
+                mask=self._makemask(dest, mem.bitwidth, n)))
+        if mem in self._sparse_mems:
+            write('}')
 
     def _build_wire(self, write, op, param, args, dest):
         for n in range(self._limbs(dest)):
@@ -470,8 +1671,153 @@ class CompiledSimulation(object):
             write('{dest}[{n}] = {bits};'.format(
                 dest=self.varname[dest], n=n, bits='|'.join(bits)))
 
-    def _create_code(self, write):
+    def _partition(self, nets):
+        """Split the nets, in order, into lists of about partition_size nets.
+
+        A partition ends after a net whose destination name hashes to a multiple of
+        partition_size (or once it grows to four times that), so the split points move
+        only near where a design is edited.
+        """
+        partitions = [[]]
+        for net in nets:
+            partitions[-1].append(net)
+            name = net.dests[0].name.encode('utf-8')
+            if (zlib.crc32(name) % self.partition_size == 0 or
+                    len(partitions[-1]) >= 4*self.partition_size):
+                partitions.append([])
+        return [partition for partition in partitions if partition]
+
+    def _net_cost(self, net):
+        """Estimate the time taken by the code of a net, in about the time of one limb."""
+        limbs = max(self._limbs(w) for w in net.args + tuple(net.dests))
+        if net.op == '*':
+            return 4*limbs*limbs
+        if net.op in 'cs':  # these shift each argument or bit into place
+            return limbs + net.dests[0].bitwidth // 16
+        return limbs
+
+    def _balanced_tasks(self, nets):
+        """Split the nets, in order, into tasks of about equal cost for the threads.
+
+        Going backwards from the nets whose results are only stored or output, each
+        net joins the task of the nets reading it (the one of them run first), or
+        while that is full, the task made to continue it.  So a task follows a cone
+        of logic and depends only on the tasks before it.  Consecutive small tasks are
+        then merged, leaving a few tasks for each thread, so that they can be
+        balanced between the threads.
+        """
+        target = sum(self._net_cost(net) for net in nets) / (4.0*self.threads)
+        tasks, costs, readers, continued = [], [], {}, {}
+        for net in reversed(nets):
+            cost = self._net_cost(net)
+            k = readers.get(net.dests[0])
+            while k in continued and costs[k] + cost > target:
+                k = continued[k]
+            if k is None or costs[k] + cost > target:
+                tasks.append([])
+                costs.append(0)
+                if k is not None:
+                    continued[k] = len(tasks)-1
+                k = len(tasks)-1
+            tasks[k].append(net)
+            costs[k] += cost
+            for w in net.args:
+                readers[w] = max(readers.get(w, k), k)
+        merged, merged_cost = [], 0
+        for k in reversed(range(len(tasks))):
+            if merged and merged_cost + costs[k] <= target:
+                merged[-1].extend(reversed(tasks[k]))
+                merged_cost += costs[k]
+            else:
+                merged.append(list(reversed(tasks[k])))
+                merged_cost = costs[k]
+        return merged
+
+    def _schedule_tasks(self, tasks):
+        """Assign each task to a thread, estimating when each would finish.
+
+        Tasks are taken in order, each going to the thread where it could start
+        first, once the tasks it reads from have finished.  The tasks each task
+        must wait for in other threads are kept in _task_deps.
+        """
+        producer, deps, costs = {}, [], []
+        for k, nets in enumerate(tasks):
+            deps.append({producer[w] for net in nets for w in net.args if w in producer})
+            for net in nets:
+                producer[net.dests[0]] = k
+            costs.append(sum(self._net_cost(net) for net in nets))
+        finish, free = [], [0]*self.threads
+        self._task_thread = []
+        for k, cost in enumerate(costs):
+            ready = max([finish[dep] for dep in deps[k]] or [0])
+            t = min(range(self.threads), key=lambda t: (max(free[t], ready), t))
+            finish.append(max(free[t], ready) + cost)
+            free[t] = finish[-1]
+            self._task_thread.append(t)
+        self._task_deps = [{dep for dep in task_deps if self._task_thread[dep] != t}
+                           for task_deps, t in zip(deps, self._task_thread)]
+        self._task_costs = costs
+        self._thread_finish = free
+
+    def _create_partition(self, nets, op_builders):
+        """Return the name of a function computing nets, and a source file defining it.
+
+        Also returns the objects that the function reaches through the state, whose
+        addresses are passed to it in that order, so that the source file does not
+        depend on the layout of sim_state.
+        """
+        used = set()
+        for net in nets:
+            used.update(net.args)
+            used.update(net.dests)
+            if net.op == 'm':
+                used.add(net.op_param[1])
+        # only constants and ROMs are not reached through the state
+        shared = [obj for obj in used if not self.varname[obj].startswith('s->')]
+        state = sorted((obj for obj in used if self.varname[obj].startswith('s->')),
+                       key=lambda obj: self.varname[obj])
+        varname = self.varname
+        self.varname = dict(varname)
+        for obj in state:
+            self.varname[obj] = varname[obj][len('s->'):]
+        try:
+            body = []
+            for k, obj in enumerate(state):
+                if isinstance(obj, WireVector):
+                    body.append('uint64_t *{} = p[{}];'.format(self.varname[obj], k))
+                elif obj in self._sparse_mems:
+                    body.append('sim_sparse_mem *{} = p[{}];'.format(self.varname[obj], k))
+                else:
+                    body.append('uint{width}_t (*{name})[{limbs}] = p[{k}];'.format(
+                        width=self._memwidth(obj), name=self.varname[obj],
+                        limbs=self._limbs(obj), k=k))
+            body.append('uint64_t tmp, carry, tmphi, tmplo;')  # temporary variables
+            for net in nets:
+                self._build_net(body.append, net, op_builders)
+        finally:
+            self.varname = varname
+        body = '\n'.join(body)
+        func = 'sim_part_' + hashlib.sha256(body.encode('utf-8')).hexdigest()[:16]
+        lines = []
+        self._write_prelude(lines.append)
+        lines.extend(sorted(self._extern_declaration(obj) for obj in shared))
+        lines.append('void {}(void *const p[]) {{'.format(func))
+        lines.append(body)
+        lines.append('}')
+        return func, '\n'.join(lines) + '\n', state
+
+    def _build_net(self, write, net, op_builders):
+        op, param, args, dest = net.op, net.op_param, net.args, net.dests[0]
+        write('// net {op} : {args} -> {dest}'.format(
+            op=op, args=', '.join(self.varname[x] for x in args), dest=self.varname[dest]))
+        op_builders[op](write, op, param, args, dest)
+
+    def _write_prelude(self, write):
         write('#include <stdint.h>')
+        write('#include <stdlib.h>')
+        write('#include <string.h>')
+        if self._sparse_mems:
+            self._write_sparse(write)
 
         # windows dllexport needed to make symbols visible
         if platform.system() == 'Windows':
@@ -481,7 +1827,8 @@ class CompiledSimulation(object):
 
         # multiplication macro
         #  for efficient 64x64 -> 128 bit multiplication without uint128_t
-        #  as -O0 optimization does not handle uint128_t well
+        #  as -O0 optimization does not handle uint128_t well, but at higher
+        #  optimization levels the portable uint128_t version is as fast
         machine_alias = {'amd64': 'x86_64', 'aarch64': 'arm64', 'aarch64_be': 'arm64'}
         machine = platform.machine().lower()
         machine = machine_alias.get(machine, machine)
@@ -492,39 +1839,120 @@ class CompiledSimulation(object):
             'mips64': '"dmultu %2, %3\n\tmflo %0\n\tmfhi %1":'
                       '"=r"(*pl),"=r"(*ph):"r"(t0),"r"(t1)',
         }
-        if machine in mulinstr:
+        if self.opt_level == 0 and machine in mulinstr:
             write('#define mul128(t0, t1, pl, ph) __asm__({})'.format(mulinstr[machine]))
+        else:
+            write('#define mul128(t0, t1, pl, ph) do { '
+                  'unsigned __int128 p128 = (unsigned __int128)(t0) * (t1); '
+                  'pl = (uint64_t)p128; ph = (uint64_t)(p128 >> 64); } while (0)')
+
+    def _write_sparse(self, write):
+        """Write the types and functions of sparse memories.
+
+        The pages of a sparse memory are kept in an open-addressing hash table keyed
+        by the page number plus one (so that 0 marks an empty slot), which is kept
+        at most half full.  Reading an address whose page was never written gives
+        zeros, without allocating it.
+        """
+        limbs = max(self._limbs(mem) for mem in self._sparse_mems)
+        write('typedef struct { uint64_t key; uint64_t *data; } sim_sparse_slot;')
+        write('typedef struct { sim_sparse_slot *slots; uint64_t cap, count; } sim_sparse_mem;')
+        write('static const uint64_t sim_sparse_zero[{}];'.format(limbs))
+        write('static sim_sparse_slot *sim_sparse_find(sim_sparse_slot *slots, uint64_t cap, '
+              'uint64_t key) {')
+        write('uint64_t k = ((key * 0x9E3779B97F4A7C15ULL) >> 32) & (cap-1);')
+        write('while (slots[k].key != 0 && slots[k].key != key) k = (k+1) & (cap-1);')
+        write('return &slots[k];')
+        write('}')
+        write('static const uint64_t *sim_sparse_read(const sim_sparse_mem *m, uint64_t addr, '
+              'uint64_t bits, uint64_t limbs) {')
+        write('if (m->cap == 0) return sim_sparse_zero;')
+        write('sim_sparse_slot *slot = sim_sparse_find(m->slots, m->cap, (addr >> bits)+1);')
+        write('if (slot->key == 0) return sim_sparse_zero;')
+        write('return slot->data + (addr & ((1ULL << bits)-1))*limbs;')
+        write('}')
+        write('static uint64_t *sim_sparse_write(sim_sparse_mem *m, uint64_t addr, '
+              'uint64_t bits, uint64_t limbs) {')
+        write('if (2*(m->count+1) > m->cap) {')
+        write('uint64_t cap = m->cap ? 2*m->cap : 16;')
+        write('sim_sparse_slot *slots = calloc(cap, sizeof(sim_sparse_slot));')
+        write('if (slots == 0) abort();')
+        write('for (uint64_t k = 0; k < m->cap; k++) {')
+        write('if (m->slots[k].key != 0) '
+              '*sim_sparse_find(slots, cap, m->slots[k].key) = m->slots[k];')
+        write('}')
+        write('free(m->slots);')
+        write('m->slots = slots;')
+        write('m->cap = cap;')
+        write('}')
+        write('sim_sparse_slot *slot = sim_sparse_find(m->slots, m->cap, (addr >> bits)+1);')
+        write('if (slot->key == 0) {')
+        write('slot->data = calloc(limbs << bits, sizeof(uint64_t));')
+        write('if (slot->data == 0) abort();')
+        write('slot->key = (addr >> bits)+1;')
+        write('m->count++;')
+        write('}')
+        write('return slot->data + (addr & ((1ULL << bits)-1))*limbs;')
+        write('}')
+        write('static void sim_sparse_clear(sim_sparse_mem *m) {')
+        write('for (uint64_t k = 0; k < m->cap; k++) free(m->slots[k].data);')
+        write('free(m->slots);')
+        write('m->slots = 0;')
+        write('m->cap = m->count = 0;')
+        write('}')
+
+    def _create_code(self, write):
+        # when partitioned (as the tasks run by threads are), the constants shared
+        #  between source files are global
+        threaded = self.threads > 1
+        partitioned = self.partition_size is not None or threaded
+        self._static = '' if partitioned else 'static '
+        self._partition_sources = []
+        self._sparse_mems = {
+            net.op_param[1] for net in self.block.logic_subset('m@')
+            if not isinstance(net.op_param[1], RomBlock) and
+            1 << net.op_param[1].addrwidth > self.sparse_mem_threshold}
+        if threaded:
+            write('#define _POSIX_C_SOURCE 200112L')  # for pthreads and sched_yield
+        self._write_prelude(write)
+        if threaded:
+            write('#include <pthread.h>')
+            write('#include <sched.h>')
+
+        # the wires, registers and memories of each lane are kept in a sim_state
+        #  struct (its members are reached through the pointer s), so that nothing
+        #  the simulation changes is global, and any wire can be inspected
+        members = ['int state_changed;']  # set when a register or memory changes value
+        init = []
+        if threaded:
+            members.append('sim_context *ctx;')  # the context the lane belongs to
+            init.append('s->ctx = ctx;')
 
         # declare memories
         mems = {net.op_param[1] for net in self.block.logic_subset('m@')}
+        mems = sorted(mems, key=lambda m: m.name)
         for key in self._memmap:
             if key not in mems:
                 raise PyrtlError('unrecognized MemBlock in memory_value_map')
             if isinstance(key, RomBlock):
                 raise PyrtlError('RomBlock in memory_value_map')
         for mem in mems:
-            self._declare_mem(write, mem)
+            self._declare_mem(write, mem, members)
+        self._mems = [mem for mem in mems if not isinstance(mem, RomBlock)]
+        self._mem_index = {mem: n for n, mem in enumerate(self._mems)}
 
-        # single step function
-        write('static void sim_run_step(uint64_t inputs[], uint64_t outputs[]) {')
-        write('uint64_t tmp, carry, tmphi, tmplo;')  # temporary variables
+        # declare registers outside of sim_run_step so they can be saved and loaded
+        registers = sorted(self.block.wirevector_subset(Register), key=lambda w: w.name)
+        for w in registers:
+            self._declare_wv(write, w, members, init)
 
-        # declare wire vectors
-        for w in self.block.wirevector_set:
-            self._declare_wv(write, w)
+        wires = sorted(self.block.wirevector_set, key=lambda w: w.name)
+        for w in wires:
+            if not isinstance(w, Register):
+                self._declare_wv(write, w, members)
 
-        # inputs copied in
-        inputs = list(self.block.wirevector_subset(Input))
-        self._inputpos = {}  # for each input wire, start and number of elements in input array
-        self._inputbw = {}  # bitwidth of each input wire
-        ipos = 0
-        for w in inputs:
-            self._inputpos[w.name] = ipos, self._limbs(w)
-            self._inputbw[w.name] = w.bitwidth
-            for n in range(self._limbs(w)):
-                write('{vn}[{n}] = inputs[{pos}];'.format(vn=self.varname[w], n=n, pos=ipos))
-                ipos += 1
-        self._ibufsz = ipos  # total length of input array
+        if self.coverage:
+            self._declare_coverage(wires, members)
 
         # combinational logic
         op_builders = {
@@ -545,28 +1973,88 @@ class CompiledSimulation(object):
             'c': self._build_concat,
             's': self._build_select,
         }
-        for net in self.block:  # topological order
-            if net.op in 'r@':
-                continue  # skip synchronized nets
-            op, param, args, dest = net.op, net.op_param, net.args, net.dests[0]
-            write('// net {op} : {args} -> {dest}'.format(
-                op=op, args=', '.join(self.varname[x] for x in args), dest=self.varname[dest]))
-            op_builders[op](write, op, param, args, dest)
+        # topological order, skipping synchronized nets
+        logic = [net for net in self.block._topological_nets(sort=True)
+                 if net.op not in 'r@']
+        if partitioned:
+            # each lane keeps the addresses of the state used by each partition
+            partition_funcs = []
+            if self.partition_size is not None:
+                partitions = self._partition(logic)
+            else:
+                partitions = self._balanced_tasks(logic)
+            for n, nets in enumerate(partitions):
+                func, source, state = self._create_partition(nets, op_builders)
+                partition_funcs.append((func, 'part{}'.format(n)))
+                self._partition_sources.append(source)
+                members.append('void *part{}[{}];'.format(n, max(len(state), 1)))
+                for k, obj in enumerate(state):
+                    init.append('s->part{}[{}] = {};'.format(n, k, self.varname[obj]))
+            if threaded:
+                self._schedule_tasks(partitions)
+            self._task_funcs = partition_funcs
+        write('typedef struct sim_context sim_context;')
+        write('typedef struct {')
+        for line in members:
+            write(line)
+        write('} sim_state;')
+        if partitioned:
+            for func, _ in partition_funcs:
+                write('void {}(void *const p[]);'.format(func))
+        if threaded:
+            write('static void sim_parallel(sim_state *s);')
+
+        # single step function
+        write('static uint64_t sim_run_step(sim_state *s, uint64_t inputs[], '
+              'uint64_t outputs[]) {')
+        write('uint64_t tmp, carry, tmphi, tmplo;')  # temporary variables
+
+        # inputs copied in
+        inputs = sorted(self.block.wirevector_subset(Input), key=lambda w: w.name)
+        self._inputpos = {}  # for each input wire, start and number of elements in input array
+        self._inputbw = {}  # bitwidth of each input wire
+        ipos = 0
+        for w in inputs:
+            self._inputpos[w.name] = ipos, self._limbs(w)
+            self._inputbw[w.name] = w.bitwidth
+            for n in range(self._limbs(w)):
+                write('{vn}[{n}] = inputs[{pos}];'.format(vn=self.varname[w], n=n, pos=ipos))
+                ipos += 1
+        self._ibufsz = ipos  # total length of input array
+        self._input_table = {w.name: (w.name, w.bitmask) for w in inputs}
+        self._required_inputs = frozenset(self._input_table)
+
+        # combinational logic
+        if threaded:
+            write('sim_parallel(s);')
+        elif partitioned:
+            for func, member in partition_funcs:
+                write('{}(s->{});'.format(func, member))
+        else:
+            for net in logic:
+                self._build_net(write, net, op_builders)
 
         # memory writes
-        for net in self.block.logic_subset('@'):
+        for net in sorted(self.block.logic_subset('@'), key=_net_sort_key):
             mem = net.op_param[1]
             write('if ({enable}[0]) {{'.format(enable=self.varname[net.args[2]]))
+            entry = '{mem}[{addr}[0]]'.format(
+                mem=self.varname[mem], addr=self.varname[net.args[0]])
+            if mem in self._sparse_mems:
+                write('uint64_t *entry = sim_sparse_write({mem}, {addr}[0], {bits}, '
+                      '{limbs});'.format(mem=self.varname[mem], addr=self.varname[net.args[0]],
+                                         bits=self._page_bits(mem), limbs=self._limbs(mem)))
+                entry = 'entry'
             for n in range(self._limbs(mem)):
-                write('{mem}[{addr}[0]][{n}] = {vn}[{n}];'.format(
-                    mem=self.varname[mem],
-                    addr=self.varname[net.args[0]],
-                    vn=self.varname[net.args[1]],
-                    n=n))
+                if self.fast_forward:
+                    write('s->state_changed |= {entry}[{n}] != {vn}[{n}];'.format(
+                        entry=entry, vn=self.varname[net.args[1]], n=n))
+                write('{entry}[{n}] = {vn}[{n}];'.format(
+                    entry=entry, vn=self.varname[net.args[1]], n=n))
             write('}')
 
         # register updates
-        regnets = list(self.block.logic_subset('r'))
+        regnets = sorted(self.block.logic_subset('r'), key=_net_sort_key)
         for x, net in enumerate(regnets):
             rin = net.args[0]
             write('uint64_t regtmp{x}[{limbs}];'.format(x=x, limbs=self._limbs(rin)))
@@ -576,39 +2064,602 @@ class CompiledSimulation(object):
         for x, net in enumerate(regnets):
             rout = net.dests[0]
             for n in range(self._limbs(rout)):
+                write('{vn}_last[{n}] = {vn}[{n}];'.format(vn=self.varname[rout], n=n))
+                if self.fast_forward:
+                    write('s->state_changed |= {vn}[{n}] != regtmp{x}[{n}];'.format(
+                        vn=self.varname[rout], x=x, n=n))
                 write('{vn}[{n}] = regtmp{x}[{n}];'.format(vn=self.varname[rout], x=x, n=n))
 
-        # output copied out
-        outputs = list(self.block.wirevector_subset(Output))
+        # output copied out, followed by the traced wires that are not inputs or outputs
+        outputs = sorted(self.block.wirevector_subset(Output), key=lambda w: w.name)
+        traced = set(self.tracer.trace) if self.tracer is not None else set()
+        traced.difference_update(self._inputpos)
+        outputs += [w for w in wires if w.name in traced and not isinstance(w, Output)]
         self._outputpos = {}  # for each output wire, start and number of elements in output array
         opos = 0
         for w in outputs:
             self._outputpos[w.name] = opos, self._limbs(w)
+            # registers are traced with their value during the step
+            vn = self.varname[w] + ('_last' if isinstance(w, Register) else '')
             for n in range(self._limbs(w)):
-                write('outputs[{pos}] = {vn}[{n}];'.format(pos=opos, vn=self.varname[w], n=n))
+                write('outputs[{pos}] = {vn}[{n}];'.format(pos=opos, vn=vn, n=n))
                 opos += 1
         self._obufsz = opos  # total length of output array
+        if self.coverage:
+            self._write_coverage(write, wires)
+
+        # rtl assertions, all checked at once, returning one more than the index of
+        #  the first that failed
+        self._assertions = sorted(
+            ((w.name, exp) for w, exp in self.block.rtl_assert_dict.items()
+             if w in self.block.wirevector_set), key=lambda a: a[0])
+        if self._assertions:
+            asserts = [self.varname[self.block.wirevector_by_name[name]] + '[0]'
+                       for name, _ in self._assertions]
+            write('if (!({})) {{'.format(' && '.join(asserts)))
+            for k, cond in enumerate(asserts):
+                write('if (!{}) return {};'.format(cond, k+1))
+            write('}')
+        write('return 0;')
         write('}')
 
+        self._build_context(write, init)
+
         # entry point
         write('EXPORT')
-        write('void sim_run_all(uint64_t stepcount, uint64_t inputs[], uint64_t outputs[]) {')
+        write('void sim_run_all(sim_context *ctx, uint64_t stepcount, uint64_t inputs[], '
+              'uint64_t outputs[], uint64_t *skipped) {')
+        write('sim_state *s = &ctx->lanes[0];')
         write('uint64_t input_pos = 0, output_pos = 0;')
         write('for (uint64_t stepnum = 0; stepnum < stepcount; stepnum++) {')
-        write('sim_run_step(inputs+input_pos, outputs+output_pos);')
+        if self.fast_forward:
+            # at a fixed point with the same inputs, the outputs must repeat
+            write('if (ctx->ff_quiescent && memcmp(inputs+input_pos, ctx->ff_in, '
+                  'sizeof(uint64_t)*{i}) == 0) {{'.format(i=self._ibufsz))
+            write('memcpy(outputs+output_pos, ctx->ff_out, '
+                  'sizeof(uint64_t)*{o});'.format(o=self._obufsz))
+            write('(*skipped)++;')
+            write('} else {')
+            write('s->state_changed = 0;')
+            self._write_step(write, 's', 'inputs+input_pos', 'outputs+output_pos')
+            write('ctx->ff_quiescent = !s->state_changed;')
+            write('memcpy(ctx->ff_in, inputs+input_pos, sizeof(uint64_t)*{});'.format(
+                self._ibufsz))
+            write('memcpy(ctx->ff_out, outputs+output_pos, sizeof(uint64_t)*{});'.format(
+                self._obufsz))
+            write('}')
+        else:
+            self._write_step(write, 's', 'inputs+input_pos', 'outputs+output_pos')
         write('input_pos += {};'.format(self._ibufsz))
         write('output_pos += {};'.format(self._obufsz))
         write('}}')
 
-    def __del__(self):
-        """Handle removal of the DLL when the simulator is deleted."""
-        if self._dll is not None:
-            handle = self._dll._handle
-            if platform.system() == 'Windows':
-                _ctypes.FreeLibrary(handle)  # pylint: disable=no-member
+        self._input_order = [w.name for w in inputs]
+        self._output_order = [w.name for w in outputs]
+        self._output_names = [w.name for w in outputs if isinstance(w, Output)]
+        # for each wire, its index in sim_wire and number of limbs
+        self._wire_index = {w.name: (n, self._limbs(w)) for n, w in enumerate(wires)}
+        self._build_run_columns(write)
+        self._build_run_lanes(write)
+
+        if self._capture:
+            self._build_capture(write)
+
+        # register state save and load
+        self._regpos = {}  # for each register, start and number of elements in register array
+        rpos = 0
+        for w in registers:
+            self._regpos[w.name] = rpos, self._limbs(w)
+            rpos += self._limbs(w)
+        self._regbufsz = rpos  # total length of register array
+        for func, copy_fmt in (('sim_save_regs', 'regs[{pos}] = {vn}[{n}];'),
+                               ('sim_load_regs', '{vn}[{n}] = regs[{pos}];')):
+            write('EXPORT')
+            write('void {}(sim_context *ctx, uint64_t lane, uint64_t regs[]) {{'.format(func))
+            write('sim_state *s = &ctx->lanes[lane];')
+            for w in registers:
+                start = self._regpos[w.name][0]
+                for n in range(self._limbs(w)):
+                    write(copy_fmt.format(pos=start+n, vn=self.varname[w], n=n))
+            write('}')
+
+        # run until the state words at condpos all equal condval
+        write('EXPORT')
+        write('uint64_t sim_run_until(sim_context *ctx, uint64_t stepcount, uint64_t inputs[], '
+              'uint64_t input_stride, uint64_t outputs[], uint64_t output_stride, '
+              'uint64_t ncond, uint64_t condpos[], uint64_t condval[], uint64_t state[]) {')
+        write('for (uint64_t stepnum = 0; stepnum < stepcount; stepnum++) {')
+        write('sim_save_regs(ctx, 0, state);')
+        write('uint64_t *out = outputs+stepnum*output_stride;')
+        self._write_step(write, '&ctx->lanes[0]', 'inputs+stepnum*input_stride', 'out')
+        write('memcpy(state+{r}, out, sizeof(uint64_t)*{o});'.format(
+            r=self._regbufsz, o=self._obufsz))
+        write('uint64_t k = 0;')
+        write('while (k < ncond && state[condpos[k]] == condval[k]) k++;')
+        write('if (k == ncond) return stepnum+1;')
+        write('}')
+        write('return stepcount;')
+        write('}')
+
+    def _declare_coverage(self, wires, members):
+        """Add the toggle bitmaps and bucket counters of every wire to sim_state.
+
+        The layout of each wire's coverage is kept in _cov_layout.
+        """
+        self._cov_layout = {}
+        words = buckets = 0
+        bucket_bits = self.coverage_buckets.bit_length()-1 if self.coverage_buckets else 0
+        for w in wires:
+            if isinstance(w, Const):
+                continue
+            count = 1 << min(w.bitwidth, bucket_bits) if bucket_bits else 0
+            self._cov_layout[w.name] = (w.bitwidth, words, self._limbs(w), buckets, count)
+            words += self._limbs(w)
+            buckets += count
+        self._cov_words = max(words, 1)
+        self._cov_used = buckets
+        self._cov_buckets = max(buckets, 1)
+        members.append('uint64_t cov_steps;')
+        # the values in the last step (if there was one), which checkpoint copies
+        members.append('struct {{ uint64_t started, values[{}]; }} cov_last;'.format(
+            self._cov_words))
+        members.append('uint64_t cov_toggled[{}];'.format(self._cov_words))
+        members.append('uint64_t cov_counts[{}];'.format(self._cov_buckets))
+
+    def _write_coverage(self, write, wires):
+        """Write the update of the coverage of every wire at the end of sim_run_step.
+
+        The bits that differ from the last step are or'ed into the toggle bitmaps
+        (except in the first step ever run), and the bucket of each value is counted.
+        """
+        write('uint64_t cov_mask = s->cov_last.started ? ~(uint64_t)0 : 0;')
+        write('s->cov_last.started = 1;')
+        write('s->cov_steps++;')
+        for w in wires:
+            if isinstance(w, Const):
+                continue
+            bitwidth, start, limbs, bucket, count = self._cov_layout[w.name]
+            # registers are covered with their value during the step
+            vn = self.varname[w] + ('_last' if isinstance(w, Register) else '')
+            for n in range(limbs):
+                write('s->cov_toggled[{k}] |= ({vn}[{n}] ^ s->cov_last.values[{k}]) & '
+                      'cov_mask;'.format(k=start+n, vn=vn, n=n))
+                write('s->cov_last.values[{k}] = {vn}[{n}];'.format(k=start+n, vn=vn, n=n))
+            if count:
+                # the top bits of the value, which may straddle two limbs
+                shift = bitwidth - count.bit_length() + 1
+                limb, offset = divmod(shift, 64)
+                index = '({}[{}] >> {})'.format(vn, limb, offset)
+                if offset and limb+1 < limbs:
+                    index = '({} | {}[{}] << {})'.format(index, vn, limb+1, 64-offset)
+                write('s->cov_counts[{}+({}&{})]++;'.format(bucket, index, count-1))
+
+    def _write_step(self, write, state, inputs, outputs):
+        """Write a call of sim_run_step in a loop over stepnum up to stepcount.
+
+        If an rtl_assert fails in the step, it is recorded in the context (along with
+        the step), and the loop ends once the rest of the step is done.
+        With fast_forward, any step taken means the next one must be simulated.
+        """
+        if self.fast_forward:
+            write('ctx->ff_quiescent = 0;')
+        if not self._assertions:
+            write('sim_run_step({}, {}, {});'.format(state, inputs, outputs))
+            return
+        write('uint64_t failed = sim_run_step({}, {}, {});'.format(state, inputs, outputs))
+        write('if (failed && !ctx->assert_failed) {')
+        write('ctx->assert_failed = failed;')
+        write('ctx->assert_step = stepnum;')
+        write('stepcount = stepnum+1;')
+        write('}')
+
+    def _build_run_columns(self, write):
+        """Write sim_run_columns, which runs from and to one array per input and output.
+
+        The array of a wire holds its limbs for each step in turn, so that arrays made
+        outside of PyRTL can be simulated on without being interleaved into rows.
+        """
+        write('EXPORT')
+        write('void sim_run_columns(sim_context *ctx, uint64_t stepcount, uint64_t *incols[], '
+              'uint64_t *outcols[], uint64_t *skipped) {')
+        write('sim_state *s = &ctx->lanes[0];')
+        if self.fast_forward:
+            # the inputs and outputs of the last step simulated are kept in the context
+            write('uint64_t in[{}+1], *out = ctx->ff_out;'.format(self._ibufsz))
+        else:
+            write('uint64_t in[{i}+1], out[{o}+1];'.format(i=self._ibufsz, o=self._obufsz))
+        write('for (uint64_t stepnum = 0; stepnum < stepcount; stepnum++) {')
+        for col, name in enumerate(self._input_order):
+            start, count = self._inputpos[name]
+            for n in range(count):
+                write('in[{pos}] = incols[{col}][stepnum*{count}+{n}];'.format(
+                    pos=start+n, col=col, count=count, n=n))
+        if self.fast_forward:
+            # at a fixed point with the same inputs, out still holds the outputs
+            write('if (ctx->ff_quiescent && memcmp(in, ctx->ff_in, sizeof(uint64_t)*{}) == 0) '
+                  '{{'.format(self._ibufsz))
+            write('(*skipped)++;')
+            write('} else {')
+            write('s->state_changed = 0;')
+            self._write_step(write, 's', 'in', 'out')
+            write('ctx->ff_quiescent = !s->state_changed;')
+            write('memcpy(ctx->ff_in, in, sizeof(uint64_t)*{});'.format(self._ibufsz))
+            write('}')
+        else:
+            self._write_step(write, 's', 'in', 'out')
+        for col, name in enumerate(self._output_order):
+            start, count = self._outputpos[name]
+            for n in range(count):
+                write('outcols[{col}][stepnum*{count}+{n}] = out[{pos}];'.format(
+                    pos=start+n, col=col, count=count, n=n))
+        write('}')
+        write('}')
+
+    def _build_run_lanes(self, write):
+        """Write sim_run_lanes, which steps every lane with its own inputs each cycle.
+
+        The arrays of inputs and outputs are laid out as for sim_run_columns, with
+        the lanes of each step in turn.
+        """
+        write('EXPORT')
+        write('void sim_run_lanes(sim_context *ctx, uint64_t stepcount, uint64_t *incols[], '
+              'uint64_t *outcols[]) {')
+        write('uint64_t in[{i}+1], out[{o}+1];'.format(i=self._ibufsz, o=self._obufsz))
+        write('for (uint64_t stepnum = 0; stepnum < stepcount; stepnum++) {')
+        write('for (uint64_t lane = 0; lane < {}; lane++) {{'.format(self.lanes))
+        write('uint64_t slot = stepnum*{}+lane;'.format(self.lanes))
+        for col, name in enumerate(self._input_order):
+            start, count = self._inputpos[name]
+            for n in range(count):
+                write('in[{pos}] = incols[{col}][slot*{count}+{n}];'.format(
+                    pos=start+n, col=col, count=count, n=n))
+        self._write_step(write, '&ctx->lanes[lane]', 'in', 'out')
+        for col, name in enumerate(self._output_order):
+            start, count = self._outputpos[name]
+            for n in range(count):
+                write('outcols[{col}][slot*{count}+{n}] = out[{pos}];'.format(
+                    pos=start+n, col=col, count=count, n=n))
+        write('}')
+        write('}')
+        write('}')
+
+    def _build_context(self, write, init):
+        """Write the sim_context struct, which holds all the state of one simulation.
+
+        sim_new allocates a context with every lane set to its initial state, so
+        any number of independent simulations can share one loaded library.
+        With threads, the context also holds the threads and what they share.
+        """
+        threads = self.threads
+        if threads > 1:
+            write('typedef struct { sim_context *ctx; uint64_t id; pthread_t thread; } '
+                  'sim_worker_info;')
+        write('struct sim_context {')
+        write('sim_state lanes[{}];'.format(self.lanes))
+        write('uint64_t assert_failed, assert_step;')  # the last failure of an rtl_assert
+        if self.fast_forward:
+            # whether the last step simulated reached a fixed point, and its inputs and outputs
+            write('int ff_quiescent;')
+            write('uint64_t ff_in[{}+1], ff_out[{}+1];'.format(self._ibufsz, self._obufsz))
+        if self._capture:
+            fmt = self._capture_format()
+            write('struct {')  # the state of the capture, copied by checkpoint
+            write('uint64_t ring[{ringsz}][{rowsz}+1];'.format(**fmt))
+            write('uint64_t ring_cycle[{ringsz}];'.format(**fmt))
+            write('uint64_t ring_start, ring_count, post, cycle;')
+            write('} cap;')
+        if threads > 1:
+            write('sim_worker_info workers[{}];'.format(threads))
+            write('uint64_t started;')  # number of threads started, besides the caller
+            write('pthread_mutex_t lock;')
+            write('pthread_cond_t wake;')
+            write('int quit, serial;')
+            write('sim_state *active;')  # the lane being stepped
+            write('uint64_t epoch;')  # number of steps started
+            write('uint64_t done[{}];'.format(len(self._task_thread)))  # epoch of each task
+        write('};')
+        write('EXPORT')
+        write('void sim_free(sim_context *ctx) {')
+        if threads > 1:
+            write('pthread_mutex_lock(&ctx->lock);')
+            write('ctx->quit = 1;')
+            write('pthread_cond_broadcast(&ctx->wake);')
+            write('pthread_mutex_unlock(&ctx->lock);')
+            write('for (uint64_t t = 1; t <= ctx->started; t++) '
+                  'pthread_join(ctx->workers[t].thread, 0);')
+            write('pthread_cond_destroy(&ctx->wake);')
+            write('pthread_mutex_destroy(&ctx->lock);')
+        if self._sparse_mems:
+            write('for (uint64_t lane = 0; lane < {}; lane++) {{'.format(self.lanes))
+            write('sim_state *s = &ctx->lanes[lane];')
+            for mem in sorted(self._sparse_mems, key=lambda m: self.varname[m]):
+                write('sim_sparse_clear({});'.format(self.varname[mem]))
+            write('}')
+        write('free(ctx);')
+        write('}')
+        if threads > 1:
+            self._build_threads(write)
+        write('EXPORT')
+        write('sim_context *sim_new(void) {')
+        write('sim_context *ctx = calloc(1, sizeof(sim_context));')
+        write('if (ctx == 0) return 0;')
+        write('for (uint64_t lane = 0; lane < {}; lane++) {{'.format(self.lanes))
+        write('sim_state *s = &ctx->lanes[lane];')
+        for line in init:
+            write(line)
+        write('}')
+        if threads > 1:
+            write('pthread_mutex_init(&ctx->lock, 0);')
+            write('pthread_cond_init(&ctx->wake, 0);')
+            write('for (uint64_t t = 1; t < {}; t++) {{'.format(threads))
+            write('ctx->workers[t].ctx = ctx;')
+            write('ctx->workers[t].id = t;')
+            write('if (pthread_create(&ctx->workers[t].thread, 0, sim_worker, '
+                  '&ctx->workers[t])) {')
+            write('sim_free(ctx);')
+            write('return 0;')
+            write('}')
+            write('ctx->started = t;')
+            write('}')
+        write('return ctx;')
+        write('}')
+        write('EXPORT')
+        write('void *sim_mem(sim_context *ctx, uint64_t lane, uint64_t index) {')
+        write('sim_state *s = &ctx->lanes[lane];')
+        write('switch (index) {')
+        for mem in self._mems:
+            write('case {}: return {};'.format(self._mem_index[mem], self.varname[mem]))
+        write('}')
+        write('return 0;')
+        write('}')
+        self._build_mem_access(write)
+        if self.coverage:
+            write('EXPORT')
+            write('void *sim_coverage(sim_context *ctx, uint64_t lane, uint64_t which) {')
+            write('sim_state *s = &ctx->lanes[lane];')
+            write('return which == 0 ? (void *)s->cov_toggled : which == 1 ? '
+                  '(void *)s->cov_counts : which == 2 ? (void *)&s->cov_steps : '
+                  '(void *)&s->cov_last;')
+            write('}')
+            write('EXPORT')
+            write('void sim_coverage_clear(sim_context *ctx, uint64_t lane) {')
+            write('sim_state *s = &ctx->lanes[lane];')
+            write('s->cov_steps = 0;')
+            write('memset(s->cov_toggled, 0, sizeof(s->cov_toggled));')
+            write('memset(s->cov_counts, 0, sizeof(s->cov_counts));')
+            write('}')
+        write('EXPORT')
+        write('uint64_t sim_assert_failed(sim_context *ctx, uint64_t *step) {')
+        write('uint64_t failed = ctx->assert_failed;')
+        write('*step = ctx->assert_step;')
+        write('ctx->assert_failed = 0;')
+        write('return failed;')
+        write('}')
+        if self.fast_forward:
+            # the state was changed from Python, so the next step must be simulated
+            write('EXPORT')
+            write('void sim_wake(sim_context *ctx) { ctx->ff_quiescent = 0; }')
+        # the symbol table of wires, by their position in order of name
+        write('EXPORT')
+        write('const void *sim_wire(sim_context *ctx, uint64_t lane, uint64_t index) {')
+        write('sim_state *s = &ctx->lanes[lane];')
+        write('switch (index) {')
+        for n, w in enumerate(sorted(self.block.wirevector_set, key=lambda w: w.name)):
+            vn = self.varname[w] + ('_last' if isinstance(w, Register) else '')
+            write('case {}: return {};'.format(n, vn))
+        write('}')
+        write('return 0;')
+        write('}')
+
+    def _build_mem_access(self, write):
+        """Write the functions loading and clearing memories, called from Python.
+
+        sim_mem_load writes count entries, with the limbs of each value in turn.
+        """
+        write('EXPORT')
+        write('void sim_mem_load(sim_context *ctx, uint64_t lane, uint64_t index, '
+              'uint64_t count, uint64_t addrs[], uint64_t values[]) {')
+        write('sim_state *s = &ctx->lanes[lane];')
+        write('switch (index) {')
+        for mem in self._mems:
+            limbs = self._limbs(mem)
+            write('case {}:'.format(self._mem_index[mem]))
+            write('for (uint64_t k = 0; k < count; k++) {')
+            if mem in self._sparse_mems:
+                write('uint64_t *entry = sim_sparse_write({mem}, addrs[k], {bits}, '
+                      '{limbs});'.format(mem=self.varname[mem], bits=self._page_bits(mem),
+                                         limbs=limbs))
+            else:
+                write('uint{}_t *entry = {}[addrs[k]];'.format(
+                    self._memwidth(mem), self.varname[mem]))
+            write('for (uint64_t n = 0; n < {limbs}; n++) '
+                  'entry[n] = values[k*{limbs}+n];'.format(limbs=limbs))
+            write('}')
+            write('break;')
+        write('}')
+        write('}')
+        write('EXPORT')
+        write('void sim_mem_clear(sim_context *ctx, uint64_t lane, uint64_t index) {')
+        write('sim_state *s = &ctx->lanes[lane];')
+        write('switch (index) {')
+        for mem in self._mems:
+            if mem in self._sparse_mems:
+                write('case {}: sim_sparse_clear({}); break;'.format(
+                    self._mem_index[mem], self.varname[mem]))
+            else:
+                write('case {i}: memset({m}, 0, sizeof({m})); break;'.format(
+                    i=self._mem_index[mem], m=self.varname[mem]))
+        write('}')
+        write('}')
+        if self._sparse_mems:
+            write('EXPORT')
+            write('const uint64_t *sim_sparse_entry(const sim_sparse_mem *m, uint64_t addr, '
+                  'uint64_t bits, uint64_t limbs) {')
+            write('return sim_sparse_read(m, addr, bits, limbs);')
+            write('}')
+
+    def _build_threads(self, write):
+        """Write the code that runs the tasks of each step on the threads of a context.
+
+        Each thread runs its tasks in order, first waiting until the tasks of other
+        threads that it reads from have finished the same step, and sim_parallel, run by
+        the caller as thread 0, returns once every thread has finished its tasks.
+        Threads that find no new step to run for a while sleep until woken.
+        """
+        funcs, threads = self._task_funcs, self.threads
+        write('static void sim_wait_task(sim_context *ctx, uint64_t task, uint64_t epoch) {')
+        write('for (uint64_t spins = 0; __atomic_load_n(&ctx->done[task], __ATOMIC_ACQUIRE) '
+              '!= epoch; spins++) {')
+        write('if (spins >= 64) sched_yield();')
+        write('}')
+        write('}')
+        last = {}
+        for t in range(threads):
+            write('static void sim_thread{}(sim_context *ctx, sim_state *s, '
+                  'uint64_t epoch) {{'.format(t))
+            for k, (func, member) in enumerate(funcs):
+                if self._task_thread[k] != t:
+                    continue
+                waits = {}  # only the latest task waited on in each thread
+                for dep in self._task_deps[k]:
+                    other = self._task_thread[dep]
+                    waits[other] = max(dep, waits.get(other, 0))
+                for dep in sorted(waits.values()):
+                    write('sim_wait_task(ctx, {}, epoch);'.format(dep))
+                write('{}(s->{});'.format(func, member))
+                write('__atomic_store_n(&ctx->done[{}], epoch, __ATOMIC_RELEASE);'.format(k))
+                last[t] = k
+            write('}')
+
+        write('static void *sim_worker(void *arg) {')
+        write('sim_context *ctx = ((sim_worker_info *)arg)->ctx;')
+        write('uint64_t id = ((sim_worker_info *)arg)->id, seen = 0, epoch;')
+        write('for (;;) {')
+        write('for (uint64_t spins = 0; (epoch = __atomic_load_n(&ctx->epoch, '
+              '__ATOMIC_ACQUIRE)) == seen; spins++) {')
+        write('if (spins < 4096) {')
+        write('if (spins >= 64) sched_yield();')
+        write('continue;')
+        write('}')
+        write('pthread_mutex_lock(&ctx->lock);')
+        write('while (ctx->epoch == seen && !ctx->quit) pthread_cond_wait(&ctx->wake, &ctx->lock);')
+        write('int quit = ctx->quit;')
+        write('pthread_mutex_unlock(&ctx->lock);')
+        write('if (quit) return 0;')
+        write('spins = 0;')
+        write('}')
+        write('seen = epoch;')
+        write('switch (id) {')
+        for t in range(1, threads):
+            write('case {t}: sim_thread{t}(ctx, ctx->active, epoch); break;'.format(t=t))
+        write('}')
+        write('}')
+        write('}')
+
+        write('static void sim_parallel(sim_state *s) {')
+        write('sim_context *ctx = s->ctx;')
+        write('if (ctx->serial) {')
+        for func, member in funcs:
+            write('{}(s->{});'.format(func, member))
+        write('return;')
+        write('}')
+        write('pthread_mutex_lock(&ctx->lock);')
+        write('ctx->active = s;')
+        write('uint64_t epoch = ctx->epoch + 1;')
+        write('__atomic_store_n(&ctx->epoch, epoch, __ATOMIC_RELEASE);')
+        write('pthread_cond_broadcast(&ctx->wake);')
+        write('pthread_mutex_unlock(&ctx->lock);')
+        write('sim_thread0(ctx, s, epoch);')
+        for t in range(1, threads):
+            if t in last:
+                write('sim_wait_task(ctx, {}, epoch);'.format(last[t]))
+        write('}')
+        write('EXPORT')
+        write('void sim_serial(sim_context *ctx, int serial) {')
+        write('ctx->serial = serial;')
+        write('}')
+
+    def _capture_format(self):
+        """The sizes and trigger condition used in the code of sim_run_capture."""
+        tracer = self.tracer
+        conds = []
+        for name, value in sorted(tracer.trigger.items()):
+            if name in self._outputpos:
+                start, count = self._outputpos[name]
+                start += self._ibufsz
             else:
-                _ctypes.dlclose(handle)  # pylint: disable=no-member
-            self._dll = None
-        if self._dir is not None:
-            shutil.rmtree(self._dir)
-            self._dir = None
+                start, count = self._inputpos[name]
+            if value >> (64*count):
+                conds.append('0')  # the wire can never hold the value
+            for pos in range(start, start+count):
+                conds.append('row[{}] == 0x{:X}ULL'.format(pos, value & ((1 << 64)-1)))
+                value >>= 64
+        return {
+            'rowsz': self._ibufsz + self._obufsz, 'ringsz': max(tracer.pre_trigger, 1),
+            'pre': tracer.pre_trigger, 'post': tracer.post_trigger,
+            'decimate': tracer.decimate, 'cond': ' && '.join(conds) or '1',
+            'i': self._ibufsz}
+
+    def _build_capture(self, write):
+        """Write sim_run_capture, which keeps only the steps around the tracer's trigger.
+
+        The rolling window of samples before the trigger is kept in a ring buffer,
+        and its state persists between calls in the context, like the rest of the
+        simulation.
+        """
+        fmt = self._capture_format()
+        write('EXPORT')
+        write('uint64_t sim_run_capture(sim_context *ctx, uint64_t stepcount, '
+              'uint64_t inputs[], uint64_t captured[], uint64_t cycles[]) {')
+        write('uint64_t ncaptured = 0, slot;')
+        write('uint64_t row[{rowsz}+1];'.format(**fmt))
+        write('for (uint64_t stepnum = 0; stepnum < stepcount; stepnum++) {')
+        write('memcpy(row, inputs+stepnum*{i}, sizeof(uint64_t)*{i});'.format(**fmt))
+        self._write_step(write, '&ctx->lanes[0]', 'inputs+stepnum*{i}'.format(**fmt),
+                         'row+{i}'.format(**fmt))
+        write('int sampled = ctx->cap.cycle % {decimate} == 0;'.format(**fmt))
+        write('if ({cond}) {{'.format(**fmt))
+        write('if (ctx->cap.post == 0) {')  # commit the window before the trigger
+        write('for (uint64_t k = 0; k < ctx->cap.ring_count; k++) {')
+        write('slot = (ctx->cap.ring_start + k) % {ringsz};'.format(**fmt))
+        write('memcpy(captured+ncaptured*{rowsz}, ctx->cap.ring[slot], '
+              'sizeof(uint64_t)*{rowsz});'.format(**fmt))
+        write('cycles[ncaptured++] = ctx->cap.ring_cycle[slot];')
+        write('}')
+        write('ctx->cap.ring_start = ctx->cap.ring_count = 0;')
+        write('}')
+        write('memcpy(captured+ncaptured*{rowsz}, row, sizeof(uint64_t)*{rowsz});'.format(**fmt))
+        write('cycles[ncaptured++] = ctx->cap.cycle;')
+        write('ctx->cap.post = {post};'.format(**fmt))
+        write('} else if (ctx->cap.post > 0) {')
+        write('if (sampled) {')
+        write('memcpy(captured+ncaptured*{rowsz}, row, sizeof(uint64_t)*{rowsz});'.format(**fmt))
+        write('cycles[ncaptured++] = ctx->cap.cycle;')
+        write('ctx->cap.post--;')
+        write('}')
+        write('}} else if (sampled && {pre} > 0) {{'.format(**fmt))
+        write('slot = (ctx->cap.ring_start + ctx->cap.ring_count) % {ringsz};'.format(**fmt))
+        write('memcpy(ctx->cap.ring[slot], row, sizeof(uint64_t)*{rowsz});'.format(**fmt))
+        write('ctx->cap.ring_cycle[slot] = ctx->cap.cycle;')
+        write('if (ctx->cap.ring_count < {pre}) ctx->cap.ring_count++;'.format(**fmt))
+        write('else ctx->cap.ring_start = (ctx->cap.ring_start + 1) % {ringsz};'.format(**fmt))
+        write('}')
+        write('ctx->cap.cycle++;')
+        write('}')
+        write('return ncaptured;')
+        write('}')
+        write('EXPORT')
+        write('void *sim_capture(sim_context *ctx, uint64_t *size) {')
+        write('*size = sizeof(ctx->cap);')
+        write('return &ctx->cap;')
+        write('}')
+
+    def __del__(self):
+        """Free the simulation's context; the library is removed with its last user."""
+        if self._ctx is not None:
+            self._dll.sim_free(self._ctx)
+            self._lib.contexts -= 1
+            self._ctx = None
+        if self._lib is None and self._dir is not None:  # compiling failed
+            shutil.rmtree(self._dir, ignore_errors=True)
+        self._dll = self._lib = self._dir = None
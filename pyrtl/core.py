@@ -174,6 +174,11 @@ class LogicNet(collections.namedtuple('LogicNet', ['op', 'op_param', 'args', 'de
     __ge__ = _compare_error
 
 
+def _net_sort_key(net):
+    """ A key to order LogicNets by the names of the wires they connect. """
+    return (tuple(w.name for w in net.dests), net.op, tuple(w.name for w in net.args))
+
+
 class Block(object):
     """ Block encapsulates a netlist.
 
@@ -400,22 +405,37 @@ class Block(object):
         logic that do not involve registers
         Also, the order of the nets is not guaranteed to be the the same
         over multiple iterations"""
+        return self._topological_nets(sort=False)
+
+    def _topological_nets(self, sort):
+        """ Iterate over the nets in topographic order (see __iter__).
+
+        With sort, the order of the nets depends only on the names of the wires, so it
+        is the same over multiple iterations (and over runs that build the same block),
+        which lets code generated from it be compared and cached """
         from .wire import Input, Const, Register
+        if sort:
+            def order(items, key=lambda w: w.name):
+                return sorted(items, key=key)
+        else:
+            def order(items, key=None):
+                return items
         src_dict, dest_dict = self.net_connections()
-        to_clear = self.wirevector_subset((Input, Const, Register))
+        to_clear = collections.deque(order(self.wirevector_subset((Input, Const, Register))))
         cleared = set()
         remaining = self.logic.copy()
         try:
             while len(to_clear):
-                wire_to_check = to_clear.pop()
+                wire_to_check = to_clear.popleft()
                 cleared.add(wire_to_check)
                 if wire_to_check in dest_dict:
-                    for gate in dest_dict[wire_to_check]:  # loop over logicnets not yet returned
+                    # loop over logicnets not yet returned
+                    for gate in order(dest_dict[wire_to_check], key=_net_sort_key):
                         if all(arg in cleared for arg in gate.args):  # if all args ready
                             yield gate
                             remaining.remove(gate)
                             if gate.op != 'r':
-                                to_clear.update(gate.dests)
+                                to_clear.extend(order(gate.dests))
         except KeyError as e:
             import six
             six.raise_from(PyrtlError("Cannot Iterate through malformed block"), e)
@@ -0,0 +1,347 @@
+"""Coverage-guided fuzzing of the inputs of a design, run on a CompiledSimulation."""
+
+from __future__ import print_function, unicode_literals
+
+import collections
+import hashlib
+import json
+import multiprocessing
+import numbers
+import os
+import platform
+import random
+import tempfile
+
+from .pyrtlexceptions import PyrtlError
+from .wire import Input
+
+
+__all__ = ['StimulusFuzzer']
+
+# the fuzzer run by the processes of run_parallel, which inherit it when forked
+_worker_fuzzer = None
+
+
+def _fuzz_worker(job):
+    """Run the inherited fuzzer in a process of run_parallel."""
+    seed, iterations, sync_every = job
+    fuzzer = _worker_fuzzer
+    fuzzer._random.seed(seed)
+    fuzzer.run(iterations, sync_every)
+    return fuzzer.coverage, fuzzer.failures
+
+
+class StimulusFuzzer(object):
+    """Search for input sequences that reach new coverage or fail an rtl_assert.
+
+    The fuzzer keeps a corpus of input sequences, each of which reached toggle or
+    value coverage (see CompiledSimulation's coverage) that no sequence before it
+    did.  Each iteration mutates one of them (flipping bits, changing, repeating or
+    dropping steps, or splicing two together) and runs it from the initial state,
+    or else restores the state at the end of a sequence of the corpus and carries
+    on with random steps.  Sequences are simulated at native speed by
+    run_columns, and those that reach new coverage join the corpus.
+
+    A sequence failing an rtl_assert is kept in failures, which maps the name of
+    the assertion's Output to the shortest sequence found that fails it (up to and
+    including the failing step).
+
+    With a corpus_dir, every sequence in the corpus, and the failure of every
+    assertion (in its failures subdirectory), is also saved there as a JSON file,
+    and the sequences already there are loaded to start from.  The directory can be shared by many
+    fuzzers, which pick up each other's sequences as they run, such as the
+    processes of run_parallel.
+    """
+
+    def __init__(self, sim, corpus_dir=None, seed=None, length=32, max_length=1024):
+        """Create a fuzzer of the inputs of a simulation.
+
+        :param sim: a CompiledSimulation with coverage, which is forked so that its
+          state when the fuzzer is made is the initial state of every sequence
+        :param corpus_dir: a directory in which to keep the corpus and failures
+        :param seed: the seed of the random choices of the fuzzer
+        :param length: the greatest number of steps in a random sequence, or added
+          to the end of one
+        :param max_length: the greatest number of steps in any sequence
+        """
+        if not sim.coverage:
+            raise PyrtlError('fuzzing needs a CompiledSimulation with coverage=True')
+        if length < 1 or max_length < length:
+            raise PyrtlError('length must be at least 1 and no more than max_length')
+        self.sim = sim.fork()
+        self.sim.tracer = None  # the fuzzer's runs are not traced
+        self._start = self.sim.checkpoint()
+        self._inputs = collections.OrderedDict(sorted(
+            (w.name, w.bitwidth) for w in sim.block.wirevector_subset(Input)))
+        if not self._inputs:
+            raise PyrtlError('fuzzing needs a design with inputs')
+        self.corpus_dir = corpus_dir
+        self.seed = seed
+        self._random = random.Random(seed)
+        self.length = length
+        self.max_length = max_length
+        self.corpus = []  # pairs of a sequence and the state at its end
+        self.coverage = None
+        self.failures = {}
+        self.iterations = 0
+        self._known = set()  # the files of corpus_dir already loaded or saved
+        if corpus_dir is not None:
+            for sub in (corpus_dir, os.path.join(corpus_dir, 'failures')):
+                if not os.path.isdir(sub):
+                    os.makedirs(sub)
+            self._sync()
+        for _ in range(100):
+            if self.corpus:
+                break
+            self._try(self._random_steps(length))
+        if not self.corpus:
+            raise PyrtlError('every sequence tried fails an rtl_assert in its first step')
+
+    def run(self, iterations, sync_every=100):
+        """Fuzz for the given number of iterations.
+
+        :param iterations: the number of sequences to run
+        :param sync_every: how often (in iterations) to load the sequences that
+          other fuzzers have saved in corpus_dir
+        :return: the failures found so far
+        """
+        for n in range(iterations):
+            if self.corpus_dir is not None and n and n % sync_every == 0:
+                self._sync()
+            if self._random.random() < 0.25:
+                prefix, state = self._random.choice(self.corpus)
+                room = self.max_length - self._steps(prefix)
+                if room > 0:
+                    self._try(self._random_steps(min(self.length, room)), prefix, state)
+                    continue
+            self._try(self._mutate())
+        return self.failures
+
+    def run_parallel(self, iterations, processes=None, sync_every=100):
+        """Fuzz in a pool of processes, sharing the corpus through corpus_dir.
+
+        :param iterations: the number of sequences each process runs
+        :param processes: the number of processes, by default one per CPU
+        :return: the failures found so far, by this fuzzer or any of the processes
+
+        The processes are forked from this one, each with its own copy of the fuzzer
+        and simulation seeded differently, and their coverage and failures are then
+        merged into this fuzzer, which loads their corpus.
+        """
+        global _worker_fuzzer
+        if self.corpus_dir is None:
+            raise PyrtlError('fuzzing in parallel needs a corpus_dir to share')
+        if platform.system() == 'Windows':
+            raise PyrtlError('fuzzing in parallel is not supported on Windows')
+        if self.sim.threads > 1:
+            # forked processes do not inherit the threads of the simulation
+            raise PyrtlError('fuzzing in parallel needs a CompiledSimulation with threads=1')
+        processes = processes or multiprocessing.cpu_count()
+        base = self._random.getrandbits(32)
+        jobs = [(base+n, iterations, sync_every) for n in range(processes)]
+        context = multiprocessing
+        if hasattr(multiprocessing, 'get_context'):
+            context = multiprocessing.get_context('fork')
+        _worker_fuzzer = self
+        pool = context.Pool(processes)
+        try:
+            results = pool.map(_fuzz_worker, jobs)
+        finally:
+            pool.terminate()
+            pool.join()
+            _worker_fuzzer = None
+        for coverage, failures in results:
+            self.coverage = self.coverage.merge(coverage)
+            for name, sequence in failures.items():
+                self._add_failure(name, sequence, save=False)
+        self._sync()
+        return self.failures
+
+    def _steps(self, sequence):
+        """The number of steps in a sequence."""
+        return len(next(iter(sequence.values()))) if sequence else 0
+
+    def _random_value(self, bitwidth):
+        """A random value for an input, favouring the extremes."""
+        choice = self._random.random()
+        if choice < 0.2:
+            return 0
+        if choice < 0.3:
+            return (1 << bitwidth) - 1
+        if choice < 0.4:
+            return 1 << self._random.randrange(bitwidth)
+        return self._random.getrandbits(bitwidth)
+
+    def _random_steps(self, length):
+        """A sequence of between 1 and length steps of random inputs."""
+        nsteps = self._random.randint(1, length)
+        return {name: [self._random_value(bitwidth) for _ in range(nsteps)]
+                for name, bitwidth in self._inputs.items()}
+
+    def _mutate(self):
+        """A sequence made by a few random changes to one (or two) of the corpus."""
+        sequence = {name: list(values) for name, values
+                    in self._random.choice(self.corpus)[0].items()}
+        for _ in range(self._random.randint(1, 4)):
+            nsteps = self._steps(sequence)
+            name = self._random.choice(sorted(self._inputs))
+            step = self._random.randrange(nsteps)
+            action = self._random.randrange(5)
+            if action == 0:  # flip a bit
+                sequence[name][step] ^= 1 << self._random.randrange(self._inputs[name])
+            elif action == 1:  # change a value
+                sequence[name][step] = self._random_value(self._inputs[name])
+            elif action == 2:  # repeat some steps
+                end = self._random.randint(step+1, nsteps)
+                for values in sequence.values():
+                    values[end:end] = values[step:end]
+            elif action == 3 and nsteps > 1:  # drop some steps, but not all of them
+                end = self._random.randint(step+1, min(nsteps, step+nsteps-1))
+                for values in sequence.values():
+                    del values[step:end]
+            elif action == 4:  # splice on the end of another sequence
+                other = self._random.choice(self.corpus)[0]
+                start = self._random.randrange(self._steps(other))
+                for key, values in sequence.items():
+                    values[step:] = other[key][start:]
+        for values in sequence.values():
+            del values[self.max_length:]
+        return sequence
+
+    def _execute(self, sequence, state=None):
+        """Run a sequence from the initial state, or the given one, collecting coverage.
+
+        A failing rtl_assert stops the run without raising its exception.
+
+        :return: the assertion_failure of the simulation
+        """
+        sim = self.sim
+        sim.restore(self._start if state is None else state)
+        sim.clear_coverage()
+        sim._run_columns(sequence, self._steps(sequence), validate=False)
+        return sim.assertion_failure
+
+    def _try(self, sequence, prefix=None, state=None):
+        """Run a sequence, carrying on from the state at the end of prefix if given.
+
+        If it reached new coverage, the whole sequence (after the prefix) joins the
+        corpus, or if it failed an rtl_assert, just the steps before the failure.
+        """
+        self.iterations += 1
+        failed = self._execute(sequence, state)
+        if prefix is not None:
+            sequence = {name: prefix[name] + values for name, values in sequence.items()}
+        if failed is not None:
+            name, step = failed
+            if prefix is not None:
+                step += self._steps(prefix)
+            self._add_failure(name, {key: values[:step+1] for key, values in sequence.items()})
+        coverage = self.sim.get_coverage(0)
+        if not self._covers_more(coverage):
+            return False
+        self.coverage = coverage if self.coverage is None else self.coverage.merge(coverage)
+        if failed is not None:
+            if step == 0:
+                return True
+            sequence = {key: values[:step] for key, values in sequence.items()}
+            self._execute(sequence)
+        self._add(sequence, self.sim.checkpoint())
+        return True
+
+    def _covers_more(self, coverage):
+        """Whether coverage reaches any bit or bucket not covered before."""
+        if self.coverage is None:
+            return True
+        if (coverage.toggled & ~self.coverage.toggled).any():
+            return True
+        return bool(((coverage.counts != 0) & (self.coverage.counts == 0)).any())
+
+    def _add(self, sequence, state):
+        """Add a sequence to the corpus, saving it in corpus_dir."""
+        self.corpus.append((sequence, state))
+        if self.corpus_dir is not None:
+            self._known.add(self._save(self.corpus_dir, {'inputs': sequence}))
+
+    def _add_failure(self, name, sequence, save=True):
+        """Keep a sequence failing an assertion, if it is the shortest found."""
+        if name in self.failures and \
+                self._steps(self.failures[name]) <= self._steps(sequence):
+            return
+        self.failures[name] = sequence
+        if save and self.corpus_dir is not None:
+            # named by the hash of the assertion's name, which may not suit a filename
+            filename = hashlib.sha1(name.encode('utf-8')).hexdigest() + '.json'
+            self._save(os.path.join(self.corpus_dir, 'failures'),
+                       {'assertion': name, 'inputs': sequence}, filename)
+
+    def _save(self, directory, contents, filename=None):
+        """Write a JSON file, by default named by the hash of its contents.
+
+        :return: the name of the file
+        """
+        text = json.dumps(contents, sort_keys=True)
+        if filename is None:
+            filename = hashlib.sha1(text.encode('utf-8')).hexdigest() + '.json'
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        # atomic, for other fuzzers
+        getattr(os, 'replace', os.rename)(tmp, os.path.join(directory, filename))
+        return filename
+
+    def _sync(self):
+        """Load the sequences in corpus_dir that this fuzzer has not seen yet.
+
+        Each one is run to find its coverage and the state at its end, and joins the
+        corpus (and the failures in the directory join the failures).  Files that are
+        not valid sequences of inputs of this design are skipped.
+        """
+        for filename in sorted(os.listdir(self.corpus_dir)):
+            if not filename.endswith('.json') or filename in self._known:
+                continue
+            self._known.add(filename)
+            sequence = self._load(os.path.join(self.corpus_dir, filename))
+            if sequence is None:
+                continue
+            if self._execute(sequence) is not None:
+                continue
+            coverage = self.sim.get_coverage(0)
+            self.coverage = coverage if self.coverage is None else self.coverage.merge(coverage)
+            self.corpus.append((sequence, self.sim.checkpoint()))
+        failures = os.path.join(self.corpus_dir, 'failures')
+        for filename in sorted(os.listdir(failures)):
+            if filename.endswith('.json'):
+                failure = self._load(os.path.join(failures, filename), 'assertion')
+                if failure is not None:
+                    self._add_failure(failure[1], failure[0], save=False)
+
+    def _load(self, path, key=None):
+        """Read the sequence in a JSON file of corpus_dir, or None if it is not valid.
+
+        Every input of the design must have the same number (at least one) of values,
+        each of which fits the input.  With a key, the string under that key in the
+        file is also returned, as a pair with the sequence.
+        """
+        try:
+            with open(path) as f:
+                contents = json.load(f)
+            sequence = contents['inputs']
+            extra = contents[key] if key is not None else None
+        except (IOError, ValueError, KeyError, TypeError):
+            return None
+        if not isinstance(sequence, dict) or set(sequence) != set(self._inputs):
+            return None
+        lengths = set()
+        for name, values in sequence.items():
+            if not isinstance(values, list) or not all(
+                    isinstance(v, numbers.Integral) and not isinstance(v, bool) and
+                    0 <= v < 1 << self._inputs[name] for v in values):
+                return None
+            lengths.add(len(values))
+        if len(lengths) != 1 or not lengths.pop():
+            return None
+        if key is None:
+            return sequence
+        if not isinstance(extra, type(u'')):
+            return None
+        return sequence, extra
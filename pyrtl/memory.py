@@ -308,12 +308,18 @@ class RomBlock(_MemReadBase):
         return super(RomBlock, self).__getitem__(item)
 
     def _get_read_data(self, address):
-        import types
         try:
             if address < 0 or address > 2**self.addrwidth - 1:
                 raise PyrtlError("Invalid address, " + str(address) + " specified")
         except TypeError:
             raise PyrtlError("Address: {} with invalid type specified".format(address))
+        value = self._get_raw_data(address)
+        self._check_read_value(value)
+        return value
+
+    def _get_raw_data(self, address):
+        """ Look up the data for an address, raising PyrtlError if there is none. """
+        import types
         if isinstance(self.data, types.FunctionType):
             try:
                 value = self.data(address)
@@ -336,14 +342,16 @@ class RomBlock(_MemReadBase):
                                      consider using pad_with_zeros=True for defaults""")
             except:
                 raise PyrtlError("invalid type for RomBlock data object")
+        return value
 
+    def _check_read_value(self, value):
+        """ Raise PyrtlError if value is not valid data for this rom. """
         try:
             if value < 0 or value >= 2**self.bitwidth:
                 raise PyrtlError("invalid value for RomBlock data")
         except TypeError:
             raise PyrtlError("Value: {} from rom {} has an invalid type"
                              .format(value, self))
-        return value
 
     def _build_read_port(self, addr):
         if self.build_new_roms and \
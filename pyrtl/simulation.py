@@ -3,10 +3,23 @@
 from __future__ import print_function, unicode_literals
 
 import sys
+import os
 import re
+import mmap
+import array
+import struct
+import tempfile
+import copy
+import heapq
+import itertools
 import numbers
 import collections
 
+try:
+    from collections.abc import MutableMapping
+except ImportError:  # python 2
+    from collections import MutableMapping
+
 from .pyrtlexceptions import PyrtlError, PyrtlInternalError
 from .core import working_block, PostSynthBlock, _PythonSanitizer
 from .wire import Input, Register, Const, Output, WireVector
@@ -52,7 +65,8 @@ class Simulation(object):
 
     def __init__(
             self, tracer=True, register_value_map=None, memory_value_map=None,
-            default_value=0, block=None):
+            default_value=0, block=None, event_driven=False, memory_backends=None,
+            fast_forward=False):
         """ Creates a new circuit simulator
 
         :param tracer: an instance of SimulationTrace used to store execution results.
@@ -70,6 +84,20 @@ class Simulation(object):
           use the value stored in the object (default to 0)
         :param block: the hardware block to be traced (which might be of type PostSynthesisBlock).
           defaults to the working block
+        :param event_driven: if True, each step only re-evaluates the nets downstream of
+          the inputs, registers, and memories whose values actually changed since the last
+          step.  This gives the same results as the default mode but does much less work
+          for designs that are mostly idle.  Changes made to *.value* or to the memory
+          returned by inspect_mem from outside of step are not seen in this mode.
+        :param memory_backends: Defines how the contents of each memory are stored.
+          Format: {Memory: backend}, where backend is called as backend(mem, default_value)
+          to create the store, e.g. DenseMemory, SparseMemory, or
+          functools.partial(MmapMemory, filename='image.bin').  Memories not in the map
+          are stored in a plain dictionary.
+        :param fast_forward: if True, detect when the registers and memories reach a
+          fixed point under unchanged inputs, and from then on skip evaluating the
+          logic (simply repeating the last step of the trace) for as long as the inputs
+          stay the same.  The number of cycles skipped is kept in *.cycles_skipped*.
 
         Warning: Simulation initializes some things when called with __init__,
         so changing items in the block for Simulation will likely break
@@ -88,6 +116,10 @@ class Simulation(object):
         self.memvalue = {}  # map from {memid :{address: value}}
         self.block = block
         self.default_value = default_value
+        self.event_driven = event_driven
+        self.memory_backends = memory_backends
+        self.fast_forward = fast_forward
+        self.cycles_skipped = 0
         if tracer is True:
             tracer = SimulationTrace()
         self.tracer = tracer
@@ -119,10 +151,11 @@ class Simulation(object):
 
         # set memories to their passed values
 
+        backends = _memory_backend_map(self.memory_backends, self.block)
         for mem_net in self.block.logic_subset('m@'):
-            memid = mem_net.op_param[1].id
-            if memid not in self.memvalue:
-                self.memvalue[memid] = {}
+            mem = mem_net.op_param[1]
+            if mem.id not in self.memvalue:
+                self.memvalue[mem.id] = _make_memory_store(mem, backends, default_value)
 
         if memory_value_map is not None:
             for (mem, mem_map) in memory_value_map.items():
@@ -130,7 +163,6 @@ class Simulation(object):
                     raise PyrtlError('error, one or more of the memories in the map is a RomBlock')
                 if isinstance(self.block, PostSynthBlock):
                     mem = self.block.mem_map[mem]  # pylint: disable=maybe-no-member
-                self.memvalue[mem.id] = mem_map
                 max_addr_val, max_bit_val = 2**mem.addrwidth, 2**mem.bitwidth
                 for (addr, val) in mem_map.items():
                     if addr < 0 or addr >= max_addr_val:
@@ -139,20 +171,57 @@ class Simulation(object):
                     if val < 0 or val >= max_bit_val:
                         raise PyrtlError('error, %s at %s in %s outside of bounds' %
                                          (str(val), str(addr), mem.name))
+                if mem in backends:
+                    self.memvalue[mem.id].update(mem_map)
+                else:
+                    self.memvalue[mem.id] = mem_map
 
         # set all other variables to default value
         for w in self.block.wirevector_set:
             if w not in self.value:
                 self.value[w] = default_value
 
+        # map from input name to (slot in self.value, bitmask) for validating inputs
+        inputs = self.block.wirevector_subset(Input)
+        self._input_table = {w.name: (w, w.bitmask) for w in inputs}
+        self._required_inputs = frozenset(self._input_table)
+
         self.ordered_nets = tuple((i for i in self.block))
         self.reg_update_nets = tuple((self.block.logic_subset('r')))
         self.mem_update_nets = tuple((self.block.logic_subset('@')))
 
-    def step(self, provided_inputs):
+        # flatten the combinational logic into a plan of (evaluator, args, dest, mask)
+        # so that step does not need to decode the op of each net every cycle
+        comb_nets = [net for net in self.ordered_nets if net.op not in 'r@']
+        self._rom_tables = {}  # the table of each RomBlock, shared by its read ports
+        self._plan = tuple(
+            (self._make_evaluator(net, default_value), net.args,
+             net.dests[0], net.dests[0].bitmask)
+            for net in comb_nets)
+
+        # fan-out of each wire (and memory) as plan indices, used by the event driven mode
+        plan_index = {net: i for i, net in enumerate(comb_nets)}
+        wire_dst_dict = self.block.net_connections()[1]
+        self._fanout = {
+            w: tuple(sorted(plan_index[net] for net in nets if net in plan_index))
+            for w, nets in wire_dst_dict.items()}
+        self._mem_fanout = collections.defaultdict(list)
+        for net in comb_nets:
+            if net.op == 'm':
+                self._mem_fanout[net.op_param[0]].append(plan_index[net])
+        self._event_sources = tuple(
+            self.block.wirevector_subset((Input, Register)).intersection(self._fanout))
+        self._dirty = None  # plan indices to evaluate next step, None for all of them
+        self._mems_changed = False  # whether the memory writes of a step changed anything
+        self._quiescent = False  # whether the state is a fixed point under the last inputs
+
+    def step(self, provided_inputs, validate=True):
         """ Take the simulation forward one cycle
 
         :param provided_inputs: a dictionary mapping wirevectors to their values for this step
+        :param validate: if False, skip checking provided_inputs against the block's inputs.
+          Only use this for stimulus that is known to be valid, as invalid values will
+          silently produce incorrect results.
 
         All input wires must be in the provided_inputs in order for the simulation
         to accept these values
@@ -161,61 +230,166 @@ class Simulation(object):
         sim.step({'a': 1, 'x': 23}) to simulate a cycle with values 1 and 23
         respectively
         """
-
         # Check that all Input have a corresponding provided_input
-        input_set = self.block.wirevector_subset(Input)
-        supplied_inputs = set()
-        for i in provided_inputs:
-            if isinstance(i, WireVector):
-                name = i.name
-            else:
-                name = i
-            sim_wire = self.block.wirevector_by_name[name]
-            if sim_wire not in input_set:
-                raise PyrtlError(
-                    'step provided a value for input for "%s" which is '
-                    'not a known input ' % name)
-            if not isinstance(provided_inputs[i], numbers.Integral) or provided_inputs[i] < 0:
-                raise PyrtlError(
-                    'step provided an input "%s" which is not a valid '
-                    'positive integer' % provided_inputs[i])
-            if len(bin(provided_inputs[i]))-2 > sim_wire.bitwidth:
-                raise PyrtlError(
-                    'the bitwidth for "%s" is %d, but the provided input '
-                    '%d requires %d bits to represent'
-                    % (name, sim_wire.bitwidth,
-                       provided_inputs[i], len(bin(provided_inputs[i]))-2))
-
-            self.value[sim_wire] = provided_inputs[i]
-            supplied_inputs.add(sim_wire)
-
-        # Check that only inputs are specified, and set the values
-        if input_set != supplied_inputs:
-            for i in input_set.difference(supplied_inputs):
-                raise PyrtlError('Input "%s" has no input value specified' % i.name)
-
-        self.value.update(self.regvalue)  # apply register updates from previous step
-
-        for net in self.ordered_nets:
-            self._execute(net)
-
-        # Do all of the mem operations based off the new values changed in _execute()
-        for net in self.mem_update_nets:
-            self._mem_update(net)
+        if validate:
+            _validate_inputs(provided_inputs, self._input_table, self._required_inputs)
+
+        input_table = self._input_table
+        input_values = [
+            (input_table[i.name if isinstance(i, WireVector) else i][0], v)
+            for i, v in provided_inputs.items()]
+        if self._quiescent and all(self.value[slot] == v for slot, v in input_values):
+            self.cycles_skipped += 1  # nothing can change, so the last step repeats
+        else:
+            self._cycle(input_values)
 
         # at the end of the step, record the values to the trace
         # print self.value # Helpful Debug Print
         if self.tracer is not None:
             self.tracer.add_step(self.value)
 
+        # finally, if any of the rtl_assert assertions are failing then we should
+        # raise the appropriate exceptions
+        check_rtl_assertions(self)
+
+    def run(self, inputs, nsteps=None, validate=True):
+        """ Take the simulation forward many cycles
+
+        :param inputs: either a dictionary mapping each input (or its name) to a sequence
+          of per-cycle values (or to a single value to hold for every cycle), or a list
+          of dictionaries, one per cycle, as would be passed to step
+        :param nsteps: the number of cycles to run; defaults to the length of the sequences
+        :param validate: if False, skip checking the inputs (see step)
+
+        :return: the number of cycles skipped by fast_forward
+
+        Running a batch of columnar stimulus validates each column once and records
+        the trace in bulk, avoiding the per-cycle overhead of calling step.
+
+        Example: if we have inputs named 'a' and 'x', we can call:
+        sim.run({'a': [1, 0, 1], 'x': 23}) to simulate three cycles with 'x' held at 23
+        """
+        skipped_before = self.cycles_skipped
+        if not isinstance(inputs, collections.Mapping):
+            for provided_inputs in itertools.islice(inputs, nsteps):
+                self.step(provided_inputs, validate)
+            return self.cycles_skipped - skipped_before
+
+        slots, rows = _input_columns(
+            inputs, nsteps, self._input_table, self._required_inputs, validate)
+        value = self.value
+        check_assertions = bool(self.block.rtl_assert_dict)
+        if self.tracer is not None:
+            traced = [(name, self.tracer._wires[name], []) for name in self.tracer.trace]
+        else:
+            traced = []
+        last_row = tuple(value[slot] for slot in slots)
+        repeats = 0  # cycles skipped since the last one simulated
+        try:
+            for row in rows:
+                if self._quiescent and row == last_row:
+                    repeats += 1
+                    continue
+                if repeats:
+                    for _, wire, values in traced:
+                        values.extend(itertools.repeat(value[wire], repeats))
+                    self.cycles_skipped += repeats
+                    repeats = 0
+                self._cycle(zip(slots, row))
+                last_row = row
+                for _, wire, values in traced:
+                    values.append(value[wire])
+                if check_assertions:
+                    check_rtl_assertions(self)
+        finally:
+            for _, wire, values in traced:
+                values.extend(itertools.repeat(value[wire], repeats))
+            self.cycles_skipped += repeats
+            if traced:
+                self.tracer.add_steps_named({name: values for name, _, values in traced})
+        return self.cycles_skipped - skipped_before
+
+    def run_until(self, condition, inputs, max_cycles, validate=True):
+        """ Run the simulation until the condition holds or max_cycles have passed
+
+        :param condition: a dictionary mapping Outputs and Registers (or their names)
+          to values; the simulation stops after the first cycle in which every one of
+          them has its value
+        :param inputs: a dictionary mapping each input (or its name) to a sequence of
+          per-cycle values or to a single value to hold for every cycle (as for run)
+        :param max_cycles: the most cycles to run; the simulation also stops when it
+          runs out of input values
+        :param validate: if False, skip checking the inputs (see step)
+        :return: a tuple of the number of cycles run and a dictionary from the name of
+          each Output, and of each wire in the condition, to its value in the last cycle
+
+        This replaces a testbench loop that polls a handshake from Python each cycle.
+        Example: wait up to 100 cycles, holding 'req' high, for 'ready' to go high:
+        cycles, values = sim.run_until({'ready': 1}, {'req': 1}, 100)
+        """
+        checks = [(self.block.wirevector_by_name[name], v)
+                  for name, v in _run_until_checks(condition, self.block)]
+        slots, rows = _input_columns(
+            inputs, _run_until_steps(inputs, max_cycles),
+            self._input_table, self._required_inputs, validate)
+        value = self.value
+        check_assertions = bool(self.block.rtl_assert_dict)
+        if self.tracer is not None:
+            traced = [(name, self.tracer._wires[name], []) for name in self.tracer.trace]
+        else:
+            traced = []
+        cycles = 0
+        try:
+            for row in rows:
+                self._cycle(zip(slots, row))
+                cycles += 1
+                for _, wire, values in traced:
+                    values.append(value[wire])
+                if check_assertions:
+                    check_rtl_assertions(self)
+                if all(value[w] == v for w, v in checks):
+                    break
+        finally:
+            if traced:
+                self.tracer.add_steps_named({name: values for name, _, values in traced})
+        final = {w.name: value[w] for w, _ in checks}
+        final.update((w.name, value[w]) for w in self.block.wirevector_subset(Output))
+        return cycles, final
+
+    def _cycle(self, input_values):
+        """ Simulate a single cycle with the given inputs.
+
+        :param input_values: an iterable of (slot, value) pairs for the inputs of the cycle
+        """
+        value = self.value
+        if self.event_driven:
+            prior_sources = [value[w] for w in self._event_sources]
+
+        for slot, v in input_values:
+            value[slot] = v
+
+        value.update(self.regvalue)  # apply register updates from previous step
+
+        if self.event_driven and self._dirty is not None:
+            self._propagate_events(prior_sources)
+        else:
+            for func, args, dest, mask in self._plan:
+                value[dest] = func(*[value[arg] for arg in args]) & mask
+            self._dirty = []
+
+        # Do all of the mem operations based off the new values computed by the plan
+        self._mems_changed = False
+        for net in self.mem_update_nets:
+            self._mem_update(net)
+
         # Do all of the reg updates based off of the new values
         for net in self.reg_update_nets:
-            argval = self.value[net.args[0]]
+            argval = value[net.args[0]]
             self.regvalue[net.dests[0]] = self._sanitize(argval, net.dests[0])
 
-        # finally, if any of the rtl_assert assertions are failing then we should
-        # raise the appropriate exceptions
-        check_rtl_assertions(self)
+        if self.fast_forward:
+            self._quiescent = not self._mems_changed and all(
+                self.regvalue[r] == value[r] for r in self.regvalue)
 
     def inspect(self, w):
         """ Get the value of a wirevector in the last simulation cycle.
@@ -243,6 +417,54 @@ class Simulation(object):
         """
         return self.memvalue[mem.id]
 
+    def checkpoint(self):
+        """ Capture the current state of the simulation.
+
+        :return: a SimulationCheckpoint holding the register values, memory contents,
+          and trace length, which can later be passed to restore
+        """
+        return SimulationCheckpoint(
+            registers={r.name: self.regvalue.get(r, self.value[r])
+                       for r in self.block.wirevector_subset(Register)},
+            memories={memid: _memory_snapshot(store)
+                      for memid, store in self.memvalue.items()},
+            trace_length=_trace_length(self.tracer),
+            trigger_state=_trigger_state(self.tracer),
+            context=dict(self.value))
+
+    def restore(self, checkpoint):
+        """ Return the simulation to the state captured by checkpoint.
+
+        :param checkpoint: a SimulationCheckpoint from this simulation (or one forked
+          from it), as returned by checkpoint
+
+        Steps traced after the checkpoint was taken are dropped from the trace.
+        """
+        self.value.update(checkpoint.context)
+        for name, val in checkpoint.registers.items():
+            self.regvalue[self.block.wirevector_by_name[name]] = val
+        for memid, contents in checkpoint.memories.items():
+            _memory_restore(self.memvalue[memid], contents)
+        _restore_trace(self.tracer, checkpoint)
+        self._dirty = None  # re-evaluate everything on the next step
+        self._quiescent = False
+
+    def fork(self):
+        """ Return a new Simulation of the same block that starts from the current state.
+
+        The fork has its own copy of the trace and of all register and memory state,
+        so the two simulations can be stepped independently.  Memory backends are used
+        to create the fork's memories again, so a file backed memory with a fixed
+        filename will be shared by both simulations.
+        """
+        sim = Simulation(
+            tracer=_copy_trace(self.tracer), default_value=self.default_value,
+            block=self.block, event_driven=self.event_driven,
+            memory_backends=self.memory_backends, fast_forward=self.fast_forward)
+        sim.restore(self.checkpoint())
+        sim.cycles_skipped = self.cycles_skipped
+        return sim
+
     @staticmethod
     def _sanitize(val, wirevector):
         """Return a modified version of val that would fit in wirevector.
@@ -253,46 +475,54 @@ class Simulation(object):
         """
         return val & wirevector.bitmask
 
-    def _execute(self, net):
-        """Handle the combinational logic update rules for the given net.
+    def _make_evaluator(self, net, default_value):
+        """Return a function computing the (unmasked) result of the given net.
 
-        This function, along with edge_update, defined the semantics
-        of the primitive ops. Function updates self.value accordingly.
+        The returned function takes the values of net.args as positional arguments.
+        This function, along with _mem_update, defines the semantics of the primitive
+        ops.  The result is masked to the width of the dest by the caller.
         """
-        if net.op in 'r@':
-            return  # registers and memory write ports have no logic function
-        elif net.op in self.simple_func:
-            argvals = (self.value[arg] for arg in net.args)
-            result = self.simple_func[net.op](*argvals)
+        if net.op in self.simple_func:
+            return self.simple_func[net.op]
         elif net.op == 'c':
-            result = 0
-            for arg in net.args:
-                result = result << len(arg)
-                result = result | self.value[arg]
+            shifts = tuple(len(arg) for arg in net.args)
+
+            def concat(*argvals):
+                result = 0
+                for shift, val in zip(shifts, argvals):
+                    result = (result << shift) | val
+                return result
+            return concat
         elif net.op == 's':
-            result = 0
-            source = self.value[net.args[0]]
-            for b in net.op_param[::-1]:
-                result = (result << 1) | (0x1 & (source >> b))
+            selected = net.op_param[::-1]
+
+            def select(source):
+                result = 0
+                for b in selected:
+                    result = (result << 1) | (0x1 & (source >> b))
+                return result
+            return select
         elif net.op == 'm':
             # memories act async for reads
             memid = net.op_param[0]
             mem = net.op_param[1]
-            read_addr = self.value[net.args[0]]
             if isinstance(mem, RomBlock):
-                result = mem._get_read_data(read_addr)
-            else:
-                result = self.memvalue[memid].get(read_addr, self.default_value)
+                if mem not in self._rom_tables:
+                    self._rom_tables[mem] = _rom_read_table(mem)
+                return self._rom_tables[mem].__getitem__
+            memvalue = self.memvalue
+
+            def memread(read_addr):
+                return memvalue[memid].get(read_addr, default_value)
+            return memread
         else:
             raise PyrtlInternalError('error, unknown op type')
 
-        self.value[net.dests[0]] = self._sanitize(result, net.dests[0])
-
     def _mem_update(self, net):
         """Handle the mem update for the simulation of the given net (which is a memory).
 
         Combinational logic should have no posedge behavior, but registers and
-        memory should.  This function, used after _execute, defines the
+        memory should.  This function, used after the combinational plan, defines the
         semantics of the primitive ops.  Function updates self.memvalue accordingly
         (using prior_value)
         """
@@ -303,7 +533,360 @@ class Simulation(object):
         write_val = self.value[net.args[1]]
         write_enable = self.value[net.args[2]]
         if write_enable:
-            self.memvalue[memid][write_addr] = write_val
+            mem = self.memvalue[memid]
+            if ((self.event_driven or self.fast_forward) and
+                    mem.get(write_addr, self.default_value) != write_val):
+                self._mems_changed = True
+                if self.event_driven:
+                    self._dirty.extend(self._mem_fanout[memid])
+            mem[write_addr] = write_val
+
+    def _propagate_events(self, prior_sources):
+        """Re-evaluate only the nets affected by the values that changed this step.
+
+        :param prior_sources: the values of self._event_sources before this step
+
+        Plan indices are in topological order, so evaluating them from a heap
+        ensures every net is computed after all of the nets it depends on.
+        """
+        value = self.value
+        plan = self._plan
+        fanout = self._fanout
+        pending = self._dirty
+        self._dirty = []
+        for w, prior in zip(self._event_sources, prior_sources):
+            if value[w] != prior:
+                pending.extend(fanout[w])
+        heapq.heapify(pending)
+
+        last = None
+        while pending:
+            i = heapq.heappop(pending)
+            if i == last:
+                continue  # already evaluated this step
+            last = i
+            func, args, dest, mask = plan[i]
+            result = func(*[value[arg] for arg in args]) & mask
+            if value[dest] != result:
+                value[dest] = result
+                for j in fanout.get(dest, ()):
+                    heapq.heappush(pending, j)
+
+
+def _validate_inputs(provided_inputs, input_table, required_inputs):
+    """ Check the inputs provided to a step against the block's inputs.
+
+    :param provided_inputs: a dictionary mapping WireVectors (or their names) to values
+    :param input_table: a map from input name to (slot, bitmask), built at construction
+    :param required_inputs: the set of names of all inputs of the block
+
+    Raises PyrtlError if an unknown wire is provided, if a value is not a non-negative
+    integer representable in the width of its input, or if an input is missing.
+    """
+    mixed_keys = False
+    for i, v in provided_inputs.items():
+        if isinstance(i, WireVector):
+            name = i.name
+            mixed_keys = True
+        else:
+            name = i
+        try:
+            bitmask = input_table[name][1]
+        except KeyError:
+            raise PyrtlError(
+                'step provided a value for input for "%s" which is '
+                'not a known input ' % name)
+        if not isinstance(v, numbers.Integral) or v < 0:
+            raise PyrtlError(
+                'step provided an input "%s" which is not a valid '
+                'positive integer' % v)
+        if v > bitmask:
+            raise PyrtlError(
+                'the bitwidth for "%s" is %d, but the provided input '
+                '%d requires %d bits to represent'
+                % (name, bitmask.bit_length(), v, v.bit_length()))
+
+    # a name and its WireVector may both be given, so only count when that can't happen
+    if mixed_keys or len(provided_inputs) != len(required_inputs):
+        supplied_inputs = set(getattr(i, 'name', i) for i in provided_inputs)
+        for name in required_inputs.difference(supplied_inputs):
+            raise PyrtlError('Input "%s" has no input value specified' % name)
+
+
+def _input_columns(inputs, nsteps, input_table, required_inputs, validate):
+    """ Turn columnar stimulus into rows of input values, one per cycle.
+
+    :param inputs: a map from each input (or its name) to a sequence of per-cycle
+      values, or to a single value that is held for every cycle
+    :param nsteps: the number of cycles, or None to use the length of the sequences
+    :param input_table: a map from input name to (slot, bitmask), built at construction
+    :param required_inputs: the set of names of all inputs of the block
+    :param validate: if False, skip checking that the values fit their inputs
+    :return: (slots, rows) where rows yields, for each cycle, a tuple of the
+      values for the inputs in slots
+
+    Each column is checked as a whole, rather than value by value, when validating.
+    """
+    names, columns = [], []
+    for i, column in inputs.items():
+        name = i.name if isinstance(i, WireVector) else i
+        if name not in input_table:
+            raise PyrtlError(
+                'run provided a value for input for "%s" which is '
+                'not a known input ' % name)
+        if name in names:
+            raise PyrtlError('run provided input "%s" more than once' % name)
+        names.append(name)
+        columns.append(column)
+    for name in required_inputs.difference(names):
+        raise PyrtlError('Input "%s" has no input value specified' % name)
+
+    lengths = set(len(c) for c in columns if not isinstance(c, numbers.Integral))
+    if nsteps is None:
+        if len(lengths) != 1:
+            raise PyrtlError(
+                'run cannot infer the number of steps, either provide nsteps or '
+                'sequences for the inputs that are all of the same length')
+        nsteps = lengths.pop()
+    elif lengths and min(lengths) < nsteps:
+        raise PyrtlError('run was given fewer input values than the %d steps requested'
+                         % nsteps)
+
+    for n, (name, column) in enumerate(zip(names, columns)):
+        held = isinstance(column, numbers.Integral)
+        if held:
+            column = [column]
+        elif len(column) != nsteps:
+            column = column[:nsteps]
+        bitmask = input_table[name][1]
+        if validate and not (all(isinstance(v, numbers.Integral) for v in column) and
+                             (not column or (min(column) >= 0 and max(column) <= bitmask))):
+            for v in column:
+                if not isinstance(v, numbers.Integral) or v < 0:
+                    raise PyrtlError(
+                        'run provided an input "%s" which is not a valid '
+                        'positive integer' % v)
+                if v > bitmask:
+                    raise PyrtlError(
+                        'the bitwidth for "%s" is %d, but the provided input '
+                        '%d requires %d bits to represent'
+                        % (name, bitmask.bit_length(), v, v.bit_length()))
+        if held:
+            column = itertools.repeat(column[0], nsteps)
+        columns[n] = column
+
+    slots = [input_table[name][0] for name in names]
+    if columns:
+        rows = zip(*columns)
+    else:
+        rows = itertools.repeat((), nsteps)
+    return slots, rows
+
+
+def _run_until_checks(condition, block):
+    """ Return the (name, value) pairs that must all hold for run_until to stop. """
+    checks = []
+    for w, v in condition.items():
+        name = w.name if isinstance(w, WireVector) else w
+        wire = block.wirevector_by_name.get(name)
+        if not isinstance(wire, (Output, Register)):
+            raise PyrtlError('run_until can only wait on the value of an Output or '
+                             'Register, not "%s"' % name)
+        if not 0 <= v <= wire.bitmask:
+            raise PyrtlError('run_until is waiting for "%s" to be %d, which it can '
+                             'never hold' % (name, v))
+        checks.append((name, v))
+    return checks
+
+
+def _run_until_steps(inputs, max_cycles):
+    """ Return the number of cycles run_until can run given its inputs and cap. """
+    if not isinstance(inputs, collections.Mapping):
+        raise PyrtlError('run_until takes its inputs as a dictionary from each input '
+                         'to a sequence of values or a single value to hold')
+    return min([max_cycles] + [len(c) for c in inputs.values()
+                               if not isinstance(c, numbers.Integral)])
+
+
+class SimulationCheckpoint(collections.namedtuple(
+        'SimulationCheckpoint',
+        ['registers', 'memories', 'trace_length', 'trigger_state', 'context'])):
+    """ The saved state of a simulation, as returned by checkpoint.
+
+    * *registers*: a map from register name to its value on the next step
+    * *memories*: a map identifying each memory to a dictionary of its contents (or
+      the raw image of a MmapMemory)
+    * *trace_length*: the number of steps in the trace (None if there is no tracer)
+    * *trigger_state*: the cycle count, rolling window and samples still to take of a
+      TriggeredTrace (None for other tracers)
+    * *context*: simulator specific values needed to restore inspect
+
+    The format of *memories* and *context* depends on the simulator, so a checkpoint
+    should only be restored into the simulation it came from or one forked from it.
+    """
+
+
+def _trace_length(tracer):
+    """ Return the number of steps in tracer, or None if there is nothing traced. """
+    if tracer is None or not len(tracer.trace):
+        return None
+    return len(tracer)
+
+
+def _truncate_trace(tracer, length):
+    """ Drop any steps after the first length steps of tracer. """
+    if tracer is not None and length is not None:
+        tracer._truncate(length)
+
+
+def _trigger_state(tracer):
+    """ Return the state of a TriggeredTrace besides its trace, or None for other tracers. """
+    if isinstance(tracer, TriggeredTrace):
+        return tracer._trigger_state()
+    return None
+
+
+def _restore_trace(tracer, checkpoint):
+    """ Return tracer to where it was when checkpoint was taken. """
+    _truncate_trace(tracer, checkpoint.trace_length)
+    if isinstance(tracer, TriggeredTrace) and checkpoint.trigger_state is not None:
+        tracer._restore_trigger_state(checkpoint.trigger_state)
+
+
+def _copy_trace(tracer):
+    """ Return a copy of tracer that can be extended independently. """
+    if tracer is None:
+        return None
+    return tracer._copy()
+
+
+class SimulationDivergence(collections.namedtuple(
+        'SimulationDivergence', ['cycle', 'values', 'inputs', 'exceptions'])):
+    """ Where two simulations run by lockstep first differed.
+
+    * *cycle*: the number of the first cycle (counting from 0 in the call to lockstep)
+      in which the simulations differ
+    * *values*: a map from the name of each compared wire that differs in that cycle
+      to the pair of its values in the two simulations
+    * *inputs*: a map from the name of each input to its value in that cycle
+    * *exceptions*: the pair of the exceptions raised by each simulation in that
+      cycle (such as by an rtl_assert), or None for one that raised none
+    """
+
+    def __str__(self):
+        lines = ['simulations diverge in cycle %d' % self.cycle]
+        for name in sorted(self.values):
+            lines.append('  %s: %d != %d' % ((name,) + tuple(self.values[name])))
+        for n, exc in enumerate(self.exceptions):
+            if exc is not None:
+                lines.append('  %s simulation raised %r' % (('first', 'second')[n], exc))
+        lines.append('  inputs: ' + ', '.join(
+            '%s=%d' % (name, self.inputs[name]) for name in sorted(self.inputs)))
+        return '\n'.join(lines)
+
+
+def lockstep(sim_a, sim_b, inputs, nsteps=None, wires=None, chunk_size=4096,
+             keep_trace=False):
+    """ Run two simulations of a design side by side and find where they first differ.
+
+    :param sim_a: a Simulation, FastSimulation or CompiledSimulation
+    :param sim_b: another simulation of a block with inputs of the same names, such as
+      one of a different simulator or of the block after optimize or synthesize
+    :param inputs: a dictionary mapping each input (or its name) to a sequence of
+      per-cycle values or to a single value to hold for every cycle (as for run),
+      or a list of dictionaries, one per cycle
+    :param nsteps: the number of cycles to run; defaults to the length of the sequences
+    :param wires: the names of the wires to compare, such as registers; defaults to
+      the Outputs of the block of sim_a (other than those of rtl_asserts, whose
+      failures are compared instead).  Both simulations must trace them.
+    :param chunk_size: the number of cycles each simulation runs at a time
+    :param keep_trace: if False, the cycles run are dropped from both traces once
+      they have been compared, so that long runs take little memory
+    :return: None if the simulations agree in every cycle, or else a
+      SimulationDivergence describing the first cycle in which they differ
+
+    The simulations are each run a chunk at a time with the same inputs, and the
+    values traced in the chunk are then compared wire by wire, each as one list
+    comparison, so checking adds little to the time taken by the slower of them.
+    At the first difference the run stops, leaving both traces ending with the
+    divergent cycle (even without keep_trace), which can then be rendered, though
+    the simulations themselves are left at the end of its chunk.  If both raise
+    the same type of exception in the same cycle, it is raised.
+    """
+    if chunk_size < 1:
+        raise PyrtlError('chunk_size must be at least 1')
+    if not isinstance(inputs, collections.Mapping):
+        inputs = list(inputs)
+        inputs = {w: [step[w] for step in inputs] for w in (inputs[0] if inputs else {})}
+    inputs = {w.name if isinstance(w, WireVector) else w: column
+              for w, column in inputs.items()}
+    if nsteps is None:
+        lengths = set(len(c) for c in inputs.values() if not isinstance(c, numbers.Integral))
+        if len(lengths) != 1:
+            raise PyrtlError(
+                'lockstep cannot infer the number of steps, either provide nsteps or '
+                'sequences for the inputs that are all of the same length')
+        nsteps = lengths.pop()
+    if wires is None:
+        wires = sorted(w.name for w in sim_a.block.wirevector_subset(Output)
+                       if w not in sim_a.block.rtl_assert_dict)
+    wires = [w.name if isinstance(w, WireVector) else w for w in wires]
+    for sim in (sim_a, sim_b):
+        # the number of cycles each chunk runs is told by how much the trace grew
+        if sim.tracer is None or isinstance(sim.tracer, TriggeredTrace):
+            raise PyrtlError('lockstep needs simulations with a SimulationTrace, which '
+                             'records every cycle')
+        for name in wires:
+            if name not in sim.tracer.trace:
+                raise PyrtlError('lockstep compares "%s", which must be traced by both '
+                                 'simulations' % name)
+
+    sims = (sim_a, sim_b)
+    for start in range(0, nsteps, chunk_size):
+        count = min(chunk_size, nsteps - start)
+        chunk = {name: [column]*count if isinstance(column, numbers.Integral)
+                 else column[start:start+count] for name, column in inputs.items()}
+        lengths = [_trace_length(sim.tracer) or 0 for sim in sims]
+        exceptions = [None, None]
+        for n, sim in enumerate(sims):
+            try:
+                sim.run(chunk)
+            except Exception as exc:
+                if len(sim.tracer) == lengths[n]:
+                    raise  # it failed before running, such as on invalid inputs
+                exceptions[n] = exc
+        # the cycles run by each (up to and including any that raised)
+        ran = [len(sim.tracer) - length for sim, length in zip(sims, lengths)]
+        first = None  # the first cycle of the chunk in which the traces differ
+        for name in wires:
+            trace_a, trace_b = sim_a.tracer.trace[name], sim_b.tracer.trace[name]
+            limit = min(ran) if first is None else first
+            a = trace_a[lengths[0]:lengths[0]+limit]
+            b = trace_b[lengths[1]:lengths[1]+limit]
+            if a != b:
+                first = next(k for k, (x, y) in enumerate(zip(a, b)) if x != y)
+        if first is None and exceptions != [None, None]:
+            if ran[0] == ran[1] and None not in exceptions and \
+                    type(exceptions[0]) is type(exceptions[1]):
+                raise exceptions[0]  # both failed alike
+            first = min(ran)-1
+        if first is not None:
+            for sim, length in zip(sims, lengths):
+                _truncate_trace(sim.tracer, length+first+1)
+            return SimulationDivergence(
+                cycle=start+first,
+                values={name: (sim_a.tracer.trace[name][lengths[0]+first],
+                               sim_b.tracer.trace[name][lengths[1]+first])
+                        for name in wires
+                        if sim_a.tracer.trace[name][lengths[0]+first] !=
+                        sim_b.tracer.trace[name][lengths[1]+first]},
+                inputs={name: column[first] for name, column in chunk.items()},
+                exceptions=tuple(exc if r == first+1 else None
+                                 for exc, r in zip(exceptions, ran)))
+        if not keep_trace:
+            for sim, length in zip(sims, lengths):
+                _truncate_trace(sim.tracer, length)
+    return None
 
 
 # ----------------------------------------------------------------
@@ -329,15 +912,21 @@ class FastSimulation(object):
 
     def __init__(
             self, register_value_map=None, memory_value_map=None,
-            default_value=0, tracer=True, block=None, code_file=None):
+            default_value=0, tracer=True, block=None, code_file=None, memory_backends=None):
         """ Instantiates a Fast Simulation instance.
 
         The interface for FastSimulation and Simulation should be almost identical.
-        In addition to the Simualtion arguments, FastSimulation additional takes:
+        In addition to the Simualtion arguments (except event_driven), FastSimulation
+        additional takes:
 
         :param code_file: The file in which to store a copy of the generated
         python code. Defaults to no code being stored.
 
+        The rtl_asserts of the block are checked by the generated code in each cycle.
+        When one fails, the run stops after that cycle and its exception is raised,
+        with assertion_failure set to the name of the assertion's Output and the
+        number of the failing cycle in the call to step, run or run_until.
+
         Look at Simulation.__init__ for descriptions for the other parameters
 
         This builds the Fast Simulation compiled Python code, so all changes
@@ -355,6 +944,7 @@ class FastSimulation(object):
         self.tracer = tracer
         self.sim_func = None
         self.code_file = code_file
+        self.memory_backends = memory_backends
         self.mems = {}
         self.regs = {}
         self.internal_names = _PythonSanitizer('_fastsim_tmp_')
@@ -369,6 +959,11 @@ class FastSimulation(object):
         for wire in self.block.wirevector_set:
             self.internal_names.make_valid_string(wire.name)
 
+        # map from input name to (slot in the sim_func dict, bitmask) for validating inputs
+        inputs = self.block.wirevector_subset(Input)
+        self._input_table = {w.name: (w.name, w.bitmask) for w in inputs}
+        self._required_inputs = frozenset(self._input_table)
+
         # set registers to their values
         reg_set = self.block.wirevector_subset(Register)
         for r in reg_set:
@@ -379,6 +974,11 @@ class FastSimulation(object):
 
         self._initialize_mems(memory_value_map)
 
+        # the rtl_assert outputs, checked as part of the generated code
+        self._assertions = {w.name: exp for w, exp in self.block.rtl_assert_dict.items()
+                            if w in self.block.wirevector_set}
+        self.assertion_failure = None
+
         s = self._compiled()
         if self.code_file is not None:
             with open(self.code_file, 'w') as file:
@@ -388,35 +988,44 @@ class FastSimulation(object):
         logic_creator = compile(s, '<string>', 'exec')
         exec(logic_creator, context)
         self.sim_func = context['sim_func']
+        self._run_until_funcs = {}
 
     def _initialize_mems(self, memory_value_map):
+        backends = _memory_backend_map(self.memory_backends, self.block)
+        self._rams = {self._mem_varname(net.op_param[1]): net.op_param[1]
+                      for net in self.block.logic_subset('m@')
+                      if not isinstance(net.op_param[1], RomBlock)}
         if memory_value_map is not None:
             for (mem, mem_map) in memory_value_map.items():
                 if isinstance(mem, RomBlock):
                     raise PyrtlError('error, one or more of the memories in the map is a RomBlock')
-                self.mems[self._mem_varname(mem)] = mem_map
+                if mem in backends:
+                    store = _make_memory_store(mem, backends, self.default_value)
+                    store.update(mem_map)
+                    self.mems[self._mem_varname(mem)] = store
+                else:
+                    self.mems[self._mem_varname(mem)] = mem_map
 
         for net in self.block.logic_subset('m@'):
             mem = net.op_param[1]
             if self._mem_varname(mem) not in self.mems:
                 if isinstance(mem, RomBlock):
-                    self.mems[self._mem_varname(mem)] = mem
+                    self.mems[self._mem_varname(mem)] = _rom_read_table(mem)
                 else:
-                    self.mems[self._mem_varname(mem)] = {}
+                    self.mems[self._mem_varname(mem)] = _make_memory_store(
+                        mem, backends, self.default_value)
 
-    def step(self, provided_inputs):
+    def step(self, provided_inputs, validate=True):
         """ Run the simulation for a cycle
 
         :param provided_inputs: a dictionary mapping WireVectors (or their names)
           to their values for this step
           eg: {wire: 3, "wire_name": 17}
+        :param validate: if False, skip checking provided_inputs against the block's inputs
+          (see Simulation.step)
         """
-        # validate_inputs
-        for wire, value in provided_inputs.items():
-            wire = self.block.get_wirevector_by_name(wire) if isinstance(wire, str) else wire
-            if value > wire.bitmask or value < 0:
-                raise PyrtlError("Wire {} has value {} which cannot be represented"
-                                 " using its bitwidth".format(wire, value))
+        if validate:
+            _validate_inputs(provided_inputs, self._input_table, self._required_inputs)
 
         # building the simulation data
         ins = {self._to_name(wire): value for wire, value in provided_inputs.items()}
@@ -424,7 +1033,7 @@ class FastSimulation(object):
         ins.update(self.mems)
 
         # propagate through logic
-        self.regs, self.outs, mem_writes = self.sim_func(ins)
+        self.regs, self.outs, mem_writes, failed = self.sim_func(ins)
 
         for mem, addr, value in mem_writes:
             self.mems[mem][addr] = value
@@ -435,8 +1044,119 @@ class FastSimulation(object):
         if self.tracer is not None:
             self.tracer.add_fast_step(self)
 
-        # check the rtl assertions
-        check_rtl_assertions(self)
+        # the rtl assertions were checked by sim_func
+        self._assertion_result(failed, 0)
+
+    def run(self, inputs, nsteps=None, validate=True):
+        """ Run the simulation for many cycles
+
+        :param inputs: either a dictionary mapping each input (or its name) to a sequence
+          of per-cycle values (or to a single value to hold for every cycle), or a list
+          of dictionaries, one per cycle, as would be passed to step
+        :param nsteps: the number of cycles to run; defaults to the length of the sequences
+        :param validate: if False, skip checking the inputs (see Simulation.step)
+
+        See Simulation.run for details.
+        """
+        if not isinstance(inputs, collections.Mapping):
+            for provided_inputs in itertools.islice(inputs, nsteps):
+                self.step(provided_inputs, validate)
+            return
+
+        slots, rows = _input_columns(
+            inputs, nsteps, self._input_table, self._required_inputs, validate)
+        sim_func = self.sim_func
+        mems = self.mems
+        traced = []
+        if self.tracer is not None:
+            for name in self.tracer.trace:
+                # inputs and registers are passed in to sim_func, all else comes out of it
+                passed_in = isinstance(self.block.wirevector_by_name[name], (Input, Register))
+                traced.append((name, passed_in, []))
+
+        ins = dict(mems)
+        ran = 0
+        failed = None
+        try:
+            for row in rows:
+                ran += 1
+                ins.update(zip(slots, row))
+                ins.update(self.regs)
+                self.regs, self.outs, mem_writes, failed = sim_func(ins)
+                for mem, addr, value in mem_writes:
+                    mems[mem][addr] = value
+                for name, passed_in, values in traced:
+                    values.append(ins[name] if passed_in else self.outs[name])
+                if failed is not None:
+                    break
+        finally:
+            if ran:
+                self.context = self.outs.copy()
+                self.context.update(ins)
+            if traced:
+                self.tracer.add_steps_named({name: values for name, _, values in traced})
+        self._assertion_result(failed, ran-1)
+
+    def run_until(self, condition, inputs, max_cycles, validate=True):
+        """ Run the simulation until the condition holds or max_cycles have passed
+
+        :param condition: a dictionary mapping Outputs and Registers (or their names)
+          to values that must all hold for the simulation to stop
+        :param inputs: a dictionary mapping each input (or its name) to a sequence of
+          per-cycle values or to a single value to hold for every cycle
+        :param max_cycles: the most cycles to run
+        :param validate: if False, skip checking the inputs (see Simulation.step)
+        :return: a tuple of the number of cycles run and the final values
+
+        The loop over cycles, including the check of the condition, is part of the
+        generated code (one function is generated per distinct condition).
+        See Simulation.run_until for details.
+        """
+        checks = tuple(sorted(_run_until_checks(condition, self.block)))
+        slots, rows = _input_columns(
+            inputs, _run_until_steps(inputs, max_cycles),
+            self._input_table, self._required_inputs, validate)
+        run_until_func = self._run_until_funcs.get(checks)
+        if run_until_func is None:
+            context = {}
+            exec(compile(self._compiled_run_until(checks), '<string>', 'exec'), context)
+            run_until_func = self._run_until_funcs[checks] = context['run_until_func']
+
+        traced = []
+        if self.tracer is not None:
+            for name in self.tracer.trace:
+                passed_in = isinstance(self.block.wirevector_by_name[name], (Input, Register))
+                traced.append((name, passed_in, []))
+        ins = dict(self.mems)
+        try:
+            cycles, self.regs, self.outs, failed = run_until_func(
+                ins, slots, rows, self.regs, traced)
+        finally:
+            if traced:
+                self.tracer.add_steps_named({name: values for name, _, values in traced})
+        if cycles:
+            self.context = self.outs.copy()
+            self.context.update(ins)
+        self._assertion_result(failed, cycles-1)
+        context = getattr(self, 'context', {})
+        final = {name: context.get(name) for name, _ in checks}
+        final.update((w.name, context.get(w.name))
+                     for w in self.block.wirevector_subset(Output))
+        return cycles, final
+
+    def _assertion_result(self, failed, step):
+        """ Record the rtl_assert that failed (if any) in the given step of a run, and raise
+        its exception.
+
+        assertion_failure is left as the name of the assertion's Output and the number
+        of the step (counting from 0 in each call of step, run or run_until) in which
+        it failed, or None if every assertion held.
+        """
+        if failed is None:
+            self.assertion_failure = None
+        else:
+            self.assertion_failure = (failed, step)
+            raise self._assertions[failed]
 
     def inspect(self, w):
         """ Get the value of a wirevector in the last simulation cycle.
@@ -470,6 +1190,42 @@ class FastSimulation(object):
             raise PyrtlError("ROM blocks are not stored in the simulation object")
         return self.mems[self._mem_varname(mem)]
 
+    def checkpoint(self):
+        """ Capture the current state of the simulation (see Simulation.checkpoint). """
+        return SimulationCheckpoint(
+            registers=dict(self.regs),
+            memories={name: _memory_snapshot(self.mems[name]) for name in self._rams},
+            trace_length=_trace_length(self.tracer),
+            trigger_state=_trigger_state(self.tracer),
+            context=dict(getattr(self, 'context', {})))
+
+    def restore(self, checkpoint):
+        """ Return the simulation to the state captured by checkpoint.
+
+        See Simulation.restore for details.
+        """
+        self.regs = dict(checkpoint.registers)
+        for name, contents in checkpoint.memories.items():
+            _memory_restore(self.mems[name], contents)
+        if checkpoint.context:
+            self.context = dict(checkpoint.context)
+        _restore_trace(self.tracer, checkpoint)
+
+    def fork(self):
+        """ Return a new FastSimulation that starts from the current state.
+
+        The generated code is shared, but the fork has its own copy of the trace and
+        of all register and memory state (see Simulation.fork).
+        """
+        sim = copy.copy(self)
+        sim.tracer = _copy_trace(self.tracer)
+        backends = _memory_backend_map(self.memory_backends, self.block)
+        sim.mems = dict(self.mems)
+        for name, mem in self._rams.items():
+            sim.mems[name] = _make_memory_store(mem, backends, self.default_value)
+        sim.restore(self.checkpoint())
+        return sim
+
     def _to_name(self, name):
         """ Converts Wires to strings, keeps strings as is """
         if isinstance(name, WireVector):
@@ -529,6 +1285,26 @@ class FastSimulation(object):
     outs = {}
     mem_ws = []"""
 
+    _run_until_start = """def run_until_func(d, slots, rows, regs, traced):
+    cycles = 0
+    outs = {}
+    failed = None
+    for row in rows:
+        d.update(zip(slots, row))
+        d.update(regs)
+        regs = {}
+        outs = {}
+        mem_ws = []"""
+
+    _run_until_end = """        for mem, addr, value in mem_ws:
+            d[mem][addr] = value
+        cycles += 1
+        for name, passed_in, values in traced:
+            values.append(d[name] if passed_in else outs[name])
+        if failed is not None or %s:
+            break
+    return cycles, regs, outs, failed"""
+
     def _compiled(self):
         """Return a string of the self.block compiled to a block of
          code that can be execed to get a function to execute"""
@@ -536,7 +1312,26 @@ class FastSimulation(object):
         # Because of fast locals in functions in both CPython and PyPy, getting a
         # function to execute makes the code a few times faster than
         # just executing it in the global exec scope.
-        prog = [self._prog_start]
+        prog = [self._prog_start] + self._compiled_body()
+        prog.append("    return regs, outs, mem_ws, failed")
+        return '\n'.join(prog)
+
+    def _compiled_run_until(self, checks):
+        """Return a string of code defining run_until_func, which loops over the
+        logic of sim_func until the (name, value) pairs in checks all hold"""
+        conds = []
+        for name, v in checks:
+            source = 'd' if isinstance(self.block.wirevector_by_name[name], Register) else 'outs'
+            conds.append('%s[%r] == %d' % (source, name, v))
+        prog = [self._run_until_start]
+        prog.extend('    ' + line for line in self._compiled_body())
+        prog.append(self._run_until_end % (' and '.join(conds) or 'True'))
+        return '\n'.join(prog)
+
+    def _compiled_body(self):
+        """Return the lines of code, indented for the body of sim_func, that compute
+        the outputs, next register values and memory writes of a cycle"""
+        prog = []
 
         simple_func = {  # OPS
             'w': lambda x: x,
@@ -603,7 +1398,7 @@ class FastSimulation(object):
                 read_addr = self._arg_varname(net.args[0])
                 mem = net.op_param[1]
                 if isinstance(net.op_param[1], RomBlock):
-                    expr = 'd["%s"]._get_read_data(%s)' % (self._mem_varname(mem), read_addr)
+                    expr = 'd["%s"][%s]' % (self._mem_varname(mem), read_addr)
                 else:  # memories act async for reads
                     expr = 'd["%s"].get(%s, %s)' % (self._mem_varname(mem),
                                                     read_addr, self.default_value)
@@ -633,8 +1428,301 @@ class FastSimulation(object):
                     v_wire_name = self._varname(wire)
                     prog.append('    outs["%s"] = %s' % (wire_name, v_wire_name))
 
-        prog.append("    return regs, outs, mem_ws")
-        return '\n'.join(prog)
+        # check the rtl assertions all at once, naming the first that failed (if any)
+        asserts = [repr(name) for name in sorted(self._assertions)]
+        if asserts:
+            prog.append('    if %s:' % ' and '.join('outs[%s]' % a for a in asserts))
+            prog.append('        failed = None')
+            prog.append('    else:')
+            prog.append('        failed = [a for a in (%s,) if not outs[a]][0]'
+                        % ', '.join(asserts))
+        else:
+            prog.append('    failed = None')
+        return prog
+
+
+# ----------------------------------------------------------------
+#         ___            __   __
+#   |\/| |__   |\/| /  \ |__) \ /
+#   |  | |___  |  | \__/ |  \  |
+#
+
+
+class SparseMemory(dict):
+    """ Memory contents stored as a dictionary from address to value.
+
+    Only the addresses that have been written take up space, so this is the
+    right choice for memories with huge address spaces that are sparsely used.
+    This is how memories are stored when no backend is specified.
+    """
+
+    def __init__(self, mem, default_value=0):
+        super(SparseMemory, self).__init__()
+
+
+class DenseMemory(MutableMapping):
+    """ Memory contents stored in a flat array with one entry per address.
+
+    Much more compact (and faster to access) than a dictionary for small memories
+    that are mostly used.  Like a dictionary, only the addresses that have been
+    written show up when iterating over the memory.
+    """
+
+    def __init__(self, mem, default_value=0):
+        size = 1 << mem.addrwidth
+        typecode = _array_typecode(mem.bitwidth)
+        if typecode is None:
+            self._data = [default_value] * size
+        else:
+            self._data = array.array(typecode, [default_value]) * size
+        self._written = bytearray(size)
+        self._count = 0
+
+    def get(self, addr, default=None):
+        try:
+            return self._data[addr] if self._written[addr] else default
+        except IndexError:
+            return default
+
+    def __getitem__(self, addr):
+        try:
+            if self._written[addr]:
+                return self._data[addr]
+        except IndexError:
+            pass
+        raise KeyError(addr)
+
+    def __setitem__(self, addr, val):
+        self._data[addr] = val
+        if not self._written[addr]:
+            self._written[addr] = 1
+            self._count += 1
+
+    def __delitem__(self, addr):
+        self[addr]  # raises KeyError if addr was never written
+        self._written[addr] = 0
+        self._count -= 1
+
+    def __iter__(self):
+        return (addr for addr, written in enumerate(self._written) if written)
+
+    def clear(self):
+        self._written = bytearray(len(self._written))
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+
+class MmapMemory(MutableMapping):
+    """ Memory contents stored in a memory mapped file.
+
+    This keeps multi-GB memory images out of the Python heap, with the operating
+    system paging in only the parts that are used.  Every address has storage in the
+    file, so an address that was never written reads as whatever the file holds
+    (default_value, for a new file or the part added to extend one), and only the
+    addresses holding something other than default_value show up when iterating
+    over the memory.  Iterating, like len(), reads every address, so it takes time
+    in proportion to the whole address space rather than to the addresses used.
+
+    :param filename: the file holding the image, in little-endian order with each entry
+      using 1, 2, 4, or 8 bytes (a multiple of 8 bytes for entries over 64 bits wide).
+      The file is extended if it is too short, and its existing contents are kept
+      as the initial contents of the memory.  If None, a temporary file is used and
+      removed by close(), or when the memory is garbage collected.
+    """
+
+    def __init__(self, mem, default_value=0, filename=None):
+        if mem.bitwidth > 64:
+            self._limbs = (mem.bitwidth + 63) // 64
+            self._struct = struct.Struct('<%dQ' % self._limbs)
+        else:
+            self._limbs = 1
+            self._struct = struct.Struct('<' + {8: 'B', 16: 'H', 32: 'I', 64: 'Q'}[
+                next(w for w in (8, 16, 32, 64) if mem.bitwidth <= w)])
+        self._itemsize = self._struct.size
+        self._size = 1 << mem.addrwidth
+        self._default = default_value
+        nbytes = self._itemsize * self._size
+
+        self._temporary = filename is None
+        if self._temporary:
+            fd, filename = tempfile.mkstemp(suffix='.mem')
+            os.close(fd)
+        self.filename = filename
+        self._mmap = None
+        self._file = open(filename, 'r+b' if os.path.exists(filename) else 'w+b')
+        self._file.seek(0, os.SEEK_END)
+        existing = self._file.tell()
+        if existing < nbytes:
+            self._file.truncate(nbytes)
+        self._mmap = mmap.mmap(self._file.fileno(), nbytes)
+        if default_value and existing < nbytes:
+            self._fill(-(-existing // self._itemsize))
+
+    def get(self, addr, default=None):
+        if not 0 <= addr < self._size:
+            return default
+        limbs = self._struct.unpack_from(self._mmap, addr * self._itemsize)
+        if self._limbs == 1:
+            return limbs[0]
+        val = 0
+        for limb in reversed(limbs):
+            val = (val << 64) | limb
+        return val
+
+    def __getitem__(self, addr):
+        val = self.get(addr, None)
+        if val is None:
+            raise KeyError(addr)
+        return val
+
+    def __setitem__(self, addr, val):
+        if not 0 <= addr < self._size:
+            raise PyrtlError('error, address %s outside of bounds' % str(addr))
+        self._struct.pack_into(self._mmap, addr * self._itemsize, *self._split(val))
+
+    def _split(self, val):
+        limbs = []
+        for n in range(self._limbs):
+            limbs.append(val & 0xFFFFFFFFFFFFFFFF)
+            val >>= 64
+        return limbs
+
+    def _fill(self, start=0):
+        """ Write default_value to every address from start on. """
+        entry = self._struct.pack(*self._split(self._default))
+        chunk = entry * max(1, (1 << 20) // self._itemsize)
+        for pos in range(start * self._itemsize, len(self._mmap), len(chunk)):
+            end = min(pos + len(chunk), len(self._mmap))
+            self._mmap[pos:end] = chunk[:end - pos]
+
+    def __delitem__(self, addr):
+        self[addr] = self._default
+
+    def __iter__(self):
+        return (addr for addr in range(self._size) if self.get(addr) != self._default)
+
+    def clear(self):
+        self._fill()
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def _image(self):
+        """ Return a copy of the whole file's contents, without scanning each address. """
+        return self._mmap[:]
+
+    def _load_image(self, image):
+        """ Replace the whole file's contents with an image returned by _image. """
+        self._mmap[:] = image
+
+    def flush(self):
+        """ Write any changes back to the file. """
+        self._mmap.flush()
+
+    def close(self):
+        """ Unmap and close the file (removing it if it was a temporary file). """
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+            self._mmap = None
+            if self._temporary:
+                os.remove(self.filename)
+
+    def __del__(self):
+        if getattr(self, '_mmap', None) is not None:
+            self.close()
+
+
+def _memory_snapshot(store):
+    """ Return a copy of the contents of a memory store, to be put back by _memory_restore.
+
+    A memory mapped store is copied as its raw image, which is much faster than
+    visiting each of its addresses.
+    """
+    if isinstance(store, MmapMemory):
+        return store._image()
+    return dict(store)
+
+
+def _memory_restore(store, contents):
+    """ Replace the contents of a memory store with a copy from _memory_snapshot. """
+    if isinstance(store, MmapMemory):
+        store._load_image(contents)
+    else:
+        store.clear()
+        store.update(contents)
+
+
+class _RomReadTable(dict):
+    """ The contents of a RomBlock, computing any address not yet in the table on demand. """
+
+    def __init__(self, rom):
+        super(_RomReadTable, self).__init__()
+        self.rom = rom
+
+    def __missing__(self, addr):
+        value = self[addr] = self.rom._get_read_data(addr)
+        return value
+
+
+_ROM_TABLE_EAGER_ADDRWIDTH = 16  # roms up to this size are flattened when simulation starts
+
+
+def _rom_read_table(rom):
+    """ Return a table of the contents of rom that can be indexed by address.
+
+    Small roms are read in full right away, so that any invalid data is reported
+    before simulation starts and reads are a plain tuple lookup.  Addresses with no
+    data at all (past the end of romdata without pad_with_zeros) only raise an
+    error if they are actually read.  Larger roms are filled in as they are read.
+    """
+    table = _RomReadTable(rom)
+    if rom.addrwidth > _ROM_TABLE_EAGER_ADDRWIDTH:
+        return table
+    for addr in range(1 << rom.addrwidth):
+        try:
+            value = rom._get_raw_data(addr)
+        except PyrtlError:
+            continue  # left to raise when read
+        rom._check_read_value(value)
+        table[addr] = value
+    if len(table) == 1 << rom.addrwidth:
+        return tuple(table[addr] for addr in range(len(table)))
+    return table
+
+
+def _array_typecode(bitwidth):
+    """ Return the smallest array typecode holding bitwidth bits, or None if none can. """
+    for typecode in 'BHILQ':
+        try:
+            if array.array(typecode).itemsize * 8 >= bitwidth:
+                return typecode
+        except ValueError:
+            pass  # 'Q' is not available on all Pythons
+    return None
+
+
+def _memory_backend_map(memory_backends, block):
+    """ Return memory_backends with its keys mapped to the memories of the block. """
+    if memory_backends is None:
+        return {}
+    backends = {}
+    for mem, backend in memory_backends.items():
+        if isinstance(mem, RomBlock):
+            raise PyrtlError('error, one or more of the memories in the backend map is a RomBlock')
+        if isinstance(block, PostSynthBlock):
+            mem = block.mem_map[mem]  # pylint: disable=maybe-no-member
+        backends[mem] = backend
+    return backends
+
+
+def _make_memory_store(mem, backends, default_value):
+    """ Create the store holding the contents of mem during simulation. """
+    if mem in backends:
+        return backends[mem](mem, default_value)
+    return {}
 
 
 # ----------------------------------------------------------------
@@ -751,9 +1839,8 @@ class TraceStorage(collections.Mapping):
                 DeprecationWarning)
             key = key.name
         if key not in self.__data:
-            raise PyrtlError('cannot find "%s" in trace -- if using CompiledSim you make be '
-                             'attempting to access internal states but only inputs/output are '
-                             'available.' % key)
+            raise PyrtlError('cannot find "%s" in trace -- it may not be among the '
+                             'wires being tracked' % key)
         return self.__data[key]
 
 
@@ -810,11 +1897,28 @@ class SimulationTrace(object):
             if wire in self.trace:
                 self.trace[wire].append(value_map[wire])
 
+    def add_steps_named(self, value_lists):
+        """ Add many steps at once from a map of wire names to lists of values. """
+        for wire in value_lists:
+            if wire in self.trace:
+                self.trace[wire].extend(value_lists[wire])
+
     def add_fast_step(self, fastsim):
         """ Add the fastsim context to the trace. """
         for wire_name in self.trace:
             self.trace[wire_name].append(fastsim.context[wire_name])
 
+    def _truncate(self, length):
+        for values in self.trace.values():
+            del values[length:]
+
+    def _copy(self):
+        new_tracer = copy.copy(self)
+        new_tracer.trace = TraceStorage(self.wires_to_track)
+        for name, values in self.trace.items():
+            new_tracer.trace[name].extend(values)
+        return new_tracer
+
     def print_trace(self, file=sys.stdout, base=10, compact=False):
         """
         Prints a list of wires and their current values.
@@ -991,3 +2095,125 @@ class SimulationTrace(object):
             print(formatted_trace_line(w, self.trace[w]), file=file)
         if extra_line:
             print(file=file)
+
+
+class TriggeredTrace(SimulationTrace):
+    """ A SimulationTrace that only keeps the steps around a trigger, like a logic analyzer.
+
+    Rather than recording every step, a rolling window of the last pre_trigger
+    samples is kept, and only when the trigger fires are that window, the triggering
+    step and the following post_trigger samples added to the trace.  A trigger that
+    fires again before those samples are taken extends the capture.  With decimate
+    set to N only every Nth step is sampled, although a step where the trigger fires
+    is always kept.  Because the captured steps need not be consecutive, the cycle
+    number of each step in the trace is kept in the list *cycles*.
+    """
+
+    def __init__(self, trigger, pre_trigger=0, post_trigger=0, decimate=1,
+                 wires_to_track=None, block=None):
+        """
+        Creates a new Triggered Simulation Trace
+
+        :param trigger: either a dictionary mapping wires (or their names) to values,
+          which fires on steps where every one of those wires has its value, or a
+          function that is passed a dictionary from each traced wire name to its
+          value and returns True on steps where it should fire.  The wires the
+          trigger looks at must be tracked.
+        :param pre_trigger: the number of samples before each trigger to keep
+        :param post_trigger: the number of samples after each trigger to keep
+        :param decimate: sample only every Nth step
+        :param wires_to_track: The wires that the tracer should track
+        :param block:
+        """
+        super(TriggeredTrace, self).__init__(wires_to_track, block)
+        if isinstance(trigger, collections.Mapping):
+            trigger = {getattr(w, 'name', w): v for w, v in trigger.items()}
+        elif not callable(trigger):
+            raise PyrtlError('trigger must be a dictionary of wire values or a function')
+        if pre_trigger < 0 or post_trigger < 0:
+            raise PyrtlError('pre_trigger and post_trigger must not be negative')
+        if decimate < 1:
+            raise PyrtlError('decimate must be at least 1')
+        self.trigger = trigger
+        self.pre_trigger = pre_trigger
+        self.post_trigger = post_trigger
+        self.decimate = decimate
+        self.cycles = []
+        self._cycle = 0
+        self._window = collections.deque(maxlen=pre_trigger)
+        self._post_remaining = 0
+
+    def add_step(self, value_map):
+        """ Add the values in value_map to the capture. """
+        names = list(self.trace)
+        self._capture(names, [[value_map[self._wires[name]] for name in names]])
+
+    def add_step_named(self, value_map):
+        names = list(self.trace)
+        self._capture(names, [[value_map[name] for name in names]])
+
+    def add_steps_named(self, value_lists):
+        """ Add many steps at once from a map of wire names to lists of values. """
+        names = list(self.trace)
+        self._capture(names, zip(*[value_lists[name] for name in names]))
+
+    def add_fast_step(self, fastsim):
+        """ Add the fastsim context to the capture. """
+        names = list(self.trace)
+        self._capture(names, [[fastsim.context[name] for name in names]])
+
+    def _trigger_test(self, names):
+        """ Return a function of a row of traced values that is true when the trigger fires. """
+        if callable(self.trigger):
+            return lambda row: self.trigger(dict(zip(names, row)))
+        missing = [name for name in self.trigger if name not in self.trace]
+        if missing:
+            raise PyrtlError('trigger wires %s are not being traced' % missing)
+        checks = [(names.index(name), value) for name, value in self.trigger.items()]
+        return lambda row: all(row[i] == value for i, value in checks)
+
+    def _capture(self, names, rows):
+        fires = self._trigger_test(names)
+        lists = [self.trace[name] for name in names]
+
+        def commit(cycle, row):
+            for values, value in zip(lists, row):
+                values.append(value)
+            self.cycles.append(cycle)
+
+        for row in rows:
+            cycle = self._cycle
+            self._cycle += 1
+            sampled = cycle % self.decimate == 0
+            if fires(row):
+                if not self._post_remaining:
+                    for entry in self._window:
+                        commit(*entry)
+                    self._window.clear()
+                commit(cycle, row)
+                self._post_remaining = self.post_trigger
+            elif self._post_remaining:
+                if sampled:
+                    commit(cycle, row)
+                    self._post_remaining -= 1
+            elif sampled and self.pre_trigger:
+                self._window.append((cycle, row))
+
+    def _truncate(self, length):
+        super(TriggeredTrace, self)._truncate(length)
+        del self.cycles[length:]
+
+    def _trigger_state(self):
+        """ Return the state of the capture, other than the trace, for a checkpoint. """
+        return self._cycle, tuple(self._window), self._post_remaining
+
+    def _restore_trigger_state(self, state):
+        """ Rewind the capture to a state returned by _trigger_state. """
+        self._cycle, window, self._post_remaining = state
+        self._window = collections.deque(window, maxlen=self.pre_trigger)
+
+    def _copy(self):
+        new_tracer = super(TriggeredTrace, self)._copy()
+        new_tracer.cycles = list(self.cycles)
+        new_tracer._window = copy.copy(self._window)
+        return new_tracer
@@ -1,8 +1,23 @@
+import os
+import pickle
+import shutil
+import tempfile
 import unittest
 import six
 
 import pyrtl
 from pyrtl.corecircuits import _basic_add
+from pyrtl.compilesim import _WORD_TYPECODE
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import concurrent.futures
+except ImportError:
+    concurrent = None
 
 # the code below disables testing of CompiledSim on systems where there does
 # not appear to be the right version of gcc.  This is a not an ideal way to check
@@ -555,6 +570,751 @@ class MemBlockBase(unittest.TestCase):
                                             'o2 000000\n'
                                             'o3 000000\n')
 
+    def test_sparse_mem_val_map(self):
+        mem_val_map = {self.mem1: {0: 1, 1: 2, 6: 7}}
+        sim = self.sim(tracer=self.sim_trace, memory_value_map=mem_val_map,
+                       sparse_mem_threshold=0, partition_size=2)
+        for i in range(4):
+            sim.step({self.read_addr1: i, self.read_addr2: 6,
+                      self.write_addr: 2, self.write_data: 5})
+        self.assertEqual(self.sim_trace.trace['o1'], [1, 2, 5, 0])
+        self.assertEqual(self.sim_trace.trace['o2'], [7] * 4)
+        self.assertEqual(sim.inspect_mem(self.mem1), {0: 1, 1: 2, 2: 5, 6: 7})
+
+
+class SparseMemBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        self.addr = pyrtl.Input(32, 'addr')
+        self.data = pyrtl.Input(72, 'data')
+        self.we = pyrtl.Input(1, 'we')
+        self.mem = pyrtl.MemBlock(72, 32, 'mem')
+        self.mem[self.addr] <<= pyrtl.MemBlock.EnabledWrite(self.data, self.we)
+        self.out = pyrtl.Output(72, 'out')
+        self.out <<= self.mem[self.addr]
+
+    def test_wide_address_space(self):
+        sim = self.sim(memory_value_map={self.mem: {0xdeadbeef: 1 << 70}})
+        addrs = [0xdeadbeef, 0xffffffff, 0x12345, 0xffffffff, 0x12345]
+        sim.run([{'addr': a, 'data': a + 1, 'we': int(a != 0xdeadbeef)} for a in addrs])
+        self.assertEqual(sim.tracer.trace['out'], [1 << 70, 0, 0, 1 << 32, 0x12346])
+        mem = sim.inspect_mem(self.mem)
+        self.assertEqual(len(mem), 3 << 10)
+        self.assertEqual(mem[0xffffffff], 1 << 32)
+        self.assertEqual(mem[0x7777], 0)
+        self.assertEqual({a: v for a, v in mem.items() if v},
+                         {0xdeadbeef: 1 << 70, 0xffffffff: 1 << 32, 0x12345: 0x12346})
+        contents = {0xdeadbeef: 1 << 70, 0xffffffff: 1 << 32, 0x12345: 0x12346}
+        self.assertEqual(mem, contents)
+        contents[0x7777] = 1  # an address outside the populated pages
+        self.assertNotEqual(mem, contents)
+
+    def test_sparse_checkpoint(self):
+        sim = self.sim()
+        sim.step({'addr': 5, 'data': 6, 'we': 1})
+        checkpoint = sim.checkpoint()
+        sim.step({'addr': 1 << 20, 'data': 7, 'we': 1})
+        forked = sim.fork()
+        sim.restore(checkpoint)
+        self.assertEqual({a: v for a, v in sim.inspect_mem(self.mem).items() if v}, {5: 6})
+        self.assertEqual(forked.inspect_mem(self.mem)[1 << 20], 7)
+
+
+class CheckpointBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        self.inc = pyrtl.Input(2, 'inc')
+        self.counter = pyrtl.Register(70, 'counter')
+        self.counter.next <<= self.counter + self.inc
+        self.mem = pyrtl.MemBlock(bitwidth=8, addrwidth=2, name='mem')
+        self.mem[self.counter[0:2]] <<= self.counter[0:8]
+        self.out = pyrtl.Output(8, 'out')
+        self.out <<= self.mem[self.inc]
+        self.cnt = pyrtl.Output(70, 'cnt')
+        self.cnt <<= self.counter
+
+    def run_steps(self, sim, incs):
+        for inc in incs:
+            sim.step({'inc': inc})
+
+    def test_checkpoint_restore(self):
+        sim = self.sim(register_value_map={self.counter: 2**69})
+        self.run_steps(sim, [1, 3, 2, 1, 3])
+        snapshot = sim.checkpoint()
+        self.run_steps(sim, [2, 2, 2])
+        first_pass = {w: list(sim.tracer.trace[w]) for w in ('out', 'cnt')}
+        first_mem = dict(sim.inspect_mem(self.mem))
+        self.run_steps(sim, [1, 1, 3, 3])
+        sim.restore(snapshot)
+        self.assertEqual(len(sim.tracer), 5)
+        self.run_steps(sim, [2, 2, 2])
+        for w in ('out', 'cnt'):
+            self.assertEqual(sim.tracer.trace[w], first_pass[w])
+        self.assertEqual(dict(sim.inspect_mem(self.mem)), first_mem)
+
+    def test_fork(self):
+        sim = self.sim()
+        self.run_steps(sim, [1, 3, 2])
+        forked = sim.fork()
+        self.run_steps(sim, [1, 1])
+        self.run_steps(forked, [3, 3])
+        self.assertEqual(sim.tracer.trace['cnt'], [0, 1, 4, 6, 7])
+        self.assertEqual(forked.tracer.trace['cnt'], [0, 1, 4, 6, 9])
+        self.assertEqual(sim.inspect_mem(self.mem)[3], 7)
+        self.assertEqual(forked.inspect_mem(self.mem)[1], 9)
+
+    def test_no_tracer(self):
+        sim = self.sim(tracer=None)
+        self.run_steps(sim, [1, 3])
+        snapshot = sim.checkpoint()
+        sim.run([{'inc': 2}, {'inc': 2}])
+        outputs = sim.run_columns({'inc': [1, 1]})
+        self.assertEqual(list(outputs['cnt']), [8, 0, 9, 0])  # two limbs each
+        sim.restore(snapshot)
+        forked = sim.fork()
+        self.run_steps(forked, [2])
+        self.assertEqual(forked.inspect('cnt'), 4)
+        self.assertIsNone(forked.tracer)
+
+
+class FastForwardBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        self.go = pyrtl.Input(1, 'go')
+        self.count = pyrtl.Register(4, 'count')
+        with pyrtl.conditional_assignment:
+            with self.go | (self.count != 0):
+                self.count.next |= self.count + 1
+        self.out = pyrtl.Output(4, 'out')
+        self.out <<= self.count
+
+    def test_fast_forward_matches(self):
+        gos = [0] * 5 + [1] + [0] * 30 + [1, 0, 0]
+        reference = self.sim()
+        skipping = self.sim(fast_forward=True)
+        reference.run([{'go': go} for go in gos])
+        skipped = skipping.run([{'go': go} for go in gos])
+        self.assertEqual(skipping.tracer.trace['out'], reference.tracer.trace['out'])
+        self.assertTrue(skipped > 0)
+        self.assertEqual(skipping.cycles_skipped, skipped)
+
+    def test_fast_forward_across_calls(self):
+        sim = self.sim(fast_forward=True)
+        for _ in range(20):
+            sim.step({'go': 0})
+        self.assertEqual(sim.cycles_skipped, 19)
+        sim.run_columns({'go': [0, 0, 1, 0]})
+        self.assertEqual(sim.cycles_skipped, 21)
+        sim.run([{'go': 0}] * 4)
+        self.assertEqual(sim.tracer.trace['out'], [0] * 23 + [1, 2, 3, 4, 5])
+        sim.restore(sim.checkpoint())  # the next step must be simulated again
+        sim.run([{'go': 0}] * 15)
+        self.assertEqual(sim.tracer.trace['out'][-15:], list(range(6, 16)) + [0] * 5)
+        self.assertEqual(sim.cycles_skipped, 25)
+
+
+class TriggeredTraceBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        self.x = pyrtl.Input(2, 'x')
+        count = pyrtl.Register(4, 'count')
+        count.next <<= count + 1
+        self.out = pyrtl.Output(4, 'out')
+        self.out <<= count
+
+    def run_trace(self, tracer, steps=24, xs=None):
+        sim = self.sim(tracer=tracer)
+        xs = xs or [0] * steps
+        sim.run([{'x': x} for x in xs[:steps // 2]])
+        sim.run([{'x': x} for x in xs[steps // 2:]])
+        return tracer
+
+    def test_trigger_window(self):
+        tracer = self.run_trace(pyrtl.TriggeredTrace(
+            {self.out: 5}, pre_trigger=2, post_trigger=3, wires_to_track=[self.x, self.out]))
+        self.assertEqual(tracer.cycles, [3, 4, 5, 6, 7, 8, 19, 20, 21, 22, 23])
+        self.assertEqual(tracer.trace['out'], [c % 16 for c in tracer.cycles])
+
+    def test_trigger_decimate(self):
+        tracer = self.run_trace(pyrtl.TriggeredTrace(
+            {'out': 5}, pre_trigger=2, post_trigger=3, decimate=2,
+            wires_to_track=[self.x, self.out]))
+        self.assertEqual(tracer.cycles, [2, 4, 5, 6, 8, 10, 18, 20, 21, 22])
+        self.assertEqual(tracer.trace['out'], [c % 16 for c in tracer.cycles])
+
+    def test_trigger_retrigger_extends(self):
+        xs = [0] * 6 + [3, 0, 3] + [0] * 15
+        tracer = self.run_trace(pyrtl.TriggeredTrace(
+            {'x': 3}, pre_trigger=1, post_trigger=2, wires_to_track=[self.x, self.out]),
+            xs=xs)
+        self.assertEqual(tracer.cycles, [5, 6, 7, 8, 9, 10])
+        self.assertEqual(tracer.trace['x'], [0, 3, 0, 3, 0, 0])
+
+    def test_trigger_function(self):
+        xs = [0] * 10 + [2] + [0] * 13
+        tracer = self.run_trace(pyrtl.TriggeredTrace(
+            lambda values: values['x'] == 2 and values['out'] == 10,
+            post_trigger=1, wires_to_track=[self.x, self.out]), xs=xs)
+        self.assertEqual(tracer.cycles, [10, 11])
+        self.assertEqual(tracer.trace['out'], [10, 11])
+
+    def test_trigger_checkpoint(self):
+        tracer = pyrtl.TriggeredTrace(
+            {'out': 5}, pre_trigger=2, post_trigger=3, wires_to_track=[self.x, self.out])
+        sim = self.sim(tracer=tracer)
+        sim.run([{'x': 0}] * 6)
+        checkpoint = sim.checkpoint()  # waiting for the samples after the trigger
+        sim.run([{'x': 0}] * 10)
+        sim.restore(checkpoint)
+        self.assertEqual(tracer.cycles, [3, 4, 5])
+        sim.run([{'x': 0}] * 12)
+        checkpoint = sim.checkpoint()  # with cycles 16 and 17 in the window
+        sim.run([{'x': 1}] * 10)
+        sim.restore(checkpoint)
+        sim.run([{'x': 0}] * 6)
+        self.assertEqual(tracer.cycles, [3, 4, 5, 6, 7, 8, 19, 20, 21, 22, 23])
+        self.assertEqual(tracer.trace['out'], [c % 16 for c in tracer.cycles])
+
+    def test_trigger_inspect(self):
+        values = []
+        for sim_type in (pyrtl.Simulation, pyrtl.FastSimulation, self.sim):
+            sim = sim_type(tracer=pyrtl.TriggeredTrace(
+                {'x': 1}, wires_to_track=[self.x, self.out]))
+            sim.step({'x': 1})
+            sim.step({'x': 3})  # not captured
+            values.append([sim.inspect(w) for w in ('x', 'out', 'count')])
+            self.assertEqual(sim.tracer.trace['x'], [1])
+        self.assertEqual(values, [[3, 1, 1]] * 3)
+
+    def test_trigger_untraced_wire(self):
+        tracer = pyrtl.TriggeredTrace({'x': 1}, wires_to_track=[self.out])
+        with self.assertRaises(pyrtl.PyrtlError):
+            self.run_trace(tracer)
+
+    def test_trigger_bad_options(self):
+        with self.assertRaises(pyrtl.PyrtlError):
+            pyrtl.TriggeredTrace({'x': 1}, decimate=0)
+        with self.assertRaises(pyrtl.PyrtlError):
+            pyrtl.TriggeredTrace(3)
+
+
+class RunUntilBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        self.req = pyrtl.Input(1, 'req')
+        self.count = pyrtl.Register(4, 'count')
+        with pyrtl.conditional_assignment:
+            with self.req:
+                self.count.next |= self.count + 1
+        self.ready = pyrtl.Output(1, 'ready')
+        self.ready <<= self.count == 5
+        self.val = pyrtl.Output(4, 'val')
+        self.val <<= self.count
+
+    def test_run_until_output(self):
+        sim = self.sim()
+        cycles, final = sim.run_until({self.ready: 1}, {'req': 1}, 100)
+        self.assertEqual(cycles, 6)
+        self.assertEqual(final['ready'], 1)
+        self.assertEqual(final['val'], 5)
+        self.assertEqual(sim.tracer.trace['val'], [0, 1, 2, 3, 4, 5])
+        self.assertEqual(sim.tracer.trace['req'], [1] * 6)
+
+    def test_run_until_register(self):
+        sim = self.sim()
+        cycles, final = sim.run_until({'count': 3}, {'req': [1, 1, 1, 1, 1]}, 100)
+        self.assertEqual(cycles, 4)
+        self.assertEqual(final['count'], 3)
+        self.assertEqual(final['val'], 3)
+
+    def test_run_until_cap_and_stimulus(self):
+        sim = self.sim()
+        self.assertEqual(sim.run_until({'ready': 1}, {'req': 0}, 10)[0], 10)
+        cycles, final = sim.run_until({'ready': 1}, {'req': [1, 0, 1]}, 100)
+        self.assertEqual(cycles, 3)
+        self.assertEqual(final['ready'], 0)
+        cycles, final = sim.run_until({'ready': 1}, {'req': 1}, 100)
+        self.assertEqual(cycles, 4)
+        self.assertEqual(final['val'], 5)
+        self.assertEqual(sim.tracer.trace['val'], [0] * 11 + [1, 1, 2, 3, 4, 5])
+
+    def test_run_until_matches_step(self):
+        reference = self.sim()
+        for req in [1, 1, 0, 1, 1, 1, 1]:
+            reference.step({'req': req})
+        sim = self.sim()
+        cycles, _ = sim.run_until({'ready': 1}, {'req': [1, 1, 0, 1, 1, 1, 1, 1, 1]}, 100)
+        self.assertEqual(cycles, 7)
+        self.assertEqual(sim.tracer.trace['val'], reference.tracer.trace['val'])
+
+    def test_run_until_bad_condition(self):
+        sim = self.sim()
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.run_until({'req': 1}, {'req': 1}, 10)
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.run_until({'ready': 2}, {'req': 1}, 10)
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.run_until({'ready': 1}, [{'req': 1}], 10)
+
+    def test_run_until_no_cycles(self):
+        sim = self.sim()
+        sim.run({'req': [1, 1, 1]})
+        cycles, final = sim.run_until({'count': 3}, {'req': 1}, 0)
+        self.assertEqual(cycles, 0)
+        self.assertEqual(final, {'count': 2, 'val': 2, 'ready': 0})
+        cycles, final = sim.run_until({'count': 3}, {'req': []}, 10)
+        self.assertEqual(cycles, 0)
+        self.assertEqual(final, {'count': 2, 'val': 2, 'ready': 0})
+        self.assertEqual(sim.tracer.trace['val'], [0, 1, 2])
+
+
+class CompileCacheBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        a = pyrtl.Input(100, 'a')
+        b = pyrtl.Input(70, 'b')
+        acc = pyrtl.Register(170, 'acc')
+        acc.next <<= a * b + acc
+        self.o = pyrtl.Output(170, 'o')
+        self.o <<= acc
+        self.cache_dir = tempfile.mkdtemp()
+        self.inputs = [{'a': (3 ** 60) + i, 'b': (7 ** 20) * i} for i in range(6)]
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def expected(self):
+        acc, out = 0, []
+        for step in self.inputs:
+            out.append(acc)
+            acc = (acc + step['a'] * step['b']) & ((1 << 170) - 1)
+        return out
+
+    def test_opt_levels_agree(self):
+        for opt_level in (0, 2, 3):
+            sim = self.sim(opt_level=opt_level)
+            sim.run(self.inputs)
+            self.assertEqual(sim.tracer.trace['o'], self.expected())
+
+    def test_bad_opt_level(self):
+        with self.assertRaises(pyrtl.PyrtlError):
+            self.sim(opt_level=7)
+
+    def test_cache_reused(self):
+        first = self.sim(cache_dir=self.cache_dir, opt_level=2)
+        cached = os.listdir(self.cache_dir)
+        self.assertEqual(len(cached), 1)
+        second = self.sim(cache_dir=self.cache_dir, opt_level=2)
+        self.assertEqual(os.listdir(self.cache_dir), cached)
+        self.assertFalse(os.path.exists(os.path.join(second._dir, 'pyrtlsim.c')))
+        # each simulation still has its own state
+        first.run(self.inputs)
+        second.run(self.inputs[:2])
+        self.assertEqual(first.tracer.trace['o'], self.expected())
+        self.assertEqual(second.tracer.trace['o'], self.expected()[:2])
+
+    def test_cache_keyed_on_flags(self):
+        self.sim(cache_dir=self.cache_dir)
+        self.sim(cache_dir=self.cache_dir, opt_level=1)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+
+class PartitionedCompileBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        self.cache_dir = tempfile.mkdtemp()
+        a = pyrtl.Input(16, 'a')
+        r = pyrtl.Register(16, 'r')
+        mem = pyrtl.MemBlock(16, 4, 'mem')
+        value = a ^ r
+        for i in range(60):
+            link = pyrtl.WireVector(16, 'chain%d' % i)
+            link <<= (value * 3 + i)[:16] ^ value[1:]
+            value = link
+        mem[value[:4]] <<= value
+        r.next <<= value + mem[a[:4]]
+        self.o = pyrtl.Output(16, 'o')
+        self.o <<= value
+        self.value = value
+        self.inputs = [{'a': (i * 4099) & 0xffff} for i in range(20)]
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def reference(self):
+        sim = pyrtl.Simulation()
+        sim.run(self.inputs)
+        return sim.tracer.trace['o']
+
+    def test_partitioned_matches(self):
+        sim = self.sim(partition_size=40)
+        self.assertTrue(len(sim._partition_sources) > 2)
+        sim.run(self.inputs)
+        self.assertEqual(sim.tracer.trace['o'], self.reference())
+
+    def test_partitions_reused_after_edit(self):
+        sim = self.sim(partition_size=40, cache_dir=self.cache_dir)
+        objects = {f for f in os.listdir(self.cache_dir) if f.endswith('.o')}
+        self.assertEqual(len(objects), len(sim._partition_sources))
+        extra = pyrtl.Output(16, 'extra')
+        extra <<= self.value + 1
+        sim = self.sim(partition_size=40, cache_dir=self.cache_dir)
+        new_objects = {f for f in os.listdir(self.cache_dir) if f.endswith('.o')} - objects
+        self.assertTrue(len(new_objects) < len(sim._partition_sources) / 2)
+        sim.run(self.inputs)
+        self.assertEqual(sim.tracer.trace['o'], self.reference())
+        self.assertEqual(sim.tracer.trace['extra'], [(v + 1) & 0xffff for v in self.reference()])
+
+
+@unittest.skipIf(concurrent is None, 'compiling in the background requires concurrent.futures')
+class BackgroundCompileBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        a = pyrtl.Input(8, 'a')
+        r = pyrtl.Register(8, 'r')
+        r.next <<= r + a
+        self.o = pyrtl.Output(8, 'o')
+        self.o <<= r
+
+    def test_background_run_waits(self):
+        sim = self.sim(background=True)
+        # the design can change once the code has been generated
+        extra = pyrtl.Output(8, 'extra')
+        extra <<= 3
+        sim.run([{'a': i} for i in range(5)])
+        self.assertEqual(sim.tracer.trace['o'], [0, 0, 1, 3, 6])
+        self.assertTrue(sim.build_future.done())
+
+    def test_background_future(self):
+        sims = [self.sim(background=True) for _ in range(3)]
+        for sim in sims:
+            self.assertIs(sim.build_future.result(), sim)
+            sim.step({'a': 2})
+            sim.step({'a': 2})
+            self.assertEqual(sim.inspect('o'), 2)
+
+    def test_background_asyncio(self):
+        try:
+            import asyncio
+        except ImportError:
+            self.skipTest('needs asyncio')
+        sim = self.sim(background=True)
+        loop = asyncio.new_event_loop()
+        try:
+            ready = loop.run_until_complete(asyncio.wrap_future(sim.build_future, loop=loop))
+        finally:
+            loop.close()
+        self.assertIs(ready, sim)
+
+    def test_foreground_wait(self):
+        sim = self.sim()
+        self.assertIsNone(sim.build_future)
+        sim.wait()
+
+
+class RunColumnsBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        self.a = pyrtl.Input(8, 'a')
+        self.wide = pyrtl.Input(100, 'wide')
+        acc = pyrtl.Register(8, 'acc')
+        acc.next <<= acc + self.a
+        self.o = pyrtl.Output(8, 'o')
+        self.o <<= acc
+        self.w = pyrtl.Output(101, 'w')
+        self.w <<= self.wide + 1
+
+    def expected(self, a_values):
+        acc, out = 0, []
+        for a in a_values:
+            out.append(acc)
+            acc = (acc + a) & 0xff
+        return out
+
+    def test_run_columns_arrays(self):
+        import array
+        sim = self.sim()
+        a_values = array.array(_WORD_TYPECODE, [3, 200, 7, 9, 0, 255])
+        wide_values = [5, (1 << 99) + 17, 0, 1 << 64, 2, 3]
+        wide_limbs = array.array(_WORD_TYPECODE, [])
+        for v in wide_values:
+            wide_limbs.extend([v & ((1 << 64) - 1), v >> 64])
+        outputs = sim.run_columns({'a': a_values, self.wide: wide_limbs})
+        self.assertEqual(list(outputs['o']), self.expected(a_values))
+        self.assertEqual(len(outputs['w']), 12)
+        self.assertEqual(sim.tracer.trace['o'], self.expected(a_values))
+        self.assertEqual(sim.tracer.trace['w'], [v + 1 for v in wide_values])
+        self.assertEqual(sim.tracer.trace['a'], list(a_values))
+        self.assertEqual(sim.tracer.trace['wide'], wide_values)
+
+    def test_run_columnar_matches_list(self):
+        a_values = [1, 2, 3, 4, 5]
+        reference = self.sim()
+        reference.run([{'a': a, 'wide': 7} for a in a_values])
+        sim = self.sim()
+        sim.run({'a': a_values, 'wide': 7})
+        self.assertEqual(sim.tracer.trace['o'], reference.tracer.trace['o'])
+        self.assertEqual(sim.tracer.trace['w'], [8] * 5)
+
+    def test_run_columns_validation(self):
+        import array
+        sim = self.sim()
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.run_columns({'a': array.array(_WORD_TYPECODE, [256]), 'wide': 0})
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.run_columns({'a': [1, 2], 'wide': 1 << 100})
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.run_columns({'a': [1, 2]})
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.run_columns({'a': [1, 2], 'wide': [1, 2, 3]})
+
+    def test_run_stream(self):
+        import array
+        a_values = [(n * 7) % 256 for n in range(25)]
+        chunks = []
+        sim = self.sim()
+        steps = sim.run_stream(({'a': a, 'wide': 1 << 70} for a in a_values),
+                               lambda first, outputs: chunks.append((first, outputs)),
+                               chunk_size=10)
+        self.assertEqual(steps, 25)
+        self.assertEqual([first for first, _ in chunks], [0, 10, 20])
+        self.assertEqual(sum((list(outputs['o']) for _, outputs in chunks), []),
+                         self.expected(a_values))
+        self.assertEqual(list(chunks[2][1]['w']), [1, 1 << 6] * 5)
+        self.assertEqual(sim.tracer.trace['o'], [])
+
+        sink = pyrtl.SimulationTrace(wires_to_track=[self.a, self.o])
+        sim = self.sim()
+        sim.run_stream([{'a': a_values[:5], 'wide': 0}, {'a': a_values[5:], 'wide': 0}], sink)
+        self.assertEqual(sink.trace['o'], self.expected(a_values))
+
+        f = six.BytesIO()
+        self.sim().run_stream([{'a': 3, 'wide': 2}, {'a': 4, 'wide': 5}], f)
+        rows = array.array(_WORD_TYPECODE, f.getvalue())
+        self.assertEqual(list(rows), [0, 3, 0, 3, 6, 0])
+
+    def test_run_stream_errors(self):
+        sim = self.sim()
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.run_stream([{'a': 1, 'wide': 0}, {'a': 1}])
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.run_stream([], chunk_size=0)
+        sim = self.sim(tracer=pyrtl.SimulationTrace(wires_to_track=[self.o]))
+        acc = pyrtl.working_block().wirevector_by_name['acc']
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.run_stream([], pyrtl.SimulationTrace(wires_to_track=[acc]))
+
+
+class LanesBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        self.a = pyrtl.Input(4, 'a')
+        r = pyrtl.Register(8, 'r')
+        self.mem = pyrtl.MemBlock(8, 2, 'mem')
+        r.next <<= r + self.a
+        self.mem[self.a[:2]] <<= r
+        self.o = pyrtl.Output(8, 'o')
+        self.o <<= r + self.mem[self.a[2:]]
+        self.stimulus = [[(step * 7 + lane * 5) % 16 for lane in range(4)] for step in range(12)]
+
+    def reference(self, lane):
+        sim = pyrtl.Simulation()
+        sim.run({'a': [row[lane] for row in self.stimulus]})
+        return sim.tracer.trace['o'], dict(sim.inspect_mem(self.mem))
+
+    def test_lanes_independent(self):
+        sim = self.sim(lanes=4)
+        outputs = sim.run_lanes({'a': self.stimulus})
+        for lane in range(4):
+            out, mem = self.reference(lane)
+            self.assertEqual(list(outputs['o'][lane::4]), out)
+            lane_mem = sim.inspect_mem(self.mem, lane)
+            self.assertEqual({addr: lane_mem[addr] for addr in mem}, mem)
+
+    def test_lanes_flat_and_held(self):
+        sim = self.sim(lanes=2)
+        outputs = sim.run_lanes({'a': [1, 2, 1, 2, 1, 2]})
+        self.assertEqual(list(outputs['o']), [0, 0, 1, 2, 2, 4])
+        outputs = sim.run_lanes({'a': 0}, nsteps=2)
+        self.assertEqual(len(outputs['o']), 4)
+
+    def test_lanes_errors(self):
+        with self.assertRaises(pyrtl.PyrtlError):
+            self.sim(lanes=0)
+        sim = self.sim(lanes=2)
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.run_lanes({'a': [[1, 2, 3]]})
+
+
+class ThreadedForksBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        a = pyrtl.Input(4, 'a')
+        r = pyrtl.Register(16, 'r')
+        self.mem = pyrtl.MemBlock(16, 2, 'mem')
+        r.next <<= (r * 3 + a)[:16]
+        self.mem[a[:2]] <<= r
+        o = pyrtl.Output(16, 'o')
+        o <<= r ^ self.mem[a[2:]]
+
+    def test_forks_share_library(self):
+        sim = self.sim()
+        sim.step({'a': 1})
+        fork = sim.fork()
+        self.assertIs(fork._lib, sim._lib)
+        fork.run([{'a': 2}, {'a': 2}])
+        sim.run([{'a': 3}, {'a': 3}])
+        self.assertNotEqual(fork.tracer.trace['o'], sim.tracer.trace['o'])
+        del sim
+        fork.step({'a': 4})  # the library outlives the simulation it was compiled for
+        self.assertEqual(len(fork.tracer.trace['o']), 4)
+
+    def test_forks_in_threads(self):
+        from multiprocessing.pool import ThreadPool
+        base = self.sim()
+        seeds = range(6)
+        stimulus = {seed: [(n * 7 + seed) % 16 for n in range(2000)] for seed in seeds}
+        forks = {seed: base.fork() for seed in seeds}
+
+        def run(seed):
+            forks[seed].run({'a': stimulus[seed]})
+            return forks[seed]
+
+        pool = ThreadPool(3)
+        try:
+            pool.map(run, seeds)
+        finally:
+            pool.close()
+            pool.join()
+        for seed in seeds:
+            serial = self.sim()
+            serial.run({'a': stimulus[seed]})
+            self.assertEqual(forks[seed].tracer.trace['o'], serial.tracer.trace['o'])
+            self.assertEqual(dict(forks[seed].inspect_mem(self.mem)),
+                             dict(serial.inspect_mem(self.mem)))
+
+
+class ParallelSimBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        a = pyrtl.Input(8, 'a')
+        mem = pyrtl.MemBlock(8, 2, 'mem')
+        mem[a[:2]] <<= a
+        read = mem[a[2:4]]
+        for k in range(4):
+            r = pyrtl.Register(16, 'r%d' % k)
+            x = r
+            for j in range(6):
+                x = (x * (j + k + 2) + a)[:16] ^ read
+            r.next <<= x
+            o = pyrtl.Output(16, 'o%d' % k)
+            o <<= x
+        self.stimulus = [{'a': (n * 37 + 11) % 256} for n in range(40)]
+
+    def check_matches(self, **kwargs):
+        reference = pyrtl.Simulation()
+        reference.run(self.stimulus)
+        sim = self.sim(threads=3, **kwargs)
+        sim.run(self.stimulus)
+        for name in sim.tracer.trace:
+            self.assertEqual(sim.tracer.trace[name], reference.tracer.trace[name])
+        return sim
+
+    def test_threads_match(self):
+        self.check_matches()
+
+    def test_threads_with_partitions_and_lanes(self):
+        sim = self.check_matches(partition_size=8, lanes=2)
+        outputs = sim.run_lanes({'a': [[step['a']] * 2 for step in self.stimulus]})
+        self.assertEqual(list(outputs['o1'][1::2]), sim.tracer.trace['o1'])
+
+    def test_threads_fork(self):
+        sim = self.sim(threads=2)
+        sim.run(self.stimulus[:20])
+        fork = sim.fork()
+        fork.run(self.stimulus[20:])
+        sim.run(self.stimulus[20:])
+        self.assertEqual(fork.tracer.trace['o3'], sim.tracer.trace['o3'])
+
+    def test_parallel_report(self):
+        sim = self.sim(threads=2)
+        report = sim.parallel_report()
+        self.assertEqual(report['threads'], 2)
+        self.assertEqual(len(report['thread_costs']), 2)
+        self.assertTrue(0 < report['balance'] <= 1)
+        self.assertTrue(1 <= report['estimated_speedup'] <= 2)
+        self.assertNotIn('speedup', report)
+        report = sim.parallel_report(self.stimulus)
+        self.assertTrue(report['speedup'] > 0)
+        self.assertEqual(sim.tracer.trace['o0'], [])  # timed on forks
+
+    def test_threads_errors(self):
+        with self.assertRaises(pyrtl.PyrtlError):
+            self.sim(threads=0)
+        with self.assertRaises(pyrtl.PyrtlError):
+            self.sim().parallel_report()
+
+
+class RtlAssertBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        self.a = pyrtl.Input(4, 'a')
+        count = pyrtl.Register(4, 'count')
+        count.next <<= count + 1
+        self.small = pyrtl.rtl_assert(self.a < 9, ValueError('a too big'))
+        self.early = pyrtl.rtl_assert((count < 6) | (self.a == 0), RuntimeError())
+        out = pyrtl.Output(4, 'out')
+        out <<= count
+
+    def test_assert_stops_run(self):
+        sim = self.sim()
+        sim.run([{'a': 1}] * 3)
+        self.assertIsNone(sim.assertion_failure)
+        with self.assertRaises(ValueError):
+            sim.run([{'a': a} for a in [2, 3, 12, 4]])
+        self.assertEqual(sim.assertion_failure, (self.small.name, 2))
+        self.assertEqual(sim.tracer.trace['out'], [0, 1, 2, 3, 4, 5])
+        with self.assertRaises(RuntimeError):
+            sim.run_columns({'a': [1, 1, 1]})
+        self.assertEqual(sim.assertion_failure, (self.early.name, 0))
+        self.assertEqual(sim.tracer.trace['out'], [0, 1, 2, 3, 4, 5, 6])
+
+    def test_assert_in_other_runs(self):
+        sim = self.sim(fast_forward=True)
+        with self.assertRaises(RuntimeError):
+            sim.run_until({'out': 15}, {'a': 1}, 100)
+        self.assertEqual(sim.assertion_failure, (self.early.name, 6))
+        self.assertEqual(len(sim.tracer.trace['out']), 7)
+        chunks = []
+        with self.assertRaises(ValueError):
+            self.sim().run_stream(({'a': 9 if n == 12 else 0} for n in range(20)),
+                                  lambda first, outputs: chunks.append(len(outputs['out'])),
+                                  chunk_size=5)
+        self.assertEqual(chunks, [5, 5, 3])
+        sim = self.sim(lanes=2)
+        with self.assertRaises(ValueError):
+            sim.run_lanes({'a': [[0, 0], [0, 10], [0, 0]]})
+        self.assertEqual(sim.assertion_failure, (self.small.name, 1))
+
+
+class LockstepBase(unittest.TestCase):
+    def test_lockstep_with_synthesized(self):
+        pyrtl.reset_working_block()
+        a = pyrtl.Input(8, 'a')
+        acc = pyrtl.Register(8, 'acc')
+        acc.next <<= acc + a
+        out = pyrtl.Output(8, 'out')
+        out <<= acc ^ a
+        inputs = {'a': [(n * 37) % 256 for n in range(300)]}
+        sim = self.sim()
+        other = self.sim(register_value_map={acc: 1})
+        pyrtl.synthesize()
+        pyrtl.optimize()
+        self.assertIsNone(pyrtl.lockstep(sim, pyrtl.Simulation(), inputs, chunk_size=64))
+        divergence = pyrtl.lockstep(pyrtl.Simulation(), other, inputs, chunk_size=64)
+        self.assertEqual(divergence.cycle, 0)
+        self.assertEqual(divergence.values, {'out': (0, 1)})
+
 
 class RegisterDefaultsBase(unittest.TestCase):
     def setUp(self):
@@ -693,7 +1453,7 @@ class RomBlockSimBase(unittest.TestCase):
     def test_rom_val_map(self):
         def rom_data_function(add):
             return int((add + 5) / 2)
-        dummy_in = pyrtl.Input(1, "dummy")
+        pyrtl.Input(1, "dummy")
         self.bitwidth = 4
         self.addrwidth = 4
         self.rom1 = pyrtl.RomBlock(bitwidth=self.bitwidth, addrwidth=self.addrwidth,
@@ -705,7 +1465,7 @@ class RomBlockSimBase(unittest.TestCase):
 
         self.sim_trace = pyrtl.SimulationTrace()
         with self.assertRaises(pyrtl.PyrtlError):
-            sim = self.sim(tracer=self.sim_trace, memory_value_map=mem_val_map)
+            self.sim(tracer=self.sim_trace, memory_value_map=mem_val_map)
 
 
 class InspectBase(unittest.TestCase):
@@ -727,6 +1487,163 @@ class InspectBase(unittest.TestCase):
         sim.step({a: 3, b: 23})
         self.assertEqual(sim.inspect_mem(mem), {23: 3})
 
+    def test_inspect_internal_wires(self):
+        a = pyrtl.Input(8, 'a')
+        r = pyrtl.Register(8, 'r')
+        tmp = a + r
+        r.next <<= tmp[:8]
+        o = pyrtl.Output(9, 'o')
+        o <<= tmp
+        sim = self.sim(tracer=pyrtl.SimulationTrace(wires_to_track=[o]))
+        sim.step({a: 3})
+        sim.step({a: 4})
+        self.assertEqual(sim.inspect(tmp), 7)
+        self.assertEqual(sim.inspect('r'), 3)
+        self.assertEqual(sim.inspect('o'), 7)
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.inspect('nonexistent')
+
+    def test_trace_internal_wires(self):
+        a = pyrtl.Input(8, 'a')
+        tmp = pyrtl.WireVector(9, 'tmp')
+        tmp <<= a + 1
+        o = pyrtl.Output(8, 'o')
+        o <<= tmp[1:]
+        sim_trace = pyrtl.SimulationTrace(wires_to_track=[a, tmp, o])
+        sim = self.sim(tracer=sim_trace)
+        sim.run([{a: n} for n in (1, 2, 255)])
+        self.assertEqual(sim_trace.trace['tmp'], [2, 3, 256])
+        outputs = sim.run_columns({'a': [5, 6]})
+        self.assertEqual(sorted(outputs), ['o'])
+        self.assertEqual(sim_trace.trace['tmp'], [2, 3, 256, 6, 7])
+
+
+@unittest.skipIf(numpy is None, 'mem_array requires numpy')
+class MemArrayBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        self.addr = pyrtl.Input(10, 'addr')
+        self.narrow = pyrtl.MemBlock(12, 10, 'narrow')
+        self.wide = pyrtl.MemBlock(80, 10, 'wide')
+        self.narrow[self.addr] <<= self.addr + 1
+        self.wide[self.addr] <<= pyrtl.concat(self.addr, pyrtl.Const(0, 70))
+        out = pyrtl.Output(12, 'out')
+        out <<= self.narrow[self.addr]
+
+    def test_mem_array_views(self):
+        sim = self.sim()
+        narrow = sim.mem_array(self.narrow)
+        self.assertEqual(narrow.dtype, numpy.uint16)
+        self.assertEqual(narrow.shape, (1024,))
+        sim.run_columns({'addr': [3, 5]})
+        self.assertEqual(list(numpy.flatnonzero(narrow)), [3, 5])
+        wide = sim.mem_array(self.wide)
+        self.assertEqual(wide.shape, (1024, 2))
+        self.assertEqual(list(wide[5]), [0, 5 << 6])
+        narrow[7] = 100
+        sim.step({'addr': 7})
+        self.assertEqual(sim.inspect('out'), 100)
+        self.assertEqual(sim.inspect_mem(self.narrow), {3: 4, 5: 6, 7: 8})
+        self.assertNotEqual(sim.inspect_mem(self.narrow), {3: 4, 5: 6})
+
+    def test_mem_array_value_map(self):
+        image = numpy.arange(1, 1025, dtype=numpy.uint16)
+        sim = self.sim(memory_value_map={self.narrow: image})
+        sim.step({'addr': 9})
+        self.assertEqual(sim.inspect('out'), 10)
+        self.assertTrue((sim.mem_array(self.narrow) == image).all())
+        forked = sim.fork()
+        self.assertEqual(forked.inspect_mem(self.narrow), sim.inspect_mem(self.narrow))
+
+        pyrtl.reset_working_block()
+        addr = pyrtl.Input(24, 'addr')
+        big = pyrtl.MemBlock(8, 24, 'big')
+        out = pyrtl.Output(8, 'out')
+        out <<= big[addr]
+        image = numpy.zeros(1 << 16, dtype=numpy.uint8)
+        image[4000] = 42
+        sim = self.sim(memory_value_map={big: image})
+        sim.step({'addr': 4000})
+        self.assertEqual(sim.inspect('out'), 42)
+        self.assertEqual(len(sim.inspect_mem(big)), 1024)
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.mem_array(big)
+        with self.assertRaises(pyrtl.PyrtlError):
+            self.sim(memory_value_map={big: numpy.zeros((4, 2))})
+
+
+@unittest.skipIf(numpy is None, 'coverage requires numpy')
+class CoverageBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        self.a = pyrtl.Input(3, 'a')
+        self.big = pyrtl.Input(70, 'big')
+        self.r = pyrtl.Register(4, 'r')
+        self.r.next <<= self.a
+        out = pyrtl.Output(70, 'out')
+        out <<= self.big
+
+    def test_toggles_and_buckets(self):
+        sim = self.sim(coverage=True, coverage_buckets=4)
+        sim.run([{'a': 1, 'big': 1 << 69}, {'a': 0, 'big': 0}, {'a': 2, 'big': 3}])
+        cov = sim.get_coverage()
+        self.assertEqual(cov.steps, 3)
+        self.assertEqual(cov.toggled_bits(self.a), 0b011)
+        self.assertEqual(cov.toggled_bits('big'), (1 << 69) | 3)
+        self.assertEqual(cov.toggled_bits(self.r), 0b001)  # r was 0, 1, 0
+        self.assertEqual(list(cov.bucket_counts('big')), [2, 0, 1, 0])
+        self.assertEqual(list(cov.bucket_counts('a')), [2, 1, 0, 0])
+        self.assertEqual(cov.uncovered()['a'], ([2], [2, 3]))
+        sim.clear_coverage()
+        self.assertEqual(sim.get_coverage().steps, 0)
+        self.assertFalse(sim.get_coverage().toggled.any())
+
+    def test_coverage_across_restore(self):
+        sim = self.sim(coverage=True)
+        sim.step({'a': 4, 'big': 0})
+        checkpoint = sim.checkpoint()
+        sim.step({'a': 7, 'big': 0})
+        sim.restore(checkpoint)
+        sim.clear_coverage()
+        sim.step({'a': 5, 'big': 0})  # toggles against the step before the checkpoint
+        self.assertEqual(sim.get_coverage().toggled_bits('a'), 0b001)
+        sim.fork().step({'a': 5, 'big': 0})
+        self.assertEqual(sim.get_coverage().steps, 1)
+
+    def test_merge_and_report(self):
+        sim = self.sim(coverage=True, lanes=2)
+        sim.run_lanes({'a': [[1, 4], [2, 0]], 'big': 0})
+        self.assertEqual(sim.get_coverage(0).toggled_bits('a'), 0b011)
+        self.assertEqual(sim.get_coverage(1).toggled_bits('a'), 0b100)
+        cov = pickle.loads(pickle.dumps(sim.get_coverage()))
+        self.assertEqual(cov.steps, 4)
+        self.assertEqual(cov.toggled_bits('a'), 0b111)
+        self.assertEqual(len(cov.counts), 0)
+        other = self.sim(coverage=True)
+        other.step({'a': 0, 'big': 0})
+        other.step({'a': 0, 'big': 1 << 68})
+        merged = cov.merge(other.get_coverage())
+        self.assertEqual(merged.steps, 6)
+        self.assertEqual(merged.toggled_bits('big'), 1 << 68)
+        report = merged.report()
+        self.assertIn('6 steps', report)
+        self.assertIn('big: bits 0-67, 69 never toggled', report)
+        self.assertNotIn('a:', report)
+
+    def test_coverage_errors(self):
+        with self.assertRaises(pyrtl.PyrtlError):
+            self.sim(coverage_buckets=4)
+        with self.assertRaises(pyrtl.PyrtlError):
+            self.sim(coverage=True, coverage_buckets=3)
+        with self.assertRaises(pyrtl.PyrtlError):
+            self.sim().get_coverage()
+        cov = self.sim(coverage=True).get_coverage()
+        pyrtl.reset_working_block()
+        x = pyrtl.Output(1, 'x')
+        x <<= pyrtl.Input(1, 'y')
+        with self.assertRaises(pyrtl.PyrtlError):
+            cov.merge(self.sim(coverage=True).get_coverage())
+
 
 class TraceErrorBase(unittest.TestCase):
     def setUp(self):
@@ -0,0 +1,108 @@
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import pyrtl
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    version = subprocess.check_output(['gcc', '--version'])
+except OSError:
+    raise unittest.SkipTest('CompiledSimulation testing requires gcc')
+
+
+@unittest.skipIf(numpy is None, 'coverage requires numpy')
+class TestStimulusFuzzer(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        self.a = pyrtl.Input(4, 'a')
+        state = pyrtl.Register(2, 'state')
+        with pyrtl.conditional_assignment:
+            with (state == 0) & (self.a == 9):
+                state.next |= 1
+            with (state == 1) & (self.a == 4):
+                state.next |= 2
+            with pyrtl.otherwise:
+                state.next |= 0
+        self.reached = pyrtl.rtl_assert(state != 2, ValueError('reached state 2'))
+        self.sim = pyrtl.CompiledSimulation(coverage=True, coverage_buckets=4)
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_finds_assertion(self):
+        fuzzer = pyrtl.StimulusFuzzer(self.sim, seed=3, length=8)
+        failures = fuzzer.run(3000)
+        self.assertEqual(list(failures), [self.reached.name])
+        sequence = failures[self.reached.name]
+        self.assertEqual(sequence['a'][-3:-1], [9, 4])
+        # the sequence fails in its last step, from the initial state
+        sim = self.sim.fork()
+        with self.assertRaises(ValueError):
+            sim.run_columns(sequence)
+        self.assertEqual(sim.assertion_failure, (self.reached.name, len(sequence['a'])-1))
+        self.assertEqual(fuzzer.iterations, 3001)
+        self.assertGreater(len(fuzzer.corpus), 1)
+        self.assertEqual(fuzzer.coverage.toggled_bits('state'), 0b11)
+        self.assertEqual(self.sim.tracer.trace['a'], [])  # the given simulation is not run
+
+    def test_corpus_dir(self):
+        fuzzer = pyrtl.StimulusFuzzer(self.sim, corpus_dir=self.dir, seed=3, length=8)
+        fuzzer.run(3000)
+        files = sorted(f for f in os.listdir(self.dir) if f.endswith('.json'))
+        self.assertEqual(len(files), len(fuzzer.corpus))
+        with open(os.path.join(self.dir, files[0])) as f:
+            self.assertEqual(sorted(json.load(f)['inputs']), ['a'])
+        failures = os.listdir(os.path.join(self.dir, 'failures'))
+        self.assertEqual(len(failures), 1)
+        other = pyrtl.StimulusFuzzer(self.sim, corpus_dir=self.dir, seed=4)
+        self.assertEqual(len(other.corpus), len(fuzzer.corpus))
+        self.assertEqual(other.failures, fuzzer.failures)
+        self.assertEqual(other.coverage.toggled_bits('a'), fuzzer.coverage.toggled_bits('a'))
+
+    def test_corpus_dir_invalid_files(self):
+        os.mkdir(os.path.join(self.dir, 'failures'))
+        bad = [{'inputs': {'a': [16]}}, {'inputs': {'a': [1.5]}}, {'inputs': {'a': []}},
+               {'inputs': {'b': [1]}}, {'inputs': {'a': 3}}, {'outputs': {}}]
+        for i, contents in enumerate(bad):
+            with open(os.path.join(self.dir, 'bad%d.json' % i), 'w') as f:
+                json.dump(contents, f)
+        with open(os.path.join(self.dir, 'broken.json'), 'w') as f:
+            f.write('{"inputs": ')
+        with open(os.path.join(self.dir, 'good.json'), 'w') as f:
+            json.dump({'inputs': {'a': [9, 15]}}, f)
+        with open(os.path.join(self.dir, 'failures', 'bad.json'), 'w') as f:
+            json.dump({'assertion': 'x', 'inputs': {'a': [1, 2], 'b': [3]}}, f)
+        fuzzer = pyrtl.StimulusFuzzer(self.sim, corpus_dir=self.dir, seed=3)
+        self.assertEqual([sequence for sequence, state in fuzzer.corpus][-1], {'a': [9, 15]})
+        self.assertEqual(fuzzer.failures, {})
+
+    def test_run_parallel(self):
+        fuzzer = pyrtl.StimulusFuzzer(self.sim, corpus_dir=self.dir, seed=5, length=8)
+        failures = fuzzer.run_parallel(1500, processes=2, sync_every=50)
+        self.assertEqual(list(failures), [self.reached.name])
+        files = [f for f in os.listdir(self.dir) if f.endswith('.json')]
+        self.assertEqual(len(files), len(fuzzer.corpus))
+
+    def test_fuzzer_errors(self):
+        with self.assertRaises(pyrtl.PyrtlError):
+            pyrtl.StimulusFuzzer(pyrtl.CompiledSimulation())
+        with self.assertRaises(pyrtl.PyrtlError):
+            pyrtl.StimulusFuzzer(self.sim, length=10, max_length=5)
+        with self.assertRaises(pyrtl.PyrtlError):
+            pyrtl.StimulusFuzzer(self.sim).run_parallel(10)
+        threaded = pyrtl.CompiledSimulation(coverage=True, threads=2)
+        with self.assertRaises(pyrtl.PyrtlError):
+            pyrtl.StimulusFuzzer(threaded, corpus_dir=self.dir).run_parallel(10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -613,10 +613,24 @@ class TestRtlAssert(unittest.TestCase):
         sim = pyrtl.FastSimulation()
         sim.step({i: 1})
         self.assertEqual(sim.inspect(o), 1)
+        self.assertIsNone(sim.assertion_failure)
 
         with self.assertRaises(self.RTLSampleException):
             sim.step({i: 0})
 
+    def test_assert_fastsimulation_run(self):
+        i = pyrtl.Input(1, 'i')
+        o = pyrtl.rtl_assert(i, self.RTLSampleException('test assertion failed'))
+
+        sim = pyrtl.FastSimulation()
+        with self.assertRaises(self.RTLSampleException):
+            sim.run({i: [1, 1, 0, 1, 0]})
+        self.assertEqual(sim.assertion_failure, (o.name, 2))
+        self.assertEqual(sim.tracer.trace['i'], [1, 1, 0])
+        with self.assertRaises(self.RTLSampleException):
+            sim.run_until({o: 0}, {i: [1, 0, 1]}, 10)
+        self.assertEqual(sim.assertion_failure, (o.name, 1))
+
 
 class TestLoopDetection(unittest.TestCase):
     def setUp(self):
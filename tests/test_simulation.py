@@ -292,6 +292,30 @@ class SimInputValidationBase(unittest.TestCase):
         with self.assertRaises(pyrtl.PyrtlError):
             sim.step({i: 5})
 
+    def test_unknown_and_missing_inputs(self):
+        i = pyrtl.Input(bitwidth=2, name='i')
+        j = pyrtl.Input(bitwidth=2, name='j')
+        o = pyrtl.Output(name='o')
+        o <<= i + j
+        sim = self.sim()
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.step({'i': 1, 'j': 1, 'k': 1})
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.step({'i': 1})
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.step({i: 1, 'i': 1})
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.step({'i': 1, 'j': -1})
+
+    def test_step_without_validation(self):
+        i = pyrtl.Input(bitwidth=2, name='i')
+        j = pyrtl.Input(bitwidth=2, name='j')
+        o = pyrtl.Output(name='o')
+        o <<= i + j
+        sim = self.sim()
+        sim.step({'i': 3, j: 2}, validate=False)
+        self.assertEqual(sim.inspect('o'), 5)
+
     def test_no_named_wires_erro(self):
         a = pyrtl.Const(-1, bitwidth=8)
         b = pyrtl.Input(8)
@@ -302,6 +326,47 @@ class SimInputValidationBase(unittest.TestCase):
             sim_trace = pyrtl.SimulationTrace()
 
 
+class RunBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        self.a = pyrtl.Input(4, 'a')
+        self.b = pyrtl.Input(4, 'b')
+        self.acc = pyrtl.Register(8, 'acc')
+        self.acc.next <<= self.acc + self.a * self.b
+        self.out = pyrtl.Output(8, 'out')
+        self.out <<= self.acc
+
+    def test_run_matches_step(self):
+        a_vals = [1, 2, 3, 15, 0, 7]
+        b_vals = [3, 3, 3, 15, 9, 1]
+        step_sim = self.sim()
+        for a, b in zip(a_vals, b_vals):
+            step_sim.step({'a': a, 'b': b})
+        run_sim = self.sim()
+        run_sim.run({'a': a_vals, self.b: b_vals})
+        self.assertEqual(run_sim.tracer.trace['out'], step_sim.tracer.trace['out'])
+        self.assertEqual(run_sim.tracer.trace['a'], a_vals)
+        self.assertEqual(run_sim.inspect('acc'), step_sim.inspect('acc'))
+
+    def test_run_held_input_and_nsteps(self):
+        sim = self.sim()
+        sim.run({'a': 2, 'b': [1, 2, 3, 4]}, nsteps=3)
+        sim.run([{'a': 1, 'b': 1}])
+        self.assertEqual(sim.tracer.trace['out'], [0, 2, 6, 12])
+        self.assertEqual(sim.tracer.trace['b'], [1, 2, 3, 1])
+
+    def test_run_invalid_inputs(self):
+        sim = self.sim()
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.run({'a': [1, 16], 'b': [1, 1]})
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.run({'a': [1, 2]})
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.run({'a': [1, 2], 'b': [1, 2, 3]})
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.run({'a': 1, 'b': 1})
+
+
 class TraceWithAdderBase(unittest.TestCase):
     def setUp(self):
         pyrtl.reset_working_block()
@@ -496,6 +561,54 @@ class MemBlockBase(unittest.TestCase):
         self.sim_trace.print_trace(output, compact=True)
         self.assertEqual(output.getvalue(), 'o1 0077653107\no2 0076452310\n')
 
+    def test_memory_backends(self):
+        import functools
+        import os
+        import tempfile
+        input_signals = [[0, 1, 4, 5],
+                         [4, 1, 0, 5],
+                         [0, 4, 1, 6],
+                         [1, 1, 0, 0],
+                         [6, 0, 6, 7]]
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            for backend in (pyrtl.SparseMemory, pyrtl.DenseMemory,
+                            functools.partial(pyrtl.MmapMemory, filename=filename)):
+                sim_trace = pyrtl.SimulationTrace()
+                sim = self.sim(tracer=sim_trace, memory_backends={self.mem1: backend},
+                               memory_value_map={self.mem1: {7: 2}})
+                for signals in input_signals:
+                    sim.step({self.read_addr1: signals[0], self.read_addr2: signals[1],
+                              self.write_addr: signals[2], self.write_data: signals[3]})
+                output = six.StringIO()
+                sim_trace.print_trace(output, compact=True)
+                self.assertEqual(output.getvalue(), 'o1 05560\no2 00560\n')
+                mem = sim.inspect_mem(self.mem1)
+                self.assertEqual([mem.get(addr, 0) for addr in range(8)],
+                                 [0, 6, 0, 0, 5, 0, 7, 2])
+                if hasattr(sim.inspect_mem(self.mem1), 'close'):
+                    sim.inspect_mem(self.mem1).close()
+        finally:
+            os.remove(filename)
+
+    def test_mmap_memory_default_value(self):
+        sim = self.sim(tracer=self.sim_trace, default_value=5,
+                       memory_backends={self.mem1: pyrtl.MmapMemory})
+        sim.step({self.read_addr1: 3, self.read_addr2: 4, self.write_addr: 4, self.write_data: 1})
+        sim.step({self.read_addr1: 3, self.read_addr2: 4, self.write_addr: 0, self.write_data: 2})
+        self.assertEqual(self.sim_trace.trace['o1'], [5, 5])
+        self.assertEqual(self.sim_trace.trace['o2'], [5, 1])
+        mem = sim.inspect_mem(self.mem1)
+        self.assertEqual(dict(mem), {0: 2, 4: 1})
+        self.assertEqual(len(mem), 2)
+        del mem[4]
+        self.assertEqual(mem[4], 5)
+        mem.clear()
+        self.assertEqual([mem[addr] for addr in range(8)], [5] * 8)
+        self.assertEqual(len(mem), 0)
+        mem.close()
+
     def test_synth_simple_memblock(self):
         pyrtl.synthesize()
         pyrtl.optimize()
@@ -566,6 +679,283 @@ class MemBlockBase(unittest.TestCase):
                                             'o3 000000\n')
 
 
+class EventDrivenSimBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        self.en = pyrtl.Input(1, 'en')
+        self.addr = pyrtl.Input(2, 'addr')
+        self.counter = pyrtl.Register(4, 'counter')
+        self.mem = pyrtl.MemBlock(bitwidth=4, addrwidth=2, name='mem')
+        self.out = pyrtl.Output(5, 'out')
+        self.counter.next <<= pyrtl.select(self.en, self.counter + 1, self.counter)
+        self.mem[self.counter[0:2]] <<= pyrtl.MemBlock.EnabledWrite(self.counter, self.en)
+        self.out <<= self.mem[self.addr] + ~self.counter
+
+    def test_event_driven_matches(self):
+        inputs = [{'en': en, 'addr': addr}
+                  for en, addr in [(0, 0), (0, 0), (1, 0), (1, 1), (0, 1), (0, 1),
+                                   (1, 2), (0, 0), (0, 0), (1, 3), (0, 3), (0, 3)]]
+        reference = self.sim()
+        event_sim = pyrtl.Simulation(event_driven=True)
+        for step_inputs in inputs:
+            reference.step(step_inputs)
+            event_sim.step(step_inputs)
+        for name in ('en', 'addr', 'counter', 'out'):
+            self.assertEqual(event_sim.tracer.trace[name], reference.tracer.trace[name])
+        self.assertEqual(event_sim.inspect_mem(self.mem), reference.inspect_mem(self.mem))
+
+
+class CheckpointBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        self.inc = pyrtl.Input(2, 'inc')
+        self.counter = pyrtl.Register(70, 'counter')
+        self.counter.next <<= self.counter + self.inc
+        self.mem = pyrtl.MemBlock(bitwidth=8, addrwidth=2, name='mem')
+        self.mem[self.counter[0:2]] <<= self.counter[0:8]
+        self.out = pyrtl.Output(8, 'out')
+        self.out <<= self.mem[self.inc]
+        self.cnt = pyrtl.Output(70, 'cnt')
+        self.cnt <<= self.counter
+
+    def run_steps(self, sim, incs):
+        for inc in incs:
+            sim.step({'inc': inc})
+
+    def test_checkpoint_restore(self):
+        sim = self.sim(register_value_map={self.counter: 2**69})
+        self.run_steps(sim, [1, 3, 2, 1, 3])
+        snapshot = sim.checkpoint()
+        self.run_steps(sim, [2, 2, 2])
+        first_pass = {w: list(sim.tracer.trace[w]) for w in ('out', 'cnt')}
+        first_mem = dict(sim.inspect_mem(self.mem))
+        self.run_steps(sim, [1, 1, 3, 3])
+        sim.restore(snapshot)
+        self.assertEqual(len(sim.tracer), 5)
+        self.run_steps(sim, [2, 2, 2])
+        for w in ('out', 'cnt'):
+            self.assertEqual(sim.tracer.trace[w], first_pass[w])
+        self.assertEqual(dict(sim.inspect_mem(self.mem)), first_mem)
+
+    def test_checkpoint_mmap_memory(self):
+        import gc
+        import os
+        sim = self.sim(memory_backends={self.mem: pyrtl.MmapMemory})
+        self.run_steps(sim, [1, 3, 2])
+        snapshot = sim.checkpoint()
+        first_mem = dict(sim.inspect_mem(self.mem))
+        self.run_steps(sim, [3, 3, 1])
+        sim.restore(snapshot)
+        self.assertEqual(dict(sim.inspect_mem(self.mem)), first_mem)
+        filename = sim.inspect_mem(self.mem).filename
+        self.assertTrue(os.path.exists(filename))
+        del sim, snapshot
+        gc.collect()
+        self.assertFalse(os.path.exists(filename))  # the temporary file is removed
+
+    def test_fork(self):
+        sim = self.sim()
+        self.run_steps(sim, [1, 3, 2])
+        forked = sim.fork()
+        self.run_steps(sim, [1, 1])
+        self.run_steps(forked, [3, 3])
+        self.assertEqual(sim.tracer.trace['cnt'], [0, 1, 4, 6, 7])
+        self.assertEqual(forked.tracer.trace['cnt'], [0, 1, 4, 6, 9])
+        self.assertEqual(sim.inspect_mem(self.mem)[3], 7)
+        self.assertEqual(forked.inspect_mem(self.mem)[1], 9)
+
+
+class FastForwardBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        self.go = pyrtl.Input(1, 'go')
+        self.count = pyrtl.Register(4, 'count')
+        with pyrtl.conditional_assignment:
+            with self.go | (self.count != 0):
+                self.count.next |= self.count + 1
+        self.out = pyrtl.Output(4, 'out')
+        self.out <<= self.count
+
+    def test_fast_forward_columnar(self):
+        if self.sim is not pyrtl.Simulation:
+            self.skipTest('only Simulation fast forwards')
+        reference = self.sim()
+        skipping = self.sim(fast_forward=True)
+        gos = [0] * 5 + [1] + [0] * 30
+        reference.run({'go': gos})
+        skipped = skipping.run({'go': gos})
+        skipping.step({'go': 0})
+        reference.step({'go': 0})
+        self.assertEqual(skipping.tracer.trace['out'], reference.tracer.trace['out'])
+        self.assertEqual(skipped, 4 + 14)
+        self.assertEqual(skipping.cycles_skipped, skipped + 1)
+
+    def test_fast_forward_matches(self):
+        if self.sim is not pyrtl.Simulation:
+            self.skipTest('only Simulation fast forwards')
+        gos = [0] * 5 + [1] + [0] * 30 + [1, 0, 0]
+        reference = self.sim()
+        skipping = self.sim(fast_forward=True)
+        reference.run([{'go': go} for go in gos])
+        skipped = skipping.run([{'go': go} for go in gos])
+        self.assertEqual(skipping.tracer.trace['out'], reference.tracer.trace['out'])
+        self.assertTrue(skipped > 0)
+        self.assertEqual(skipping.cycles_skipped, skipped)
+
+    def test_fast_forward_fork(self):
+        if self.sim is not pyrtl.Simulation:
+            self.skipTest('only Simulation fast forwards')
+        sim = self.sim(fast_forward=True)
+        for _ in range(20):
+            sim.step({'go': 0})
+        self.assertEqual(sim.cycles_skipped, 19)
+        self.assertEqual(sim.fork().cycles_skipped, 19)
+
+
+class TriggeredTraceBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        self.x = pyrtl.Input(2, 'x')
+        count = pyrtl.Register(4, 'count')
+        count.next <<= count + 1
+        self.out = pyrtl.Output(4, 'out')
+        self.out <<= count
+
+    def run_trace(self, tracer, steps=24, xs=None):
+        sim = self.sim(tracer=tracer)
+        xs = xs or [0] * steps
+        sim.run([{'x': x} for x in xs[:steps // 2]])
+        sim.run([{'x': x} for x in xs[steps // 2:]])
+        return tracer
+
+    def test_trigger_window(self):
+        tracer = self.run_trace(pyrtl.TriggeredTrace(
+            {self.out: 5}, pre_trigger=2, post_trigger=3, wires_to_track=[self.x, self.out]))
+        self.assertEqual(tracer.cycles, [3, 4, 5, 6, 7, 8, 19, 20, 21, 22, 23])
+        self.assertEqual(tracer.trace['out'], [c % 16 for c in tracer.cycles])
+
+    def test_trigger_decimate(self):
+        tracer = self.run_trace(pyrtl.TriggeredTrace(
+            {'out': 5}, pre_trigger=2, post_trigger=3, decimate=2,
+            wires_to_track=[self.x, self.out]))
+        self.assertEqual(tracer.cycles, [2, 4, 5, 6, 8, 10, 18, 20, 21, 22])
+        self.assertEqual(tracer.trace['out'], [c % 16 for c in tracer.cycles])
+
+    def test_trigger_retrigger_extends(self):
+        xs = [0] * 6 + [3, 0, 3] + [0] * 15
+        tracer = self.run_trace(pyrtl.TriggeredTrace(
+            {'x': 3}, pre_trigger=1, post_trigger=2, wires_to_track=[self.x, self.out]),
+            xs=xs)
+        self.assertEqual(tracer.cycles, [5, 6, 7, 8, 9, 10])
+        self.assertEqual(tracer.trace['x'], [0, 3, 0, 3, 0, 0])
+
+    def test_trigger_function(self):
+        xs = [0] * 10 + [2] + [0] * 13
+        tracer = self.run_trace(pyrtl.TriggeredTrace(
+            lambda values: values['x'] == 2 and values['out'] == 10,
+            post_trigger=1, wires_to_track=[self.x, self.out]), xs=xs)
+        self.assertEqual(tracer.cycles, [10, 11])
+        self.assertEqual(tracer.trace['out'], [10, 11])
+
+    def test_trigger_checkpoint(self):
+        tracer = pyrtl.TriggeredTrace(
+            {'out': 5}, pre_trigger=2, post_trigger=3, wires_to_track=[self.x, self.out])
+        sim = self.sim(tracer=tracer)
+        sim.run([{'x': 0}] * 6)
+        checkpoint = sim.checkpoint()  # waiting for the samples after the trigger
+        sim.run([{'x': 0}] * 10)
+        sim.restore(checkpoint)
+        self.assertEqual(tracer.cycles, [3, 4, 5])
+        sim.run([{'x': 0}] * 12)
+        checkpoint = sim.checkpoint()  # with cycles 16 and 17 in the window
+        sim.run([{'x': 1}] * 10)
+        sim.restore(checkpoint)
+        sim.run([{'x': 0}] * 6)
+        self.assertEqual(tracer.cycles, [3, 4, 5, 6, 7, 8, 19, 20, 21, 22, 23])
+        self.assertEqual(tracer.trace['out'], [c % 16 for c in tracer.cycles])
+
+    def test_trigger_untraced_wire(self):
+        tracer = pyrtl.TriggeredTrace({'x': 1}, wires_to_track=[self.out])
+        with self.assertRaises(pyrtl.PyrtlError):
+            self.run_trace(tracer)
+
+    def test_trigger_bad_options(self):
+        with self.assertRaises(pyrtl.PyrtlError):
+            pyrtl.TriggeredTrace({'x': 1}, decimate=0)
+        with self.assertRaises(pyrtl.PyrtlError):
+            pyrtl.TriggeredTrace(3)
+
+
+class RunUntilBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        self.req = pyrtl.Input(1, 'req')
+        self.count = pyrtl.Register(4, 'count')
+        with pyrtl.conditional_assignment:
+            with self.req:
+                self.count.next |= self.count + 1
+        self.ready = pyrtl.Output(1, 'ready')
+        self.ready <<= self.count == 5
+        self.val = pyrtl.Output(4, 'val')
+        self.val <<= self.count
+
+    def test_run_until_output(self):
+        sim = self.sim()
+        cycles, final = sim.run_until({self.ready: 1}, {'req': 1}, 100)
+        self.assertEqual(cycles, 6)
+        self.assertEqual(final['ready'], 1)
+        self.assertEqual(final['val'], 5)
+        self.assertEqual(sim.tracer.trace['val'], [0, 1, 2, 3, 4, 5])
+        self.assertEqual(sim.tracer.trace['req'], [1] * 6)
+
+    def test_run_until_register(self):
+        sim = self.sim()
+        cycles, final = sim.run_until({'count': 3}, {'req': [1, 1, 1, 1, 1]}, 100)
+        self.assertEqual(cycles, 4)
+        self.assertEqual(final['count'], 3)
+        self.assertEqual(final['val'], 3)
+
+    def test_run_until_cap_and_stimulus(self):
+        sim = self.sim()
+        self.assertEqual(sim.run_until({'ready': 1}, {'req': 0}, 10)[0], 10)
+        cycles, final = sim.run_until({'ready': 1}, {'req': [1, 0, 1]}, 100)
+        self.assertEqual(cycles, 3)
+        self.assertEqual(final['ready'], 0)
+        cycles, final = sim.run_until({'ready': 1}, {'req': 1}, 100)
+        self.assertEqual(cycles, 4)
+        self.assertEqual(final['val'], 5)
+        self.assertEqual(sim.tracer.trace['val'], [0] * 11 + [1, 1, 2, 3, 4, 5])
+
+    def test_run_until_matches_step(self):
+        reference = self.sim()
+        for req in [1, 1, 0, 1, 1, 1, 1]:
+            reference.step({'req': req})
+        sim = self.sim()
+        cycles, _ = sim.run_until({'ready': 1}, {'req': [1, 1, 0, 1, 1, 1, 1, 1, 1]}, 100)
+        self.assertEqual(cycles, 7)
+        self.assertEqual(sim.tracer.trace['val'], reference.tracer.trace['val'])
+
+    def test_run_until_bad_condition(self):
+        sim = self.sim()
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.run_until({'req': 1}, {'req': 1}, 10)
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.run_until({'ready': 2}, {'req': 1}, 10)
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.run_until({'ready': 1}, [{'req': 1}], 10)
+
+    def test_run_until_no_cycles(self):
+        sim = self.sim()
+        sim.run({'req': [1, 1, 1]})
+        cycles, final = sim.run_until({'count': 3}, {'req': 1}, 0)
+        self.assertEqual(cycles, 0)
+        self.assertEqual(final, {'count': 2, 'val': 2, 'ready': 0})
+        cycles, final = sim.run_until({'count': 3}, {'req': []}, 10)
+        self.assertEqual(cycles, 0)
+        self.assertEqual(final, {'count': 2, 'val': 2, 'ready': 0})
+        self.assertEqual(sim.tracer.trace['val'], [0, 1, 2])
+
+
 class RegisterDefaultsBase(unittest.TestCase):
     def setUp(self):
         pyrtl.reset_working_block()
@@ -650,6 +1040,22 @@ class RomBlockSimBase(unittest.TestCase):
                                                  ("o2", lambda x: rom_data_function(2*x))), 6)
         self.compareIO(self.sim_trace, exp_out)
 
+    def test_RomBlock_read_once(self):
+        reads = []
+
+        def rom_data_function(addr):
+            reads.append(addr)
+            return addr + 1
+
+        read_addr1, read_addr2 = pyrtl.Input(3, 'a1'), pyrtl.Input(3, 'a2')
+        rom = pyrtl.RomBlock(bitwidth=4, addrwidth=3, name='rom', romdata=rom_data_function)
+        output = pyrtl.Output(4, 'o')
+        output <<= rom[read_addr1] + rom[read_addr2]
+        sim = self.sim()
+        sim.step({'a1': 2, 'a2': 5})
+        self.assertEqual(sim.inspect('o'), 3 + 6)
+        self.assertEqual(sorted(reads), list(range(8)))  # once per address, for all ports
+
     def test_function_RomBlock_with_optimization(self):
 
         def rom_data_function(add):
@@ -698,6 +1104,15 @@ class RomBlockSimBase(unittest.TestCase):
         with self.assertRaises(pyrtl.PyrtlError):
             sim.step({rom_add_1: 7})
 
+    def test_rom_invalid_data_at_construction(self):
+        rom1 = pyrtl.RomBlock(bitwidth=4, addrwidth=2, romdata=[1, 2, 16, 3])
+        rom_add_1 = pyrtl.Input(2, "rom_in")
+        rom_out_1 = pyrtl.Output(4, "rom_out_1")
+        rom_out_1 <<= rom1[rom_add_1]
+
+        with self.assertRaises(pyrtl.PyrtlError):
+            self.sim()
+
     def test_rom_val_map(self):
         def rom_data_function(add):
             return int((add + 5) / 2)
@@ -782,6 +1197,67 @@ class TraceErrorBase(unittest.TestCase):
             self.sim_trace.print_trace(base=4)
 
 
+class LockstepBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        self.addr = pyrtl.Input(4, 'addr')
+        self.mem = pyrtl.MemBlock(8, 4, 'mem')
+        acc = pyrtl.Register(8, 'acc')
+        acc.next <<= acc + self.addr
+        out = pyrtl.Output(8, 'out')
+        out <<= self.mem[self.addr]
+        self.inputs = {'addr': [n % 13 for n in range(40)]}
+
+    def test_lockstep_agrees(self):
+        sim_a, sim_b = self.sim(), pyrtl.Simulation()
+        self.assertIsNone(pyrtl.lockstep(sim_a, sim_b, self.inputs, wires=['out', 'acc'],
+                                         chunk_size=7))
+        self.assertEqual(sim_a.tracer.trace['acc'], [])
+        self.assertEqual(sim_a.inspect('acc'), sum(n % 13 for n in range(39)) % 256)
+        steps = [{'addr': n} for n in range(5)]
+        self.assertIsNone(pyrtl.lockstep(sim_a, sim_b, steps, keep_trace=True))
+        self.assertEqual(sim_b.tracer.trace['addr'], list(range(5)))
+
+    def test_lockstep_diverges(self):
+        sim_a = self.sim()
+        sim_b = pyrtl.Simulation(memory_value_map={self.mem: {9: 3}})
+        divergence = pyrtl.lockstep(sim_a, sim_b, self.inputs, chunk_size=4)
+        self.assertEqual(divergence.cycle, 9)
+        self.assertEqual(divergence.values, {'out': (0, 3)})
+        self.assertEqual(divergence.inputs, {'addr': 9})
+        self.assertEqual(divergence.exceptions, (None, None))
+        self.assertIn('out: 0 != 3', str(divergence))
+        # the traces keep the chunk of cycles 8 to 11 up to the divergence
+        self.assertEqual(sim_a.tracer.trace['out'], [0, 0])
+        self.assertEqual(sim_b.tracer.trace['out'], [0, 3])
+
+    def test_lockstep_assertion(self):
+        pyrtl.rtl_assert(self.addr != 12, ValueError('addr 12'))
+        sim_a, sim_b = self.sim(), pyrtl.Simulation()
+        with self.assertRaises(ValueError):
+            pyrtl.lockstep(sim_a, sim_b, self.inputs)
+        sim_a = self.sim()
+        self.setUp()  # the same design without the assertion
+        divergence = pyrtl.lockstep(sim_a, pyrtl.Simulation(), self.inputs)
+        self.assertEqual(divergence.cycle, 12)
+        self.assertEqual(divergence.values, {})
+        self.assertIsInstance(divergence.exceptions[0], ValueError)
+        self.assertIsNone(divergence.exceptions[1])
+
+    def test_lockstep_errors(self):
+        with self.assertRaises(pyrtl.PyrtlError):
+            pyrtl.lockstep(self.sim(), pyrtl.Simulation(), self.inputs, wires=['mem'])
+        with self.assertRaises(pyrtl.PyrtlError):
+            pyrtl.lockstep(self.sim(), pyrtl.Simulation(), {'addr': 1})
+        with self.assertRaises(pyrtl.PyrtlError):
+            pyrtl.lockstep(self.sim(), pyrtl.Simulation(), {'addr': [16]})
+        with self.assertRaises(pyrtl.PyrtlError):
+            pyrtl.lockstep(self.sim(tracer=None), pyrtl.Simulation(), self.inputs, wires=[])
+        with self.assertRaises(pyrtl.PyrtlError):
+            tracer = pyrtl.TriggeredTrace({'addr': 3})
+            pyrtl.lockstep(self.sim(tracer=tracer), pyrtl.Simulation(), self.inputs)
+
+
 def make_unittests():
     """
     Generates separate unittests for each of the simulators